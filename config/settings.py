@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -90,6 +91,17 @@ STATICFILES_DIRS = (
 
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
+# 静的ファイルはファイル名に内容のハッシュを付け、圧縮したファイルも書き出す
+STATICFILES_STORAGE = 'taxishare.storage.CompressedManifestStaticFilesStorage'
+
+# WhiteNoiseがあれば、圧縮したファイルを選び、ハッシュ付きのファイルは長期間キャッシュさせて配信する
+try:
+    import whitenoise
+except ImportError:
+    whitenoise = None
+if whitenoise is not None:
+    MIDDLEWARE.insert(1, 'whitenoise.middleware.WhiteNoiseMiddleware')
+
 
 """
 Customized settings
@@ -103,3 +115,66 @@ LOGIN_REDIRECT_URL = 'taxishare:top'
 
 # メールをコンソールに表示する
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+
+# 配車依頼をまとめる時間幅（秒）
+DISPATCH_WINDOW_SECONDS = 60*5
+
+# 出発地（乗車地点）の候補（名称, 緯度, 経度）
+TAXISHARE_ORIGINS = [
+    ('錦糸町駅', 35.696739, 139.814484),
+    ('両国駅', 35.696340, 139.793330),
+    ('押上駅', 35.710440, 139.812880),
+]
+
+# 出発地毎の配車処理を並行して行うワーカー数
+DISPATCH_WORKERS = 4
+
+# 配車に使うソルバー（'auto'なら利用者数から選ぶ。'dapt', 'sa', 'tabu', 'exact', 'local'）
+# （ローカルでQUBOを解くならtabuを使う。saは10人では既定の計算量でも厳密解に届く割合が低い）
+DISPATCH_ENGINE = 'auto'
+
+# 作成したQUBOをメモリマップしてプロセス間で共有するディレクトリ（Noneなら共有しない）
+DISPATCH_MODEL_CACHE = os.path.join(tempfile.gettempdir(), 'taxishare_models')
+
+# QUBOで解くとき、出発地・時間幅毎のバッチをまとめて1回でソルバーに投げる
+DISPATCH_BATCH_QUBO = True
+
+# バッチ毎の配車処理の期限（秒）。ソルバーと局所探索を並行して動かし、期限の時点で最良の結果を使う
+# （QUBOをまとめて投げるときは使わない。Noneなら選んだソルバーの結果を待つ）
+DISPATCH_BUDGET_SECONDS = 5
+
+# 配車処理の入力と結果を保存するディレクトリ（Noneなら保存しない。replay_dispatchで再計算に使う）
+# 例: DISPATCH_ARCHIVE_DIR = os.path.join(BASE_DIR, 'dispatch_archive')
+DISPATCH_ARCHIVE_DIR = None
+# 保存するファイル数の上限（配車の度に古いものから削除する）
+DISPATCH_ARCHIVE_MAX_FILES = 10000
+
+# QUBOソルバーの計算の記録と、記録から選んだ問題の大きさ毎のパラメータを置くディレクトリ
+# （Noneなら既定のパラメータで解き、記録しない。tune_sweepで記録を増やしパラメータを選び直す）
+# 例: DISPATCH_TUNING_DIR = os.path.join(BASE_DIR, 'dispatch_tuning')
+DISPATCH_TUNING_DIR = None
+# 計算の記録（history.jsonl）の大きさの上限（バイト）。超えたら1世代前に回し、それより古い記録は捨てる
+DISPATCH_TUNING_MAX_BYTES = 16*1024*1024
+
+# 残す公開済みの配車結果の版の数と、古い版の行を1回に削除する行数
+DISPATCH_KEEP_RUNS = 3
+DISPATCH_GC_BATCH = 1000
+
+# 空車を割り当てる迎車距離の上限（km）。Noneなら上限なし
+DISPATCH_MAX_PICKUP_KM = None
+
+# 配車処理の次の計算を待つ依頼数の上限と、taxi_searchが配車結果を待つ期限（秒）
+# （期限までに終わらなければ公開済みの配車結果を表示する。計算中の依頼は次の1回にまとめる）
+DISPATCH_QUEUE_LIMIT = 100
+DISPATCH_DEADLINE_SECONDS = 10
+# 受け付けた配車処理を同時に計算するワーカースレッドの数
+# （配車結果の書き込みは1つずつなので、書き込み中に始めたワーカーは終わるのを待ってやり直す）
+DISPATCH_ADMISSION_WORKERS = 1
+
+# 特徴量を利用者全体の統計量（スナップショットの更新毎に1人分ずつ更新）で標準化する
+# （Falseならバッチの中で標準化する）
+DISPATCH_GLOBAL_NORMALIZATION = True
+
+# QUBOで解くとき、目的地が同じ一辺50mの格子にある利用者を1つのノードにまとめてqubit数を減らす
+# （まとめた利用者は必ず相乗りする。Noneならまとめない）
+DISPATCH_SNAP_METERS = 50
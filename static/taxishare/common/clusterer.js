@@ -0,0 +1,85 @@
+// 地図の表示範囲を格子に分け、同じ格子のマーカーを件数付きの1つのマーカーにまとめて表示する
+// （外部のクラスタリングライブラリを読み込まないための最小限の実装）
+function GridClusterer(map, options) {
+  options = options || {};
+  var grid = options.grid || 8;  // 表示範囲を縦横に分ける数
+  var maxZoom = options.maxZoom || 16;  // これより拡大したらまとめない
+  var markers = [];
+  var clusters = [];  // 表示中の件数付きマーカー
+
+  function clear() {
+    clusters.forEach(function(cluster) { cluster.setMap(null); });
+    clusters = [];
+  }
+
+  function clusterIcon(count) {
+    return {
+      path: google.maps.SymbolPath.CIRCLE,
+      scale: 12 + Math.min(12, Math.log(count) * 3),
+      fillColor: "#4363d8",
+      fillOpacity: 0.8,
+      strokeColor: "#ffffff",
+      strokeWeight: 2,
+    };
+  }
+
+  function redraw() {
+    var bounds = map.getBounds();
+    clear();
+    if (!bounds) {
+      return;
+    }
+    if (map.getZoom() >= maxZoom) {
+      markers.forEach(function(marker) { marker.setMap(map); });
+      return;
+    }
+    var sw = bounds.getSouthWest();
+    var ne = bounds.getNorthEast();
+    var height = (ne.lat() - sw.lat()) / grid;
+    var width = ((ne.lng() - sw.lng() + 360) % 360 || 360) / grid;
+    var cells = {};
+    markers.forEach(function(marker) {
+      var position = marker.getPosition();
+      if (!bounds.contains(position)) {
+        marker.setMap(null);
+        return;
+      }
+      var key = Math.floor((position.lat() - sw.lat()) / height) + ","
+                + Math.floor((((position.lng() - sw.lng()) + 360) % 360) / width);
+      (cells[key] = cells[key] || []).push(marker);
+    });
+    Object.keys(cells).forEach(function(key) {
+      var members = cells[key];
+      if (members.length === 1) {
+        members[0].setMap(map);
+        return;
+      }
+      var lat = 0, lng = 0;
+      members.forEach(function(marker) {
+        marker.setMap(null);
+        lat += marker.getPosition().lat();
+        lng += marker.getPosition().lng();
+      });
+      var cluster = new google.maps.Marker({
+        position: {lat: lat / members.length, lng: lng / members.length},
+        map: map,
+        icon: clusterIcon(members.length),
+        label: {text: String(members.length), color: "#ffffff", fontSize: "11px"},
+      });
+      cluster.addListener("click", function() { // クリックしたら拡大する
+        map.setCenter(cluster.getPosition());
+        map.setZoom(map.getZoom() + 2);
+      });
+      clusters.push(cluster);
+    });
+  }
+
+  map.addListener("idle", redraw);
+
+  return {
+    addMarkers: function(added) {
+      markers = markers.concat(added);
+      redraw();
+    },
+  };
+}
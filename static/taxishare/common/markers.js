@@ -0,0 +1,23 @@
+// マーカーのスプライトから地図のアイコンを作る
+// テンプレートで {% marker_sprite %} を埋め込んでから読み込む
+var MarkerSprite = (function() {
+  var sprite = JSON.parse(document.getElementById("marker-sprite").textContent);
+
+  // 名前（"black", "pink", "1"など）のアイコン
+  function icon(name, size) {
+    var index = sprite.names[name];
+    return {
+      url: sprite.url,
+      size: new google.maps.Size(size, size),
+      origin: new google.maps.Point(index*size, 0),
+      scaledSize: new google.maps.Size(sprite.columns*size, size),
+    };
+  }
+
+  // 配車番号のアイコン（番号付きのマーカーを順に使い回す）
+  function taxi(number, size) {
+    return icon(String(number % sprite.numbered + 1), size);
+  }
+
+  return {icon: icon, taxi: taxi};
+})();
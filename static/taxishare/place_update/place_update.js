@@ -1,6 +1,10 @@
 /* GoogleMap*/
 function initMap() {
-  var origin_latlng = {lat: 35.696739, lng: 139.814484};
+  // 出発地の候補（[名称, 緯度, 経度]のリスト）
+  var origins = JSON.parse(document.getElementById("origins").textContent);
+  var origin_select = document.getElementById("id_origin");
+  var origin = origins[origin_select.value];
+  var origin_latlng = {lat: origin[1], lng: origin[2]};
   var destination_latlng = {lat: 35.698383, lng: 139.773072};
   var center_latlng = {lat: (origin_latlng.lat+destination_latlng.lat)/2,
                        lng: (origin_latlng.lng+destination_latlng.lng)/2};
@@ -17,22 +21,23 @@ function initMap() {
   var origin_marker = new google.maps.Marker({
     position: origin_latlng,
     map: map,
-    icon: {
-      url:"/static/taxishare/place_update/images/black.png",
-      scaledSize: new google.maps.Size(50, 50),
-    },
+    icon: MarkerSprite.icon("black", 50),
   });
 
   var destination_marker = new google.maps.Marker({
     position: destination_latlng,
     map: map,
-    icon: {
-      url:"/static/taxishare/place_update/images/pink.png",
-      scaledSize: new google.maps.Size(50, 50),
-    },
+    icon: MarkerSprite.icon("pink", 50),
     draggable: true,
   });
 
+  // 出発地を選び直したとき
+  origin_select.addEventListener('change', function() {
+    var origin = origins[origin_select.value];
+    origin_marker.setPosition({lat: origin[1], lng: origin[2]});
+    map.panTo(origin_marker.getPosition());
+  });
+
   //　クリックイベント
   google.maps.event.addListener(destination_marker, 'dragend', function() {
     outputLatLng(destination_marker.getPosition());
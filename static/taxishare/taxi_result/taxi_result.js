@@ -1,23 +1,108 @@
 function initMap() {
-  var origin_latlng = {lat: 35.696739, lng: 139.814484};
-  var center_latlng = {lat: 35.6885, lng: 139.79825997407};
+  // 利用者の出発地（配車したときのもの）を中心にする
+  var origin_latlng = JSON.parse(document.getElementById("origin").textContent);
 
   // マップの生成
   var map = new google.maps.Map(document.getElementById("map"),{
-    center: new google.maps.LatLng(center_latlng),
+    center: new google.maps.LatLng(origin_latlng),
     zoom: 14,
     mapTypeControl: false,
     fullscreenControl: false,
   });
 
-  var origin_marker = new google.maps.Marker({
-    position: origin_latlng,
-    map: map,
-    icon: {
-      url:"/static/taxishare/taxi_result/images/black.png",
-      scaledSize: new google.maps.Size(30, 30),
-    },
+  loadMarkers(map);
+  addRoutes(map, origin_latlng);
+}
+
+// 表示範囲の目的地のマーカーをまとめて読み込み、クラスタにまとめて表示する
+function loadMarkers(map) {
+  var url = document.getElementById("map").dataset.markersUrl;
+  var clusterer = GridClusterer(map, {maxZoom: 16});
+  var info_window = new google.maps.InfoWindow();
+  var loaded = {};  // 読み込み済みのマーカー
+  var controller = null;
+
+  function addMarker(lat, lng, number, order) {
+    var key = [lat, lng, number].join(",");
+    if (loaded[key]) {
+      return null;
+    }
+    var marker = new google.maps.Marker({
+      position: {lat: lat, lng: lng},
+      icon: MarkerSprite.taxi(number, 30),
+    });
+    marker.addListener("click", function() { // マーカーをクリックしたとき吹き出しを表示
+      info_window.setContent("<div class=\"sample\">配車番号 : " + number
+                             + (order ? "<br>降車順 : " + order : "") + "</div>");
+      info_window.open(map, marker);
+    });
+    loaded[key] = marker;
+    return marker;
+  }
+
+  // 地図の移動・拡大縮小が止まったら、表示範囲のマーカーを読み込む
+  map.addListener("idle", function() {
+    var bounds = map.getBounds();
+    if (!bounds) {
+      return;
+    }
+    if (controller) {
+      controller.abort();  // 前の読み込みは取り消す
+    }
+    controller = new AbortController();
+    var sw = bounds.getSouthWest();
+    var ne = bounds.getNorthEast();
+    var bbox = [sw.lat(), sw.lng(), ne.lat(), ne.lng()].map(function(v) { return v.toFixed(6); }).join(",");
+    fetch(url + (url.indexOf("?") < 0 ? "?" : "&") + "bbox=" + bbox, {credentials: "same-origin", signal: controller.signal})
+      .then(function(response) { return response.json(); })
+      .then(function(data) {
+        var markers = [];
+        data.markers.forEach(function(row) {
+          var marker = addMarker(row[0], row[1], row[2], row[3]);
+          if (marker) {
+            markers.push(marker);
+          }
+        });
+        clusterer.addMarkers(markers);
+      })
+      .catch(function(error) {
+        if (error.name !== "AbortError") {
+          console.error(error);
+        }
+      });
   });
+}
+
+// タクシー毎に出発地から降車順に目的地を結び、出発地にマーカーを置く
+function addRoutes(map, origin_latlng) {
+  var colors = ["#e6194b", "#3cb44b", "#4363d8", "#f58231", "#911eb4", "#42d4f4", "#f032e6", "#9a6324"];
+  var routes = JSON.parse(document.getElementById("routes").textContent);
+  var origins = {};  // 出発地毎に1つだけマーカーを置く
 
-  addMarkers(map);
+  function addOrigin(lat, lng) {
+    var key = [lat, lng].join(",");
+    if (origins[key]) {
+      return;
+    }
+    origins[key] = new google.maps.Marker({
+      position: {lat: lat, lng: lng},
+      map: map,
+      icon: MarkerSprite.icon("black", 30),
+    });
+  }
+
+  addOrigin(origin_latlng.lat, origin_latlng.lng);
+  routes.forEach(function(route) {
+    if (route.path[0][0] !== null && route.path[0][1] !== null) {
+      addOrigin(route.path[0][0], route.path[0][1]);
+    }
+    new google.maps.Polyline({
+      path: route.path.map(function(p) { return {lat: p[0], lng: p[1]}; }),
+      map: map,
+      strokeColor: colors[route.number % colors.length],
+      strokeOpacity: 0.8,
+      strokeWeight: 3,
+      icons: [{icon: {path: google.maps.SymbolPath.FORWARD_OPEN_ARROW}, repeat: "80px"}],
+    });
+  });
 }
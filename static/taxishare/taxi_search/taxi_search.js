@@ -12,10 +12,7 @@ function initMap() {
   var origin_marker = new google.maps.Marker({
     position: origin_latlng,
     map: map,
-    icon: {
-      url:"/static/taxishare/taxi_search/images/black.png",
-      scaledSize: new google.maps.Size(30, 30),
-    },
+    icon: MarkerSprite.icon("black", 30),
   });
 
   addMarkers(map);
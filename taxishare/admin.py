@@ -2,7 +2,7 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.forms import UserChangeForm, UserCreationForm
 from django.utils.translation import ugettext_lazy as _
-from .models import User, Taxi
+from .models import User, Taxi, RiderSnapshot, DispatchRun, Vehicle, FeatureStatistic
 from django import forms
 
 
@@ -54,3 +54,20 @@ class MyUserAdmin(UserAdmin):
 
 admin.site.register(User, MyUserAdmin)
 admin.site.register(Taxi)
+admin.site.register(DispatchRun)
+class VehicleAdmin(admin.ModelAdmin):
+    list_display = ('name', 'capacity', 'is_available', 'updated_at')
+    list_filter = ('is_available',)
+    actions = ['release']
+
+    def release(self, request, queryset):
+        """
+        運行を終えた車両を空車に戻し、次の配車で割り当てられるようにする。
+        """
+        self.message_user(request, '{}台を空車に戻しました。'.format(queryset.update(is_available=True)))
+    release.short_description = '運行を終えた車両を空車に戻す'
+
+
+admin.site.register(Vehicle, VehicleAdmin)
+admin.site.register(FeatureStatistic)
+admin.site.register(RiderSnapshot)
@@ -0,0 +1,216 @@
+import time
+import logging
+import threading
+from collections import Counter, deque
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+SMOOTHING = 0.3  # 計算時間の指数移動平均の重み
+
+
+class Ticket(object):
+    """
+    配車処理の依頼1件を保持する。
+
+    Attributes
+    ----------
+    submitted: float
+        依頼した時刻（time.monotonic）
+    deadline: float
+        結果を待つ期限（time.monotonic）
+    status: str
+        'done'（計算済み）、'failed'（計算に失敗）、'rejected'（待ち行列があふれて断った）、
+        計算中ならNone
+    result: object
+        計算の戻り値
+    finish: method
+        結果を設定し、待っている依頼者に知らせる。
+    """
+    def __init__(self, deadline):
+        self.submitted = time.monotonic()
+        self.deadline = self.submitted+deadline
+        self.status = None
+        self.result = None
+        self.event = threading.Event()
+
+    def finish(self, status, result=None):
+        """
+        結果を設定し、待っている依頼者に知らせる。
+        """
+        self.status = status
+        self.result = result
+        self.event.set()
+
+
+class Admission(object):
+    """
+    配車処理の依頼を受け付け、同時に行う計算の数を抑える。
+    計算はworkers個までのワーカースレッドで行い、全てのワーカーが計算中に来た依頼は次の1回の計算にまとめる。
+    期限までに結果が出ない依頼者は待たずに戻り、公開済みの配車結果を使う。
+
+    Attributes
+    ----------
+    work: function
+        計算（引数なし）
+    max_queue: int
+        次の計算を待つ依頼数の上限（超えたら断る）
+    deadline: float
+        依頼者が結果を待つ既定の期限（秒）
+    workers: int
+        同時に計算するワーカースレッドの数の上限
+    request: method
+        依頼を受け付ける。
+    wait: method
+        期限まで結果を待つ。
+    join: method
+        受け付けた依頼の計算が全て終わるまで待つ。
+    metrics: method
+        待ち行列の長さや待ち時間などを返す。
+    """
+    def __init__(self, work, max_queue=100, deadline=10.0, history=1000, workers=1):
+        if workers < 1:
+            raise ValueError('workers must be at least 1: {}'.format(workers))
+        self.work = work
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.waiting = []  # 次の計算にまとめる依頼
+        self.running = {}  # ワーカー毎の計算中の依頼と計算を始めた時刻
+        self.active = 0  # 動いているワーカーの数
+        self.idle = threading.Event()
+        self.idle.set()
+        self.solve_seconds = None  # 計算時間の指数移動平均
+        self.counters = Counter()
+        self.waits = deque(maxlen=history)  # 直近の依頼の待ち時間
+
+    def estimate(self):
+        """
+        今依頼した場合に、結果が出るまでの見込み時間（秒）を返す。まだ計算していなければ0を返す。
+        """
+        if self.solve_seconds is None:
+            return 0.0
+        if self.active < self.workers:
+            return self.solve_seconds  # 空いているワーカーがすぐに始める
+        # 最も早く終わりそうなワーカーの計算が終わってから始める
+        now = time.monotonic()
+        remaining = min([max(0.0, self.solve_seconds-(now-since)) for _, since in self.running.values()],
+                        default=0.0)
+        return remaining+self.solve_seconds
+
+    def request(self, deadline=None):
+        """
+        依頼を受け付ける。空いているワーカーがあれば始め、無ければ次の計算にまとめる。
+
+        Parameters
+        ----------
+        deadline: float
+            結果を待つ期限（秒、省略時は既定の期限）
+
+        Returns
+        -------
+        ticket: Ticket
+            依頼
+        """
+        ticket = Ticket(self.deadline if deadline is None else deadline)
+        with self.lock:
+            self.counters['requests'] += 1
+            if len(self.waiting) >= self.max_queue:
+                ticket.finish('rejected')
+                return ticket
+            if self.waiting or self.active >= self.workers:
+                self.counters['coalesced'] += 1
+            self.waiting.append(ticket)
+            if self.active < self.workers:
+                self.idle.clear()
+                self.active += 1
+                threading.Thread(target=self.run, name='admission', daemon=True).start()
+        return ticket
+
+    def wait(self, ticket):
+        """
+        期限まで結果を待つ。見込み時間が期限を超えるなら待たずに戻る。
+
+        Parameters
+        ----------
+        ticket: Ticket
+            依頼
+
+        Returns
+        -------
+        done: bool
+            期限までに計算が終わったかどうか（Falseなら公開済みの結果を使う）
+        """
+        timeout = ticket.deadline-time.monotonic()
+        with self.lock:
+            if self.estimate() > timeout and ticket in self.waiting:
+                timeout = 0.0  # 間に合わない依頼者はすぐに戻す
+        finished = ticket.event.wait(max(0.0, timeout))
+        with self.lock:
+            self.waits.append(time.monotonic()-ticket.submitted)
+            self.counters[ticket.status if finished else 'shed'] += 1
+        return finished and ticket.status == 'done'
+
+    def run(self):
+        """
+        待っている依頼がなくなるまで、まとめて計算する（ワーカースレッド毎に動く）。
+        """
+        name = threading.get_ident()
+        while True:
+            with self.lock:
+                if not self.waiting:
+                    self.active -= 1
+                    if self.active == 0:
+                        self.idle.set()
+                    return
+                tickets, self.waiting = self.waiting, []
+                since = time.monotonic()
+                self.running[name] = (tickets, since)
+            try:
+                result, status = self.work(), 'done'
+            except Exception:
+                logger.exception('admitted work failed.')
+                result, status = None, 'failed'
+            with self.lock:
+                elapsed = time.monotonic()-since
+                if self.solve_seconds is None:
+                    self.solve_seconds = elapsed
+                else:
+                    self.solve_seconds += SMOOTHING*(elapsed-self.solve_seconds)
+                self.counters['solves'] += 1
+                del self.running[name]
+            for ticket in tickets:
+                ticket.finish(status, result)
+
+    def join(self, timeout=None):
+        """
+        受け付けた依頼の計算が全て終わるまで待つ。
+        """
+        return self.idle.wait(timeout)
+
+    def metrics(self):
+        """
+        待ち行列の長さや待ち時間などを返す。
+
+        Returns
+        -------
+        metrics: dictionary
+            queue_depth（次の計算を待つ依頼数）、in_flight（計算中の依頼数）、
+            wait_p50, wait_p95（直近の依頼の待ち時間、秒）、solve_seconds（計算時間の移動平均）、
+            各件数（requests, coalesced, solves, done, failed, shed, rejected）
+        """
+        with self.lock:
+            waits = np.array(self.waits)
+            metrics = {
+                'queue_depth': len(self.waiting),
+                'in_flight': sum(len(tickets) for tickets, _ in self.running.values()),
+                'wait_p50': float(np.percentile(waits, 50)) if len(waits) else None,
+                'wait_p95': float(np.percentile(waits, 95)) if len(waits) else None,
+                'solve_seconds': self.solve_seconds,
+            }
+            for key in ['requests', 'coalesced', 'solves', 'done', 'failed', 'shed', 'rejected']:
+                metrics[key] = self.counters[key]
+        return metrics
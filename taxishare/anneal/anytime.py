@@ -0,0 +1,138 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from taxishare.anneal import partition
+
+
+logger = logging.getLogger(__name__)
+
+POLL_SECONDS = 0.05  # 期限後に最初の解を待つ間隔
+
+
+class Incumbent(object):
+    """
+    複数のソルバーから届く暫定解のうち、最良の実行可能解を保持する。
+
+    Attributes
+    ----------
+    best: partition.Solution
+        最良の暫定解（まだ無ければNone）
+    history: list
+        届いた暫定解の(経過時間, ソルバー名, 目的関数値)のリスト
+    engine_best: dictionary
+        ソルバー毎の最良の目的関数値
+    offer: method
+        暫定解を受け取る。
+    close: method
+        以降の暫定解を受け取らないようにする。
+    margin: method
+        勝ったソルバーと次点のソルバーの目的関数値の差を返す。
+    """
+    def __init__(self, dist_array, taxi, capacity):
+        self.user = len(dist_array)
+        self.taxi = taxi
+        self.capacity = capacity
+        self.started = time.perf_counter()
+        self.best = None
+        self.history = []
+        self.engine_best = {}
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def offer(self, solution):
+        """
+        暫定解を受け取る。実行可能でなければ捨てる。
+
+        Parameters
+        ----------
+        solution: partition.Solution
+            暫定解
+
+        Returns
+        -------
+        improved: bool
+            最良の暫定解を更新したかどうか
+        """
+        if len(solution.number) != self.user or not partition.check_feasible(solution.number, self.taxi, self.capacity):
+            return False
+        with self.lock:
+            if self.closed:
+                return False
+            elapsed = time.perf_counter()-self.started
+            self.history.append((elapsed, solution.engine, solution.objective))
+            if solution.objective < self.engine_best.get(solution.engine, float('inf')):
+                self.engine_best[solution.engine] = solution.objective
+            if self.best is None or solution.objective < self.best.objective:
+                self.best = partition.Solution(solution.number, solution.objective, solution.engine, elapsed,
+                                               solution.response, solution.params)
+                return True
+            return False
+
+    def close(self):
+        """
+        以降の暫定解を受け取らないようにする。
+        """
+        with self.lock:
+            self.closed = True
+
+    def margin(self):
+        """
+        勝ったソルバーと次点のソルバーの目的関数値の差を返す。
+        他のソルバーが解を返さなかったときはNone。
+        """
+        others = [v for k, v in self.engine_best.items() if k != self.best.engine]
+        if not others:
+            return None
+        return min(others)-self.best.objective
+
+
+def race(tasks, budget, dist_array, taxi, capacity):
+    """
+    複数のソルバーを並行して動かし、期限の時点で最良の実行可能解を返す。
+    期限までに1つも解が無ければ、最初の解が届くまで待つ。
+
+    Parameters
+    ----------
+    tasks: dictionary
+        ソルバー名と、(offer, stop)を受け取って暫定解をofferに渡す関数の辞書
+    budget: float
+        期限（秒）
+    dist_array: numpy.ndarray
+        データ間距離の上三角行列
+    taxi: int
+        タクシー数
+    capacity: int
+        タクシー1台あたりの定員
+
+    Returns
+    -------
+    incumbent: Incumbent
+        最良の暫定解と経過
+    """
+    incumbent = Incumbent(dist_array, taxi, capacity)
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=len(tasks), thread_name_prefix='anytime')
+    futures = {executor.submit(task, incumbent.offer, stop): name for name, task in tasks.items()}
+    _, pending = wait(futures, timeout=budget)
+    if incumbent.best is None and pending:
+        logger.warning('no feasible solution within %.3gs, waiting for the first one.', budget)
+        while incumbent.best is None and pending:
+            _, pending = wait(pending, timeout=POLL_SECONDS)
+    # 残りのソルバーには打ち切りを合図し（各ソルバーは区切り毎に合図を確認して抜ける）、結果は捨てる
+    incumbent.close()
+    stop.set()
+    executor.shutdown(wait=False)
+
+    for future, name in futures.items():
+        if future.done() and future.exception() is not None:
+            logger.warning('%s failed: %r', name, future.exception())
+    if incumbent.best is None:
+        raise RuntimeError('no engine returned a feasible solution.')
+    margin = incumbent.margin()
+    logger.info('%s won at %.3gs (objective %.6g, margin %s, cancelled %s)',
+                incumbent.best.engine, incumbent.best.elapsed, incumbent.best.objective,
+                'n/a' if margin is None else '{:.6g}'.format(margin),
+                ', '.join(sorted(futures[f] for f in pending)) or 'none')
+    return incumbent
@@ -0,0 +1,194 @@
+import os
+import json
+import uuid
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from taxishare.anneal import shared
+
+
+ARCHIVE_VERSION = 1  # 保存する内容を変えたら上げる
+
+
+def record(archive_dir, df, dist_array, taxi, capacity, solution, model=None, params=None):
+    """
+    1回の配車処理の入力と結果を、圧縮した.npzファイルに保存する。
+    日付毎のディレクトリに分け、書き終えてから名前を変える。
+
+    Parameters
+    ----------
+    archive_dir: str
+        保存先のディレクトリ
+    df: pandas.dataframe
+        標準化前の特徴量データフレーム
+    dist_array: numpy.ndarray
+        データ間距離の上三角行列
+    taxi: int
+        タクシー数
+    capacity: int
+        タクシー1台あたりの定員
+    solution: partition.Solution
+        配車結果
+    model: modeling.CostFunction or shared.SharedModel
+        目的関数（QUBOを作っていないならNone）
+    params: dictionary
+        ソルバーのパラメータ
+
+    Returns
+    -------
+    path: str
+        保存したファイル
+    """
+    now = datetime.datetime.now()
+    features = df.select_dtypes('number')
+    response = solution.response
+    meta = {
+        'version': ARCHIVE_VERSION,
+        'created': now.isoformat(),
+        'columns': list(features.columns),
+        'taxi': int(taxi),
+        'capacity': int(capacity),
+        'engine': solution.engine,
+        'objective': solution.objective,
+        'elapsed': solution.elapsed,
+        'params': params or {},
+        'energy': None if response is None else float(response.energy),
+        'timing': None if response is None else response.timing,
+        'fixed': {},
+        'const': 0.0,
+    }
+    arrays = {
+        'features': features.to_numpy(dtype=np.float64),
+        'dist_array': np.asarray(dist_array, dtype=np.float64),
+        'number': solution.number,
+    }
+    if model is not None:
+        arrays['row'], arrays['col'], arrays['value'] = shared.coefficients(model)
+        meta['fixed'] = {str(k): int(v) for k, v in model.fixed.items()}
+        meta['const'] = float(model.const)
+        if model.node_of is not None:
+            arrays['node_of'] = np.asarray(model.node_of)
+    if response is not None:
+        config = response.config
+        arrays['configuration'] = np.array([config.get(i, 0) for i in range(max(config, default=-1)+1)], dtype=np.int8)
+    arrays['meta'] = np.array(json.dumps(meta, default=float))
+
+    directory = os.path.join(archive_dir, now.strftime('%Y%m%d'))
+    os.makedirs(directory, exist_ok=True)
+    name = '{}-{}'.format(now.strftime('%H%M%S%f'), uuid.uuid4().hex[:8])
+    tmp = os.path.join(directory, '.'+name)
+    with open(tmp, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    path = os.path.join(directory, name+'.npz')
+    os.rename(tmp, path)
+    return path
+
+
+def iter_archive(archive_dir):
+    """
+    保存したファイルを古い順に返す。
+    """
+    for directory in sorted(os.listdir(archive_dir)):
+        directory = os.path.join(archive_dir, directory)
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.npz'):
+                yield os.path.join(directory, name)
+
+
+def prune(archive_dir, max_files):
+    """
+    保存したファイルが上限を超えたら、古い順に削除する。空になった日付のディレクトリも削除する。
+
+    Parameters
+    ----------
+    archive_dir: str
+        保存先のディレクトリ
+    max_files: int
+        残すファイル数の上限
+
+    Returns
+    -------
+    deleted: int
+        削除したファイル数
+    """
+    if not os.path.isdir(archive_dir):
+        return 0
+    paths = list(iter_archive(archive_dir))
+    deleted = 0
+    for path in paths[:max(0, len(paths)-max_files)]:
+        try:
+            os.remove(path)
+            deleted += 1
+        except FileNotFoundError:  # 他のプロセスが先に削除した
+            pass
+    for directory in os.listdir(archive_dir):
+        directory = os.path.join(archive_dir, directory)
+        if os.path.isdir(directory) and not os.listdir(directory):
+            try:
+                os.rmdir(directory)
+            except OSError:  # 書き込みが始まった
+                pass
+    return deleted
+
+
+class Record(object):
+    """
+    保存した1回の配車処理を読み込む。
+    QUBOが保存されていれば、shared.SharedModelと同じく目的関数として使える。
+
+    Attributes
+    ----------
+    path: str
+        読み込んだファイル
+    features: pandas.dataframe
+        標準化前の特徴量（数値の列のみ）
+    dist_array: numpy.ndarray
+        データ間距離の上三角行列
+    number: numpy.ndarray
+        記録した配車番号
+    configuration: numpy.ndarray
+        記録したqubitの値（QUBOで解いていないならNone）
+    taxi, capacity, engine, objective, elapsed, params, energy, timing, created:
+        記録した配車処理の情報
+    fixed: dictionary
+        値を固定したqubit番号と固定値の辞書
+    const: float
+        定数
+    row, col, value: numpy.ndarray
+        qubitの係数（QUBOを作っていないならNone）
+    node_of: numpy.ndarray
+        利用者毎のノード番号（同じ地点の利用者をまとめていなければNone）
+    has_qubo: method
+        QUBOが保存されているか返す。
+    to_dict: method
+        qubitsの係数をデジタルアニーラに投げる形式に変換する。
+    """
+    def __init__(self, path):
+        self.path = path
+        with np.load(path) as npz:
+            meta = json.loads(str(npz['meta']))
+            self.features = pd.DataFrame(npz['features'], columns=meta['columns'])
+            self.dist_array = npz['dist_array']
+            self.number = npz['number']
+            self.configuration = npz['configuration'] if 'configuration' in npz else None
+            self.row, self.col, self.value = (npz[k] if k in npz else None for k in ('row', 'col', 'value'))
+            self.node_of = npz['node_of'] if 'node_of' in npz else None
+        for k in ('taxi', 'capacity', 'engine', 'objective', 'elapsed', 'params', 'energy', 'timing', 'created', 'const'):
+            setattr(self, k, meta[k])
+        self.fixed = {int(k): v for k, v in meta['fixed'].items()}
+
+    def has_qubo(self):
+        """
+        QUBOが保存されているか返す。
+        """
+        return self.row is not None
+
+    def to_dict(self):
+        """
+        qubitsの係数をデジタルアニーラに投げる形式に変換する。
+        """
+        return shared.to_dict(self.row, self.col, self.value, self.const)
@@ -0,0 +1,85 @@
+import json
+import asyncio
+
+from taxishare.anneal import modeling
+
+try:
+    import aiohttp
+except ImportError:  # 非同期クライアントを使うときだけ必要
+    aiohttp = None
+
+
+class AsyncDAPTSolver(modeling.DAPTSolver):
+    """
+    デジタルアニーラに複数の問題を同時に投げる非同期のソルバー。
+    接続先、APIキー、マシンパラメータはDAPTSolverと同じ。
+    同期のminimizeはDAPTSolverのものをそのまま使えるので、非同期版はminimize_asyncとして分ける。
+
+    Attributes
+    ----------
+    limit: int
+        同時に接続する数の上限
+    minimize_async: method
+        デジタルアニーラで非同期に計算する。
+    gather: method
+        複数の問題を同時に投げ、結果を順番通りに返す。
+    run: method
+        イベントループの外からgatherを実行する。
+    """
+    def __init__(self, limit=10, timeout=300):
+        super().__init__()
+        if aiohttp is None:
+            raise ImportError('AsyncDAPTSolver requires aiohttp.')
+        self.limit = limit
+        self.timeout = timeout
+
+    async def minimize_async(self, qubit_dict, session=None):
+        """
+        デジタルアニーラで非同期に計算する。
+
+        Parameters
+        ----------
+        qubit_dict: dictionary
+            qubits係数の辞書
+        session: aiohttp.ClientSession
+            接続に使うセッション（省略時は作る）
+
+        Returns
+        -------
+        Response: class
+            デジタルアニーラの戻り値を処理するクラス
+        """
+        if session is None:
+            return (await self.gather([qubit_dict]))[0]
+        url, dump_request, headers = self.build_request(qubit_dict)
+        async with session.post(url, data=dump_request, headers=headers) as response:
+            text = await response.text()
+            if response.status < 400:
+                return self.parse_response(json.loads(text))
+            raise RuntimeError(text)
+
+    async def gather(self, qubit_dicts):
+        """
+        複数の問題を同時に投げ、結果を順番通りに返す。
+        同時接続数はlimitまでに抑える。
+
+        Parameters
+        ----------
+        qubit_dicts: list
+            問題毎のqubits係数の辞書
+
+        Returns
+        -------
+        responses: list
+            問題毎のResponse
+        """
+        connector = aiohttp.TCPConnector(limit=self.limit)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            return await asyncio.gather(*[self.minimize_async(qd, session) for qd in qubit_dicts])
+
+    def run(self, qubit_dicts):
+        """
+        イベントループの外（同期のビューやワーカー）からgatherを実行する。
+        """
+        return asyncio.run(self.gather(qubit_dicts))
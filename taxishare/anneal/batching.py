@@ -0,0 +1,168 @@
+import numpy as np
+
+from taxishare.anneal import modeling
+from taxishare.anneal.kernels import SparseQUBO
+
+
+MAX_QUBIT = 8192  # デジタルアニーラで一度に扱えるqubit数
+
+
+def count_qubit(qubit_dict):
+    """
+    qubits係数の辞書に現れるqubit数（最大のqubit番号+1）を求める。
+    """
+    terms = qubit_dict['binary_polynomial']['terms']
+    return 1+max([max(t['polynomials']) for t in terms if t['polynomials']], default=-1)
+
+
+def pack(sizes, max_qubit=MAX_QUBIT):
+    """
+    qubit数の合計が上限を超えないように、問題を順にまとめる。
+
+    Parameters
+    ----------
+    sizes: list
+        問題毎のqubit数
+    max_qubit: int
+        一度に投げるqubit数の上限
+
+    Returns
+    -------
+    packs: list
+        まとめた問題番号のリストのリスト
+    """
+    packs = []
+    total = 0
+    for i, size in enumerate(sizes):
+        if not packs or total+size > max_qubit:
+            packs.append([])
+            total = 0
+        packs[-1].append(i)
+        total += size
+    return packs
+
+
+def merge(qubit_dicts):
+    """
+    独立な問題を、qubit番号をずらしてブロック対角の1つの問題にする。
+
+    Parameters
+    ----------
+    qubit_dicts: list
+        問題毎のqubits係数の辞書
+
+    Returns
+    -------
+    qubit_dict: dictionary
+        まとめたqubits係数の辞書
+    offsets: list
+        問題毎の先頭のqubit番号
+    """
+    k1 = "coefficient"
+    k2 = "polynomials"
+    terms = []
+    offsets = []
+    const = 0.0
+    offset = 0
+    for qd in qubit_dicts:
+        offsets.append(offset)
+        for t in qd['binary_polynomial']['terms']:
+            if t[k2]:
+                terms.append({k1: t[k1], k2: [offset+p for p in t[k2]]})
+            else:
+                const += t[k1]
+        offset += count_qubit(qd)
+    if const != 0:
+        terms.append({k1: const, k2: []})
+    return {'binary_polynomial': {'terms': terms}}, offsets
+
+
+def split(response, qubit_dicts, offsets):
+    """
+    まとめた問題の解を、問題毎のResponseに分ける。
+
+    Parameters
+    ----------
+    response: Response
+        まとめた問題の結果
+    qubit_dicts: list
+        問題毎のqubits係数の辞書
+    offsets: list
+        問題毎の先頭のqubit番号
+
+    Returns
+    -------
+    responses: list
+        問題毎のResponse
+    """
+    responses = []
+    for qd, offset in zip(qubit_dicts, offsets):
+        n = count_qubit(qd)
+        x = np.array([response.config.get(offset+i, 0) for i in range(n)])
+        j = {
+            'solutions': [{
+                'configuration': {str(i): int(v) for i, v in enumerate(x)},
+                'energy': SparseQUBO.from_dict(qd).energy(x),  # 問題毎のエネルギーを計算し直す
+            }],
+            'timing': dict(response.timing, batch_size=len(qubit_dicts)),
+        }
+        responses.append(modeling.Response(j))
+    return responses
+
+
+class BatchSolver(object):
+    """
+    複数の独立な問題をブロック対角にまとめて1回でソルバーに投げる。
+
+    Attributes
+    ----------
+    solver: DAPTSolver
+        minimize(qubit_dict)でResponseを返すソルバー
+    max_qubit: int
+        一度に投げるqubit数の上限
+    minimize: method
+        1つの問題を計算する。
+    minimize_all: method
+        複数の問題をまとめて計算する。
+    """
+    def __init__(self, solver, max_qubit=MAX_QUBIT):
+        self.solver = solver
+        self.max_qubit = max_qubit
+
+    def minimize(self, qubit_dict):
+        """
+        1つの問題を計算する。
+        """
+        return self.minimize_all([qubit_dict])[0]
+
+    def minimize_all(self, qubit_dicts):
+        """
+        複数の問題をまとめて計算する。
+
+        Parameters
+        ----------
+        qubit_dicts: list
+            問題毎のqubits係数の辞書
+
+        Returns
+        -------
+        responses: list
+            問題毎のResponse（qubit_dictsと同じ順）
+        """
+        packs = pack([count_qubit(qd) for qd in qubit_dicts], self.max_qubit)
+        merged = []
+        for index in packs:
+            batch = [qubit_dicts[i] for i in index]
+            merged.append(merge(batch) if len(batch) > 1 else (batch[0], None))
+        if hasattr(self.solver, 'run'):
+            # 非同期に投げられるソルバーなら、まとめた問題を同時に投げる
+            results = self.solver.run([qd for qd, _ in merged])
+        else:
+            results = [self.solver.minimize(qd) for qd, _ in merged]
+
+        responses = [None]*len(qubit_dicts)
+        for index, (_, offsets), result in zip(packs, merged, results):
+            batch = [qubit_dicts[i] for i in index]
+            for i, response in zip(index, [result] if offsets is None else split(result, batch, offsets)):
+                responses[i] = response
+        return responses
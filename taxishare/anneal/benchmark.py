@@ -0,0 +1,175 @@
+import math
+import time
+from itertools import product
+
+import numpy as np
+
+from taxishare.anneal import main, modeling, sizing, tabu
+
+
+CONFIDENCE = 0.99  # 目標に届くまでの時間（time-to-target）を求める成功確率
+GAP = 1e-6  # 厳密解の目的関数値からこの相対差以内なら目標に届いたとみなす
+
+
+def synthetic(user, seed, index=0):
+    """
+    平面上のランダムな地点から、再現できる問題（データ間距離、タクシー数）を作る。
+
+    Parameters
+    ----------
+    user: int
+        利用者数
+    seed: int
+        乱数シード
+    index: int
+        同じ利用者数の問題の番号
+
+    Returns
+    -------
+    dist_array: numpy.ndarray
+        データ間距離の上三角行列
+    taxi: int
+        タクシー数
+    """
+    rng = np.random.default_rng([seed, user, index])
+    point = rng.random((user, 2))
+    dist_array = np.triu(np.sqrt(((point[:, None]-point[None])**2).sum(axis=-1)))
+    return dist_array, sizing.calc_taxi_number(user)
+
+
+def configurations(engines, encodings, penalties):
+    """
+    ソルバー、スラック変数の符号化、制約項の係数の全ての組み合わせを返す。
+    """
+    return [{'engine': e, 'encoding': c, 'penalty1': p1, 'penalty2': p2}
+            for e, c, (p1, p2) in product(engines, encodings, penalties)]
+
+
+def base_params(engine):
+    """
+    ソルバーの既定のパラメータを返す。
+    daptはスタブサーバーがタブー探索で解くので、タブー探索の既定値にする。
+    """
+    if engine == 'dapt':
+        return dict(tabu.TabuSolver().params)
+    return dict(main.QUBO_SOLVERS[engine]().params)
+
+
+def warm_up(engines):
+    """
+    JITコンパイルなどの初回の時間を計算時間に含めないよう、各プロセスでローカルのソルバー毎に小さな問題を1回解く。
+    daptは遠隔のサーバーに依頼が飛ぶので解かない。
+    """
+    for engine in engines:
+        if engine in main.QUBO_SOLVERS and engine != 'dapt':
+            main.QUBO_SOLVERS[engine]().minimize(main.build_model(*synthetic(2, 0)).to_dict())
+
+
+def run_one(task):
+    """
+    1つの設定・問題・シードについて、計算量（反転・スイープ回数）を増やしながら解き、
+    エネルギーと計算時間の推移を記録する。
+    プロセスプールから呼べるように、引数と戻り値は単純な値にする。
+
+    Parameters
+    ----------
+    task: dictionary
+        engine, encoding, penalty1, penalty2（設定）、user, index, seed（問題）、
+        run_seed（ソルバーの乱数シード）、efforts（既定の回数に掛ける倍率）、
+        reference（厳密解の目的関数値）、url（daptならスタブサーバーのURL）
+
+    Returns
+    -------
+    trace: list
+        計算量毎の記録（iterations, elapsed, energy, objective, feasible, hit）
+    """
+    dist_array, taxi = synthetic(task['user'], task['seed'], task['index'])
+    model = modeling.CostFunction(len(dist_array), taxi, sizing.CAPACITY, encoding=task['encoding'], symmetry=True)
+    model.initialize(dist_array, task['penalty1'], task['penalty2'])
+    qubit_dict = model.to_dict()
+    params = base_params(task['engine'])
+
+    trace = []
+    for effort in task['efforts']:
+        solver = main.QUBO_SOLVERS[task['engine']]()
+        solver.params.update(params)
+        solver.params['number_iterations'] = max(1, int(params['number_iterations']*effort))
+        solver.params['seed'] = task['run_seed']
+        if task['engine'] == 'dapt':
+            solver.url = task['url']
+        started = time.perf_counter()
+        response = solver.minimize(qubit_dict)
+        elapsed = time.perf_counter()-started
+        try:
+            objective = main.decode(response, dist_array, taxi, model, task['engine'], started).objective
+            feasible = True
+        except ValueError:  # 制約を満たさない解
+            objective, feasible = np.nan, False
+        trace.append({
+            'iterations': solver.params['number_iterations'],
+            'qubits': model.number_qubit,
+            'elapsed': elapsed,
+            'energy': float(response.energy),
+            'objective': float(objective),
+            'feasible': feasible,
+            'hit': feasible and objective <= task['reference']*(1+GAP)+1e-12,
+        })
+    return trace
+
+
+def time_to_target(elapsed, success, confidence=CONFIDENCE):
+    """
+    1回の計算時間と目標に届く確率から、confidenceの確率で目標に届くまでの繰り返しを含めた時間を求める。
+    一度も届かなければinfを返す。
+    """
+    if success <= 0:
+        return math.inf
+    if success >= 1:
+        return elapsed
+    return elapsed*math.log(1-confidence)/math.log(1-success)
+
+
+def summarize(tasks, traces, confidence=CONFIDENCE):
+    """
+    設定・利用者数毎に、実行可能な解の割合、目標に届いた割合、最も短いtime-to-targetを集計する。
+
+    Parameters
+    ----------
+    tasks: list
+        run_oneに渡した設定・問題
+    traces: list
+        run_oneの戻り値
+    confidence: float
+        time-to-targetの成功確率
+
+    Returns
+    -------
+    summary: list
+        設定・利用者数毎の集計（engine, encoding, penalty1, penalty2, user, runs, qubits, feasible, success,
+        iterations, median_ms, tts_ms）
+    """
+    groups = {}
+    for task, trace in zip(tasks, traces):
+        key = (task['engine'], task['encoding'], task['penalty1'], task['penalty2'], task['user'])
+        groups.setdefault(key, []).append(trace)
+
+    summary = []
+    for (engine, encoding, penalty1, penalty2, user), group in groups.items():
+        records = [r for trace in group for r in trace]
+        row = {
+            'engine': engine, 'encoding': encoding, 'penalty1': penalty1, 'penalty2': penalty2, 'user': user,
+            'runs': len(group),
+            'qubits': float(np.mean([r['qubits'] for r in records])),
+            'feasible': float(np.mean([r['feasible'] for r in records])),
+            'success': 0.0, 'iterations': None, 'median_ms': None, 'tts_ms': math.inf,
+        }
+        # 計算量毎にtime-to-targetを求め、最も短い計算量を選ぶ
+        for level in range(len(group[0])):
+            at_level = [trace[level] for trace in group]
+            elapsed = float(np.median([r['elapsed'] for r in at_level]))
+            success = float(np.mean([r['hit'] for r in at_level]))
+            tts = 1000*time_to_target(elapsed, success, confidence)
+            if row['iterations'] is None or tts < row['tts_ms']:
+                row.update(success=success, iterations=at_level[0]['iterations'], median_ms=1000*elapsed, tts_ms=tts)
+        summary.append(row)
+    return summary
@@ -0,0 +1,73 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from taxishare.anneal.routing import haversine
+
+
+UNASSIGNED = -1  # 車両を割り当てられなかったグループ
+
+
+def pickup_cost(group_lat, group_lon, vehicle_lat, vehicle_lon):
+    """
+    グループの乗車地点と車両の現在地の間の大円距離（km）の行列を求める。
+
+    Parameters
+    ----------
+    group_lat, group_lon: array_like
+        グループ毎の乗車地点の緯度・経度
+    vehicle_lat, vehicle_lon: array_like
+        車両毎の現在地の緯度・経度
+
+    Returns
+    -------
+    cost: numpy.ndarray
+        グループ数×車両数の行列
+    """
+    group_lat, group_lon = np.asarray(group_lat, dtype=np.float64), np.asarray(group_lon, dtype=np.float64)
+    vehicle_lat, vehicle_lon = np.asarray(vehicle_lat, dtype=np.float64), np.asarray(vehicle_lon, dtype=np.float64)
+    return haversine(group_lat[:, None], group_lon[:, None], vehicle_lat[None, :], vehicle_lon[None, :])
+
+
+def assign(group_lat, group_lon, group_size, vehicle_lat, vehicle_lon, vehicle_capacity, max_km=None):
+    """
+    迎車距離の総和が最小になるように、グループに車両を1台ずつ割り当てる（ハンガリー法）。
+    定員の足りない車両と、max_kmより遠い車両は割り当てない。
+    車両が足りなければ、割り当てられなかったグループはUNASSIGNEDにする。
+
+    Parameters
+    ----------
+    group_lat, group_lon: array_like
+        グループ毎の乗車地点の緯度・経度
+    group_size: array_like
+        グループ毎の人数
+    vehicle_lat, vehicle_lon: array_like
+        車両毎の現在地の緯度・経度
+    vehicle_capacity: array_like
+        車両毎の定員
+    max_km: float
+        迎車距離の上限（省略時は上限なし）
+
+    Returns
+    -------
+    vehicle: numpy.ndarray
+        グループ毎の車両の番号（vehicle_latの添字）
+    distance: numpy.ndarray
+        グループ毎の迎車距離（km、割り当てられなければnan）
+    """
+    n_group = len(group_lat)
+    vehicle = np.full(n_group, UNASSIGNED, dtype=int)
+    distance = np.full(n_group, np.nan)
+    if n_group == 0 or len(vehicle_lat) == 0:
+        return vehicle, distance
+
+    cost = pickup_cost(group_lat, group_lon, vehicle_lat, vehicle_lon)
+    allowed = np.asarray(vehicle_capacity)[None, :] >= np.asarray(group_size)[:, None]
+    if max_km is not None:
+        allowed &= cost <= max_km
+    # 割り当てられない組は、どの割り当て可能な組よりも大きいコストにして解いた後に外す
+    penalty = (cost[allowed].max() if allowed.any() else 0.0)*n_group+1.0
+    rows, cols = linear_sum_assignment(np.where(allowed, cost, penalty))
+    ok = allowed[rows, cols]
+    vehicle[rows[ok]] = cols[ok]
+    distance[rows[ok]] = cost[rows[ok], cols[ok]]
+    return vehicle, distance
@@ -0,0 +1,315 @@
+import time
+
+import numpy as np
+from scipy import sparse
+
+from taxishare.anneal import modeling
+
+try:
+    import numba
+except ImportError:  # Numbaが無ければNumPy実装を使う
+    numba = None
+
+
+BACKEND = 'numba' if numba is not None else 'numpy'
+STOP_SWEEPS = 100  # 打ち切りの合図を確認するスイープ数の間隔
+
+
+def jit(func):
+    """
+    Numbaがあればnopythonモードでコンパイルし、無ければそのまま返す。
+    """
+    if numba is None:
+        return func
+    return numba.njit(cache=True)(func)
+
+
+class SparseQUBO(object):
+    """
+    QUBOをCSR形式で保持する。
+    E(x) = const + Σ_i linear_i*x_i + Σ_{i<j} Q_ij*x_i*x_j
+
+    Attributes
+    ----------
+    n: int
+        qubit数
+    indptr, indices, data: numpy.ndarray
+        2次項の対称なCSR表現（対角は含まない）
+    linear: numpy.ndarray
+        1次項の係数
+    const: float
+        定数項
+    """
+    def __init__(self, n, row, col, value, linear, const):
+        self.n = n
+        upper = sparse.coo_matrix((value, (row, col)), shape=(n, n)).tocsr()
+        upper.sum_duplicates()
+        matrix = (upper+upper.T).tocsr()
+        matrix.eliminate_zeros()
+        matrix.sort_indices()
+        self.indptr = matrix.indptr.astype(np.int64)
+        self.indices = matrix.indices.astype(np.int64)
+        self.data = matrix.data.astype(np.float64)
+        self.linear = np.asarray(linear, dtype=np.float64)
+        self.const = float(const)
+
+    @classmethod
+    def from_dict(cls, qubit_dict):
+        """
+        デジタルアニーラに投げる形式の辞書から作る。
+
+        Parameters
+        ----------
+        qubit_dict: dictionary
+            qubits係数の辞書
+        """
+        terms = qubit_dict['binary_polynomial']['terms']
+        n = 1+max([max(t['polynomials']) for t in terms if t['polynomials']], default=-1)
+        linear = np.zeros(n)
+        const = 0.0
+        row, col, value = [], [], []
+        for t in terms:
+            poly = t['polynomials']
+            if len(poly) == 0:
+                const += t['coefficient']
+            elif len(poly) == 1 or poly[0] == poly[1]:
+                linear[poly[0]] += t['coefficient']
+            else:
+                row.append(min(poly))
+                col.append(max(poly))
+                value.append(t['coefficient'])
+        return cls(n, row, col, value, linear, const)
+
+    @classmethod
+    def from_array(cls, coefficient_array, const=0):
+        """
+        上三角の係数配列から作る。
+
+        Parameters
+        ----------
+        coefficient_array: numpy.ndarray
+            qubit毎の係数を格納する配列
+        const: float
+            定数
+        """
+        upper = np.triu(coefficient_array, 1)
+        row, col = upper.nonzero()
+        return cls(len(coefficient_array), row, col, upper[row, col], np.diag(coefficient_array), const)
+
+    @property
+    def degree(self):
+        """
+        qubit毎の結合数
+        """
+        return np.diff(self.indptr)
+
+    def local_field(self, x):
+        """
+        qubit毎の局所場 h_i + Σ_j Q_ij*x_j を求める。
+        """
+        matrix = sparse.csr_matrix((self.data, self.indices, self.indptr), shape=(self.n, self.n))
+        return self.linear+matrix@np.asarray(x, dtype=np.float64)
+
+    def energy(self, x):
+        """
+        エネルギーを求める。
+        """
+        x = np.asarray(x, dtype=np.float64)
+        field = self.local_field(x)
+        return self.const+float(x@(self.linear+field))/2
+
+    def beta_range(self):
+        """
+        1ビット反転のエネルギー変化の大きさから、逆温度の範囲を決める。
+        """
+        row = np.repeat(np.arange(self.n), self.degree)
+        weight = np.abs(self.linear)+np.bincount(row, weights=np.abs(self.data), minlength=self.n)
+        max_delta = max(float(weight.max()), 1e-9) if self.n else 1.0
+        coefficients = np.abs(np.concatenate([self.linear, self.data]))
+        coefficients = coefficients[coefficients > 0]
+        min_delta = float(coefficients.min()) if len(coefficients) else 1.0
+        return np.log(2)/max_delta, np.log(100)/min_delta
+
+
+def flip_gain(x, field):
+    """
+    qubit毎の1ビット反転によるエネルギー変化を求める。
+    """
+    return (1-2*x)*field
+
+
+@jit
+def _flip_numba(i, x, field, indptr, indices, data):
+    d = 1-2*x[i]
+    x[i] += d
+    for p in range(indptr[i], indptr[i+1]):
+        field[indices[p]] += data[p]*d
+
+
+def _flip_numpy(i, x, field, indptr, indices, data):
+    d = 1-2*x[i]
+    x[i] += d
+    start, stop = indptr[i], indptr[i+1]
+    field[indices[start:stop]] += data[start:stop]*d
+
+
+@jit
+def _anneal_numba(x, field, indptr, indices, data, betas, seed):
+    np.random.seed(seed)
+    n = len(x)
+    energy = 0.0
+    best = 0.0
+    best_x = x.copy()
+    for beta in betas:
+        for i in range(n):
+            delta = (1-2*x[i])*field[i]
+            if delta <= 0 or np.random.random() < np.exp(-beta*delta):
+                _flip_numba(i, x, field, indptr, indices, data)
+                energy += delta
+                if energy < best-1e-12:
+                    best = energy
+                    best_x[:] = x
+    return best_x, best
+
+
+def _anneal_numpy(x, field, indptr, indices, data, betas, seed):
+    rng = np.random.default_rng(seed)
+    n = len(x)
+    energy = 0.0
+    best = 0.0
+    best_x = x.copy()
+    for beta in betas:
+        threshold = -np.log(rng.random(n))/beta  # 受理されるエネルギー変化の上限
+        for i in range(n):
+            delta = (1-2*x[i])*field[i]
+            if delta <= threshold[i]:
+                _flip_numpy(i, x, field, indptr, indices, data)
+                energy += delta
+                if energy < best-1e-12:
+                    best = energy
+                    best_x[:] = x
+    return best_x, best
+
+
+KERNELS = {
+    'numpy': (_flip_numpy, _anneal_numpy),
+}
+if numba is not None:
+    KERNELS['numba'] = (_flip_numba, _anneal_numba)
+
+
+def anneal(qubo, x, betas, seed=0, backend=None, stop=None):
+    """
+    逆温度のスケジュールに沿ってメトロポリス法で1ビット反転を繰り返す。
+    stopを渡すと、スケジュールをSTOP_SWEEPS毎に区切って計算し、区切り毎に打ち切りの合図を確認する。
+
+    Parameters
+    ----------
+    qubo: SparseQUBO
+        CSR形式のQUBO
+    x: numpy.ndarray
+        初期状態
+    betas: numpy.ndarray
+        スイープ毎の逆温度
+    seed: int
+        乱数シード
+    backend: str
+        'numba' or 'numpy'（省略時は使える方）
+    stop: threading.Event
+        セットされたら残りのスケジュールを打ち切る
+
+    Returns
+    -------
+    best_x: numpy.ndarray
+        最良の状態
+    best_energy: float
+        最良のエネルギー
+    """
+    _, kernel = KERNELS[backend or BACKEND]
+    x = np.asarray(x, dtype=np.int64).copy()
+    field = qubo.local_field(x)
+    start = qubo.energy(x)
+    betas = np.asarray(betas, dtype=np.float64)
+    if stop is None:
+        best_x, best = kernel(x, field, qubo.indptr, qubo.indices, qubo.data, betas, seed)
+        return best_x, start+best
+    # 状態と局所場はカーネルの中で更新されるので、区切りをまたいでそのまま引き継ぐ
+    best_x, best = x.copy(), start
+    for k, offset in enumerate(range(0, len(betas), STOP_SWEEPS)):
+        if stop.is_set():
+            break
+        energy = qubo.energy(x)
+        chunk_x, chunk_best = kernel(x, field, qubo.indptr, qubo.indices, qubo.data,
+                                     betas[offset:offset+STOP_SWEEPS], seed+k)
+        if energy+chunk_best < best:
+            best_x, best = chunk_x, energy+chunk_best
+    return best_x, best
+
+
+def to_response(x, energy, elapsed):
+    """
+    状態とエネルギーをデジタルアニーラの戻り値と同じ形式にする。
+    """
+    j = {
+        'solutions': [{
+            'configuration': {str(i): int(v) for i, v in enumerate(x)},
+            'energy': float(energy),
+        }],
+        'timing': {'solve_time': int(elapsed*1000)},
+    }
+    return modeling.Response(j)
+
+
+class SASolver(object):
+    """
+    ローカルで焼きなまし法を行うソルバー情報を保持する。
+
+    Attributes
+    ----------
+    backend: str
+        カーネルの実装（'numba' or 'numpy'）
+    params: dictionary
+        パラメータ
+    stop: threading.Event
+        打ち切りの合図（Noneなら最後まで計算する）
+    minimize: method
+        焼きなまし法で計算する。
+    """
+    def __init__(self, backend=None):
+        self.backend = backend or BACKEND
+        self.stop = None
+        self.params = {}
+        # 既定値は、利用者6人（対数符号化）でほぼ必ず厳密解に、8人でもタブー探索の既定値以上の割合で届く計算量にする
+        # （bench_ttsで確認。1000スイープ・4試行では6人でも1割近く厳密解に届かなかった）
+        self.params['number_iterations'] = 4000  # スイープ数
+        self.params['number_replicas'] = 8  # 独立な試行回数
+        self.params['seed'] = 0
+
+    def minimize(self, qubit_dict):
+        """
+        焼きなまし法で計算する。
+
+        Parameters
+        ----------
+        qubit_dict: dictionary
+            qubits係数の辞書
+
+        Returns
+        -------
+        Response: class
+            デジタルアニーラの戻り値と同じ形式の結果
+        """
+        started = time.perf_counter()
+        qubo = SparseQUBO.from_dict(qubit_dict)
+        beta_min, beta_max = qubo.beta_range()
+        betas = np.geomspace(beta_min, beta_max, self.params['number_iterations'])
+        rng = np.random.default_rng(self.params['seed'])
+        best_x, best = None, np.inf
+        for replica in range(self.params['number_replicas']):
+            if replica and self.stop is not None and self.stop.is_set():
+                break
+            x0 = rng.integers(0, 2, qubo.n)
+            x, energy = anneal(qubo, x0, betas, self.params['seed']+replica, self.backend, self.stop)
+            if energy < best:
+                best_x, best = x, energy
+        return to_response(best_x, best, time.perf_counter()-started)
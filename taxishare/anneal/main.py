@@ -1,52 +1,485 @@
+import time
+import logging
+from functools import partial
+
 import numpy as np
 import pandas as pd
 
-from taxishare.anneal import preparations, modeling
+from taxishare.anneal import preparations, modeling, sizing, partition, kernels, tabu, shared, batching, async_solver, anytime, archive, reduction
+
+
+logger = logging.getLogger(__name__)
+
+UPPER_USER = 10  # 一度に配車処理できる利用者数
+PENALTY1 = 10  # 制約項1（1人1台）の係数
+PENALTY2 = 10  # 制約項2（定員）の係数
+F_WEIGHT = [1, 0, 0]  # データ間距離の特徴量（目的地、年齢、性別）の重み
 
+# QUBOを解くソルバー（minimize(qubit_dict)でResponseを返す）
+QUBO_SOLVERS = {
+    'dapt': modeling.DAPTSolver,
+    'sa': kernels.SASolver,
+    'tabu': tabu.TabuSolver,
+}
 
-def main(df):
+# 複数の問題を同時に投げられるソルバー（aiohttpがあれば使う）
+ASYNC_SOLVERS = {}
+if async_solver.aiohttp is not None:
+    ASYNC_SOLVERS['dapt'] = async_solver.AsyncDAPTSolver
+
+
+def calc_dist(df, f_w=F_WEIGHT, stats=None):
     """
-    与えられた利用者集団に対し、配車番号を求める。
+    特徴量を標準化し、データ間距離を求める。
+    特徴量毎の距離行列は利用者集団毎に保持し、重みが0の特徴量は求めない。
 
     Parameters
     ----------
     df: pandas.dataframe
         標準化前の特徴量データフレーム
+    f_w: list
+        各特徴量の重み
+    stats: preparations.RunningStats
+        利用者全体の特徴量の統計量（省略時は利用者集団の中で標準化する）
 
     Returns
     -------
-    number_list:numpy.ndarray
-        配車番号リスト
+    dist_array: numpy.ndarray
+        データ間距離の上三角行列
+    """
+    return preparations.features(df, stats).combine(f_w)
+
+
+def build_model(dist_array, taxi, penalty1=PENALTY1, penalty2=PENALTY2, node_of=None):
+    """
+    配車を行う目的関数を作る。
+    node_ofを渡すと、同じノードの利用者を1つの変数にまとめた小さなQUBOを作る。
+
+    Parameters
+    ----------
+    dist_array: numpy.ndarray
+        データ間距離の上三角行列
+    taxi: int
+        タクシー数
+    penalty1: float
+        制約項1の係数
+    penalty2: float
+        制約項2の係数
+    node_of: numpy.ndarray
+        利用者毎のノード番号（省略時はまとめない）
+
+    Returns
+    -------
+    model: modeling.CostFunction
+        初期化済みの目的関数
+    """
+    const = 0.0
+    if node_of is not None:
+        const = reduction.intra(dist_array, node_of)  # エネルギーが利用者毎の目的関数値と一致するように加える
+        dist_array = reduction.aggregate(dist_array, node_of)
+    model = modeling.CostFunction(len(dist_array), taxi, sizing.CAPACITY, encoding='log', symmetry=True, node_of=node_of)
+    model.initialize(dist_array, penalty1, penalty2)
+    model.const += const
+    return model
+
+
+def decode(response, dist_array, taxi, model, engine, started):
+    """
+    ソルバーの結果から配車番号を取り出す。同じ地点の利用者をまとめたQUBOなら、利用者毎に戻す。
+
+    Parameters
+    ----------
+    response: modeling.Response
+        ソルバーの結果
+    dist_array: numpy.ndarray
+        データ間距離の上三角行列
+    taxi: int
+        タクシー数
+    model: modeling.CostFunction or shared.SharedModel
+        目的関数
+    engine: str
+        ソルバー名
+    started: float
+        計算を始めた時刻（time.perf_counter）
+
+    Returns
+    -------
+    solution: partition.Solution
+        配車結果
+    """
+    node_of = model.node_of
+    if node_of is None:
+        user, weight = len(dist_array), None
+    else:
+        weight = np.bincount(node_of)
+        user = len(weight)
+    qubit_array = response.to_array(user, taxi, model.fixed)
+    f_user, f_taxi = response.check_penalty(model.capacity, weight)
+    if f_user == 0 and f_taxi == 0:
+        number_list = response.group()
+    else:
+        raise ValueError('given penalties do not satisfy the function.')
+    if node_of is not None:
+        number_list = reduction.expand(number_list, node_of)
+    objective = partition.calc_objective(dist_array, number_list)
+    return partition.Solution(number_list, objective, engine, time.perf_counter()-started, response)
+
+
+def record_solve(tuner, engine, qubit_dict, params, response, feasible, elapsed):
+    """
+    ソルバーの計算を記録する。記録に失敗しても配車は続ける。
+    """
+    try:
+        tuner.record(engine, qubit_dict, params, response.energy, feasible, elapsed)
+    except OSError:
+        logger.exception('failed to record solve.')
+
+
+def minimize(dist_array, taxi, engine, model, started, tuner=None, timeout=None, stop=None):
+    """
+    QUBOをソルバーで解き、配車番号を取り出す。
+    tunerがあれば問題の大きさに合ったパラメータで解き、計算を記録する。
+    stopがセットされて打ち切った計算は、結果も記録も捨ててNoneを返す。
+
+    Parameters
+    ----------
+    dist_array: numpy.ndarray
+        データ間距離の上三角行列
+    taxi: int
+        タクシー数
+    engine: str
+        QUBO_SOLVERSのソルバー名
+    model: modeling.CostFunction or shared.SharedModel
+        目的関数
+    started: float
+        計算を始めた時刻（time.perf_counter）
+    tuner: tuning.Tuner
+        パラメータの選択と計算の記録（省略時は既定のパラメータで解き、記録しない）
+    timeout: float
+        応答を待つ時間（秒）。設定できるソルバーのみ
+    stop: threading.Event
+        打ち切りの合図。設定できるソルバーのみ
+
+    Returns
+    -------
+    solution: partition.Solution
+        配車結果（打ち切ったときはNone）
+    """
+    qubit_dict = model.to_dict()
+    solver = QUBO_SOLVERS[engine]()
+    if tuner is not None:
+        solver.params.update(tuner.params_for(engine, batching.count_qubit(qubit_dict)))
+    if timeout is not None and hasattr(solver, 'timeout'):
+        solver.timeout = timeout
+    if stop is not None and hasattr(solver, 'stop'):
+        solver.stop = stop
+    solving = time.perf_counter()
+    response = solver.minimize(qubit_dict)
+    elapsed = time.perf_counter()-solving
+    if stop is not None and stop.is_set():
+        return None  # 途中で打ち切った計算は、パラメータの選択を歪めないよう記録しない
+    try:
+        solution = decode(response, dist_array, taxi, model, engine, started)
+        solution.params = dict(solver.params)
+    except ValueError:
+        if tuner is not None:
+            record_solve(tuner, engine, qubit_dict, solver.params, response, False, elapsed)
+        raise
+    if tuner is not None:
+        record_solve(tuner, engine, qubit_dict, solver.params, response, True, elapsed)
+    return solution
+
+
+def anneal(dist_array, taxi, engine='dapt', model=None, tuner=None):
+    """
+    QUBOを作り、デジタルアニーラ（またはローカルのソルバー）で配車番号を求める。
+
+    Parameters
+    ----------
+    dist_array: numpy.ndarray
+        データ間距離の上三角行列
+    taxi: int
+        タクシー数
+    engine: str
+        QUBO_SOLVERSのソルバー名
+    model: modeling.CostFunction or shared.SharedModel
+        作成済みの目的関数（省略時は作る）
+    tuner: tuning.Tuner
+        パラメータの選択と計算の記録（省略時は既定のパラメータで解く）
+
+    Returns
+    -------
+    solution: partition.Solution
+        配車結果
+    """
+    started = time.perf_counter()
+    user = len(dist_array)
+    if model is None:
+        model = build_model(dist_array, taxi)
+    sizing.report(user, model)
+    return minimize(dist_array, taxi, engine, model, started, tuner)
+
+
+def run_engine(dist_array, taxi, engine, model, budget, tuner, offer, stop):
+    """
+    1つのソルバーで解き、暫定解をofferに渡す。
+    局所探索は改善する毎に渡す。どのソルバーもstopがセットされたら打ち切る。
+
+    Parameters
+    ----------
+    dist_array: numpy.ndarray
+        データ間距離の上三角行列
+    taxi: int
+        タクシー数
+    engine: str
+        ソルバー名
+    model: modeling.CostFunction or shared.SharedModel
+        目的関数（QUBOで解かないならNone）
+    budget: float
+        期限（秒）
+    tuner: tuning.Tuner
+        パラメータの選択と計算の記録（Noneなら既定のパラメータで解く）
+    offer: function
+        暫定解を受け取る関数
+    stop: threading.Event
+        打ち切りの合図
+    """
+    started = time.perf_counter()
+    if engine in QUBO_SOLVERS:
+        solution = minimize(dist_array, taxi, engine, model, started, tuner, timeout=budget, stop=stop)  # 期限を過ぎた応答は待たない
+        if solution is not None:
+            offer(solution)
+    elif engine == 'local':
+        partition.solve_local(dist_array, taxi, sizing.CAPACITY, callback=offer, stop=stop)
+    else:
+        offer(partition.SOLVERS[engine](dist_array, taxi, sizing.CAPACITY, stop=stop))
+
+
+def hedge(dist_array, taxi, engine, model, budget, tuner=None):
+    """
+    選んだソルバーと局所探索を並行して動かし、期限の時点で最良の配車結果を返す。
+
+    Parameters
+    ----------
+    dist_array: numpy.ndarray
+        データ間距離の上三角行列
+    taxi: int
+        タクシー数
+    engine: str
+        ソルバー名
+    model: modeling.CostFunction or shared.SharedModel
+        目的関数（QUBOで解かないならNone）
+    budget: float
+        期限（秒）
+    tuner: tuning.Tuner
+        パラメータの選択と計算の記録（省略時は既定のパラメータで解く）
+
+    Returns
+    -------
+    solution: partition.Solution
+        配車結果（engineは勝ったソルバー名）
+    """
+    if engine in QUBO_SOLVERS and model is None:
+        model = build_model(dist_array, taxi)
+    tasks = {e: partial(run_engine, dist_array, taxi, e, model, budget, tuner) for e in dict.fromkeys([engine, 'local'])}
+    return anytime.race(tasks, budget, dist_array, taxi, sizing.CAPACITY).best
+
+
+def solver_params(engine):
+    """
+    ソルバーのパラメータを返す（QUBOで解かないなら空の辞書）。
+    """
+    if engine in QUBO_SOLVERS:
+        return dict(QUBO_SOLVERS[engine]().params)
+    return {}
+
+
+def save_record(archive_dir, df, dist_array, taxi, solution, model):
     """
+    配車処理の入力と結果を保存する。保存に失敗しても配車は続ける。
+    """
+    try:
+        params = solver_params(solution.engine) if solution.params is None else solution.params
+        archive.record(archive_dir, df, dist_array, taxi, sizing.CAPACITY, solution, model, params)
+    except OSError:
+        logger.exception('failed to archive dispatch.')
+
+
+def prepare(df, engine='auto', cache_dir=None, stats=None, snap=None):
+    """
+    利用者集団のタクシー数、ソルバー、データ間距離、（QUBOで解くなら）目的関数を求める。
+    snapを指定してQUBOで解くなら、目的地が同じ格子にある利用者を1つのノードにまとめてQUBOを小さくする。
 
-    UPPER_USER = 10
+    Parameters
+    ----------
+    df: pandas.dataframe
+        標準化前の特徴量データフレーム
+    engine: str
+        ソルバー名（'auto'なら利用者数から選ぶ）
+    cache_dir: str
+        作成したQUBOをプロセス間で共有するディレクトリ（省略時は共有しない）
+    stats: preparations.RunningStats
+        利用者全体の特徴量の統計量（省略時は利用者集団の中で標準化する）
+    snap: float
+        目的地を寄せる格子の一辺（m、省略時はまとめない）
 
+    Returns
+    -------
+    engine: str
+        ソルバー名
+    taxi: int
+        タクシー数
+    dist_array: numpy.ndarray
+        データ間距離の上三角行列
+    model: modeling.CostFunction or shared.SharedModel
+        目的関数（QUBOで解かないならNone）
+    """
     user = len(df)
     if user > UPPER_USER:
         raise ValueError('number of user is less than 50.')
     else:
-        taxi = 15
-        norm_df = preparations.normalize(df)
-        dist_array = preparations.calc_dist_array(norm_df, [1, 0, 0])
-        number_list = []
-
-        if dist_array.any():
-            model = modeling.CostFunction(user, taxi)
-            model.initialize(dist_array, 10, 10)
-            qubit_dict = model.to_dict()
-            solver = modeling.DAPTSolver()
-            response = solver.minimize(qubit_dict)
-            qubit_array = response.to_array(user, taxi)
-            f_user, f_taxi = response.check_penalty()
-            if f_user == 0 and f_taxi == 0:
-                number_list = response.group()
+        taxi = sizing.calc_taxi_number(user)
+        if engine == 'auto':
+            engine = partition.select_engine(user)
+
+        node_of = None
+        if engine in QUBO_SOLVERS and snap is not None and user:
+            node_of = reduction.merge(df['desitination_latitude'].values, df['desitination_longitude'].values,
+                                      snap, sizing.CAPACITY)
+            if node_of.max()+1 < user:
+                # まとめたノードを詰められるだけのタクシーを用意する
+                taxi = max(taxi, reduction.taxi_number(np.bincount(node_of)))
             else:
-                raise ValueError('given penalties do not satisfy the function.')
+                node_of = None  # 同じ格子の利用者がいなければまとめない
+
+        def build():
+            dist_array = calc_dist(df, stats=stats)
+            return dist_array, build_model(dist_array, taxi, node_of=node_of)
+
+        model = None
+        if engine in QUBO_SOLVERS and cache_dir is not None:
+            # 同じ利用者集団のQUBOは、他のプロセスが作ったものを読み込む
+            key = shared.snapshot_key(df, taxi, sizing.CAPACITY, None if stats is None else stats.key(),
+                                      None if node_of is None else node_of.tolist())
+            dist_array, model = shared.get_or_build(cache_dir, key, build)
+        elif engine in QUBO_SOLVERS:
+            dist_array, model = build()
+        else:
+            dist_array = calc_dist(df, stats=stats)
+
+    return engine, taxi, dist_array, model
+
+
+def main(df, engine='auto', cache_dir=None, budget=None, archive_dir=None, tuner=None, stats=None, snap=None):
+    """
+    与えられた利用者集団に対し、配車番号を求める。
+
+    Parameters
+    ----------
+    df: pandas.dataframe
+        標準化前の特徴量データフレーム
+    engine: str
+        'auto'なら利用者数からソルバーを選ぶ。
+        'dapt'ならデジタルアニーラ、'sa', 'tabu'ならローカルでQUBOを、
+        'exact'なら厳密解法、'local'なら局所探索で解く。
+    cache_dir: str
+        作成したQUBOをプロセス間で共有するディレクトリ（省略時は共有しない）
+    budget: float
+        応答までの期限（秒）。指定するとソルバーと局所探索を並行して動かし、
+        期限の時点で最良の配車結果を返す（省略時は選んだソルバーの結果を待つ）。
+    archive_dir: str
+        配車処理の入力と結果を保存するディレクトリ（省略時は保存しない）
+    tuner: tuning.Tuner
+        QUBOソルバーのパラメータの選択と計算の記録（省略時は既定のパラメータで解き、記録しない）
+    stats: preparations.RunningStats
+        利用者全体の特徴量の統計量（省略時は利用者集団の中で標準化する）
+    snap: float
+        QUBOで解くとき、目的地を寄せてまとめる格子の一辺（m、省略時はまとめない）
+
+    Returns
+    -------
+    number_list:numpy.ndarray
+        配車番号リスト
+    """
+
+    user = len(df)
+    engine, taxi, dist_array, model = prepare(df, engine, cache_dir, stats, snap)
+    number_list = []
+
+    if dist_array.any():
+        if budget is not None:
+            solution = hedge(dist_array, taxi, engine, model, budget, tuner)
+        elif engine in QUBO_SOLVERS:
+            solution = anneal(dist_array, taxi, engine, model, tuner)
         else:
-            number_list = np.random.randint(0, taxi, user)  # 全員が同じ地点にいたらランダムにグループ分け
+            solution = partition.SOLVERS[engine](dist_array, taxi, sizing.CAPACITY)
+        logger.info('%r', solution)
+        if archive_dir is not None:
+            save_record(archive_dir, df, dist_array, taxi, solution, model)
+        number_list = solution.number
+    else:
+        number_list = np.arange(user)//sizing.CAPACITY  # 全員が同じ地点にいたら定員ずつ順に相乗りさせる
 
     return number_list
 
 
+def main_many(dfs, engine='dapt', cache_dir=None, max_qubit=batching.MAX_QUBIT, archive_dir=None, stats=None, snap=None):
+    """
+    複数の独立な利用者集団の配車番号を求める。
+    QUBOで解く集団は、ブロック対角にまとめて1回のソルバー呼び出しで解く。
+    上限を超えて複数回に分かれたときは、デジタルアニーラには同時に投げる。
+
+    Parameters
+    ----------
+    dfs: list
+        利用者集団毎の標準化前の特徴量データフレーム
+    engine: str
+        ソルバー名（mainと同じ）
+    cache_dir: str
+        作成したQUBOをプロセス間で共有するディレクトリ（省略時は共有しない）
+    max_qubit: int
+        一度にソルバーに投げるqubit数の上限
+    archive_dir: str
+        配車処理の入力と結果を保存するディレクトリ（省略時は保存しない）
+    stats: preparations.RunningStats
+        利用者全体の特徴量の統計量（省略時は利用者集団の中で標準化する）
+    snap: float
+        QUBOで解くとき、目的地を寄せてまとめる格子の一辺（m、省略時はまとめない）
+
+    Returns
+    -------
+    number_lists: list
+        利用者集団毎の配車番号リスト
+    """
+    started = time.perf_counter()
+    prepared = [prepare(df, engine, cache_dir, stats, snap) for df in dfs]
+    number_lists = [None]*len(dfs)
+    qubo_index = {}
+    for i, (engine_i, taxi, dist_array, model) in enumerate(prepared):
+        if not dist_array.any():
+            number_lists[i] = np.arange(len(dist_array))//sizing.CAPACITY  # 全員が同じ地点にいたら定員ずつ順に相乗りさせる
+        elif engine_i in QUBO_SOLVERS:
+            qubo_index.setdefault(engine_i, []).append(i)
+        else:
+            solution = partition.SOLVERS[engine_i](dist_array, taxi, sizing.CAPACITY)
+            logger.info('%r', solution)
+            if archive_dir is not None:
+                save_record(archive_dir, dfs[i], dist_array, taxi, solution, model)
+            number_lists[i] = solution.number
+
+    for engine_i, index in qubo_index.items():
+        solver = batching.BatchSolver(ASYNC_SOLVERS.get(engine_i, QUBO_SOLVERS[engine_i])(), max_qubit)
+        responses = solver.minimize_all([prepared[i][3].to_dict() for i in index])
+        for i, response in zip(index, responses):
+            _, taxi, dist_array, model = prepared[i]
+            solution = decode(response, dist_array, taxi, model, engine_i, started)
+            logger.info('%r', solution)
+            if archive_dir is not None:
+                save_record(archive_dir, dfs[i], dist_array, taxi, solution, model)
+            number_lists[i] = solution.number
+
+    return number_lists
+
+
 if __name__=='__main__':
     main(df)
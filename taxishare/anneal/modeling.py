@@ -2,6 +2,8 @@ import json
 import numpy as np
 import requests
 
+from taxishare.anneal import sizing
+
 
 class MyEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -25,33 +27,58 @@ class CostFunction(object):
         利用者数
     taxi: int
         タクシー数
+    capacity: int
+        タクシー1台あたりの定員
+    slack: list
+        タクシー毎のスラックビットの重み
+    encoding: str
+        スラック変数の符号化（'unary' or 'log'）
+    fixed: dictionary
+        値を固定したqubit番号と固定値の辞書
+    node_of: numpy.ndarray
+        利用者毎のノード番号（同じ地点の利用者をまとめていなければNone）
+    weight: numpy.ndarray
+        ノード毎の人数
     coefficient_array: numpy.ndarray
         qubit毎の係数を格納する配列
     const: float
         定数
+    number_qubit: int
+        固定されていないqubit数
     initialize: method
         qubit毎の係数を定義する。
     to_dict: method
         qubitsの係数配列、定数をデジタルアニーラに投げる形式に変換する。
     """
-    def __init__(self, user, taxi):
+    def __init__(self, user, taxi, capacity=4, encoding='unary', symmetry=False, node_of=None):
         """
         Parameters
         ----------
         user: int
-            利用者数
+            利用者数（node_ofを渡したならノード数）
         taxi: int
             タクシー数
-        coefficient_array: numpy.ndarray
-            qubit毎の係数を格納する配列
-        const: float
-            定数
+        capacity: int
+            タクシー1台あたりの定員
+        encoding: str
+            スラック変数の符号化（'unary'ならone-hot、'log'なら2進数）
+        symmetry: bool
+            タクシー番号の対称性を除く固定を行うかどうか
+        node_of: numpy.ndarray
+            利用者毎のノード番号（省略時は利用者1人を1ノードとする）
         """
         self.user = user
         self.taxi = taxi
-        number_qubit = (user+5)*taxi
+        self.capacity = capacity
+        self.encoding = encoding
+        self.slack = sizing.slack_weights(capacity, encoding)
+        self.fixed = sizing.symmetry_fixed(user, taxi) if symmetry else {}
+        self.node_of = node_of
+        self.weight = np.ones(user) if node_of is None else np.bincount(node_of, minlength=user).astype(np.float64)
+        number_qubit = (user+len(self.slack))*taxi
         self.coefficient_array = np.zeros((number_qubit, number_qubit))
         self.const = 0
+        self.number_qubit = number_qubit-len(self.fixed)
 
     def initialize(self, dist_array, penalty1, penalty2):
         """
@@ -67,6 +94,8 @@ class CostFunction(object):
             制約項2の係数
         """
         ylk_started_bit = self.user*self.taxi
+        n_slack = len(self.slack)
+        unary = self.encoding == 'unary'
 
         # 2次項を計算する
         for k in range(self.taxi):
@@ -75,16 +104,17 @@ class CostFunction(object):
                 a = group_k+i
                 for j in range(i+1, self.user):
                     b = group_k+j
-                    self.coefficient_array[a, b] += dist_array[i, j]+2*penalty2  # (dij+2β)*q_ik*q_jk
-                for l in range(5):
-                    b = ylk_started_bit+5*k+l
-                    self.coefficient_array[a, b] += -l*2*penalty2  # -l*2β*q_ik*y_lk
-
-            for l in range(5):
-                a = ylk_started_bit+5*k+l
-                for l2 in range(l+1, 5):
-                    b = ylk_started_bit+5*k+l2
-                    self.coefficient_array[a, b] += 2*penalty2*(l*l2+1)  # 2β*(ll'+1)
+                    self.coefficient_array[a, b] += dist_array[i, j]+2*penalty2*self.weight[i]*self.weight[j]  # (dij+2β*n_i*n_j)*q_ik*q_jk
+                for l, w in enumerate(self.slack):
+                    b = ylk_started_bit+n_slack*k+l
+                    self.coefficient_array[a, b] += -w*2*penalty2*self.weight[i]  # -w_l*2β*n_i*q_ik*y_lk
+
+            for l, w in enumerate(self.slack):
+                a = ylk_started_bit+n_slack*k+l
+                for l2 in range(l+1, n_slack):
+                    b = ylk_started_bit+n_slack*k+l2
+                    w2 = self.slack[l2]
+                    self.coefficient_array[a, b] += 2*penalty2*(w*w2+unary)  # 2β*(ll'+1) or 2β*w_l*w_l'
         for i in range(self.user):
             for k in range(self.taxi):
                 a = self.user*k+i
@@ -93,13 +123,24 @@ class CostFunction(object):
                     self.coefficient_array[a, b] += 2*penalty1  # 2α*q_ik*q_ik'
 
         # 1次項を計算する
-        diag_list = [penalty2-penalty1]*self.user*self.taxi  # (β-α)*q_ik
-        diag_list.extend([penalty2*(l*l-1) for _ in range(self.taxi) for l in range(5)])  # β*(ll-1)
+        diag_list = list(np.tile(penalty2*self.weight**2-penalty1, self.taxi))  # (β*n_i^2-α)*q_ik
+        diag_list.extend([penalty2*(w*w-unary) for _ in range(self.taxi) for w in self.slack])  # β*(ll-1) or β*w_l^2
         self.coefficient_array += np.diag(diag_list)
         # print(self.coefficient_array)
 
         # 定数項を計算する
-        self.const = penalty1*self.user+penalty2*self.taxi  # αI+βK
+        self.const = penalty1*self.user+penalty2*self.taxi*unary  # αI+βK
+
+        # 固定したqubitを定数項・1次項に畳み込む
+        for a, v in self.fixed.items():
+            if v:
+                self.const += self.coefficient_array[a, a]
+                row = self.coefficient_array[a, :].copy()
+                col = self.coefficient_array[:, a].copy()
+                row[a] = col[a] = 0
+                self.coefficient_array[np.diag_indices_from(self.coefficient_array)] += row+col
+            self.coefficient_array[a, :] = 0
+            self.coefficient_array[:, a] = 0
 
     def to_dict(self):
         """
@@ -157,7 +198,7 @@ class Response(object):
         self.timing = j['timing']
         self.qubit_array = None
 
-    def to_array(self, user, taxi):
+    def to_array(self, user, taxi, fixed=None):
         """
         qubitの配列に変換する。
 
@@ -167,15 +208,24 @@ class Response(object):
             利用者数
         taxi: int
             タクシー数
+        fixed: dictionary
+            値を固定したqubit番号と固定値の辞書
         """
-        dict_v = self.config.values()
-        qubit_array = np.array(list(dict_v)[:taxi*user])
+        fixed = fixed or {}
+        qubit_array = np.array([fixed.get(i, self.config.get(i, 0)) for i in range(taxi*user)])
         self.qubit_array = qubit_array.reshape((taxi, user))
 
-    def check_penalty(self):
+    def check_penalty(self, capacity=4, weight=None):
         """
         制約を満たすか確認する。
 
+        Parameters
+        ----------
+        capacity: int
+            タクシー1台あたりの定員
+        weight: numpy.ndarray
+            ノード毎の人数（省略時は全て1人）
+
         Returns
         -------
         f_user: int
@@ -184,7 +234,8 @@ class Response(object):
             タクシー数
         """
         f_user = len([x for x in self.qubit_array.sum(axis=0) if x != 1])
-        f_taxi = len([x for x in self.qubit_array.sum(axis=1) if x >= 5])
+        load = self.qubit_array.sum(axis=1) if weight is None else self.qubit_array @ weight
+        f_taxi = len([x for x in load if x > capacity])
         return f_user, f_taxi
 
     def group(self):
@@ -213,8 +264,14 @@ class DAPTSolver(object):
         APIキー
     rest_headers: dictionary
         接続形式
+    timeout: float
+        応答を待つ時間（秒、Noneなら待ち続ける）
     params: dictionary
         マシンパラメータ
+    build_request: method
+        デジタルアニーラに投げるURL、本文、ヘッダーを作る。
+    parse_response: method
+        デジタルアニーラの戻り値を処理する。
     minimize: method
         デジタルアニーラで計算する。
     """
@@ -222,15 +279,16 @@ class DAPTSolver(object):
         self.url = 'YOUR_URL'
         self.access_key = 'YOUR_KEY'
         self.rest_headers = {'content-type': 'application/json'}
+        self.timeout = None
         self.params = {}
         self.params['number_iterations'] = 100_000
         self.params['number_replicas'] = 100
         self.params['offset_increase_rate'] = 1000
         self.params['solution_mode'] = 'QUICK'
 
-    def minimize(self, qubit_dict):
+    def build_request(self, qubit_dict):
         """
-        デジタルアニーラで計算する。
+        デジタルアニーラに投げるURL、本文、ヘッダーを作る。
 
         Parameters
         ----------
@@ -239,20 +297,58 @@ class DAPTSolver(object):
 
         Returns
         -------
-        Response: class
-            デジタルアニーラの戻り値を処理するクラス
+        url: str
+            APIのURL
+        dump_request: bytes
+            JSON形式の本文
+        headers: dictionary
+            ヘッダー
         """
         request = {"fujitsuDAPT": self.params}
         request.update(qubit_dict)
         dump_request = json.dumps(request,cls = MyEncoder).encode('utf-8')
-        headers = self.rest_headers
+        headers = dict(self.rest_headers)
         headers['X-DA-Access-Key'] = self.access_key
         url = self.url + '/v1/qubo/solve'
-        response = requests.post(url, dump_request, headers=headers)
+        return url, dump_request, headers
+
+    @staticmethod
+    def parse_response(j):
+        """
+        デジタルアニーラの戻り値を処理する。
+
+        Parameters
+        ----------
+        j: json
+            デジタルアニーラの戻り値
+
+        Returns
+        -------
+        Response: class
+            デジタルアニーラの戻り値を処理するクラス
+        """
+        j = j[u'qubo_solution']
+        if j[u'result_status']:
+            return Response(j)
+        raise RuntimeError('result_status is false.')
+
+    def minimize(self, qubit_dict):
+        """
+        デジタルアニーラで計算する。
+
+        Parameters
+        ----------
+        qubit_dict: dictionary
+            qubits係数の辞書
+
+        Returns
+        -------
+        Response: class
+            デジタルアニーラの戻り値を処理するクラス
+        """
+        url, dump_request, headers = self.build_request(qubit_dict)
+        response = requests.post(url, dump_request, headers=headers, timeout=self.timeout)
         if response.ok:
-            j = response.json()[u'qubo_solution']
-            if j[u'result_status']:
-                return Response(j)
-            raise RuntimeError('result_status is false.')
+            return self.parse_response(response.json())
         else:
             raise RuntimeError(response.text)
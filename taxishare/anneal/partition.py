@@ -0,0 +1,284 @@
+import time
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+EXACT_UPPER = 10  # 厳密解法で解く利用者数の上限
+LOCAL_UPPER = 1000  # 局所探索で解く利用者数の上限（超えたらアニーラに投げる）
+
+
+class Solution(object):
+    """
+    配車結果と目的関数値を保持する。
+
+    Attributes
+    ----------
+    number: numpy.ndarray
+        利用者毎の配車番号
+    objective: float
+        同乗者間のデータ間距離の総和
+    engine: str
+        解いたソルバー名
+    elapsed: float
+        計算時間（秒）
+    response: modeling.Response
+        ソルバーの戻り値（QUBOで解いたときのみ）
+    params: dictionary
+        QUBOソルバーに渡したパラメータ（QUBOで解いたときのみ）
+    """
+    def __init__(self, number, objective, engine, elapsed=0.0, response=None, params=None):
+        self.number = np.asarray(number, dtype=int)
+        self.objective = float(objective)
+        self.engine = engine
+        self.elapsed = elapsed
+        self.response = response
+        self.params = params
+
+    def __repr__(self):
+        return 'Solution(engine={}, objective={:.6g}, elapsed={:.3g}s)'.format(
+            self.engine, self.objective, self.elapsed)
+
+
+def calc_objective(dist_array, number):
+    """
+    同じタクシーに乗る利用者間のデータ間距離の総和を求める。
+
+    Parameters
+    ----------
+    dist_array: numpy.ndarray
+        データ間距離の上三角行列
+    number: numpy.ndarray
+        利用者毎の配車番号
+
+    Returns
+    -------
+    objective: float
+        目的関数値
+    """
+    number = np.asarray(number)
+    same = number[:, None] == number[None, :]
+    return float(np.triu(dist_array, 1)[same].sum())
+
+
+def symmetrize(dist_array):
+    """
+    上三角行列のデータ間距離を対称行列にする。
+    """
+    upper = np.triu(dist_array, 1)
+    return upper+upper.T
+
+
+def check_feasible(number, taxi, capacity):
+    """
+    配車番号がタクシー数・定員の制約を満たすか確認する。
+    """
+    number = np.asarray(number)
+    if len(number) and (number.min() < 0 or number.max() >= taxi):
+        return False
+    return bool((np.bincount(number, minlength=taxi) <= capacity).all())
+
+
+def solve_exact(dist_array, taxi, capacity, stop=None):
+    """
+    分枝限定法で厳密な最適配車を求める。
+    利用者を順に既存のグループか新しいグループに割り当て、
+    未割当の利用者の最小追加距離を下界として枝刈りする。
+
+    Parameters
+    ----------
+    dist_array: numpy.ndarray
+        データ間距離の上三角行列
+    taxi: int
+        タクシー数
+    capacity: int
+        タクシー1台あたりの定員
+    stop: threading.Event
+        セットされたら探索を打ち切る
+
+    Returns
+    -------
+    solution: Solution
+        最適解（打ち切ったときはその時点の暫定解）
+    """
+    started = time.perf_counter()
+    dist = symmetrize(dist_array)
+    user = len(dist)
+    if user > taxi*capacity:
+        raise ValueError('number of user exceeds total capacity.')
+
+    # 局所探索の解を初期の暫定解にする
+    incumbent = solve_local(dist_array, taxi, capacity, stop=stop)
+    best = [incumbent.objective, incumbent.number.copy()]
+
+    number = np.full(user, -1)
+    cost = np.zeros((user, taxi))  # 利用者iをグループkに入れたときの追加距離
+    size = np.zeros(taxi, dtype=int)
+
+    def lower_bound(i, opened):
+        rest = cost[i:, :opened][:, size[:opened] < capacity]
+        if opened < taxi or rest.shape[1] == 0:
+            return 0.0 if opened < taxi else np.inf
+        return rest.min(axis=1).sum()
+
+    def branch(i, opened, value):
+        if i == user:
+            if value < best[0]:
+                best[0], best[1] = value, number.copy()
+            return
+        if value+lower_bound(i, opened) >= best[0]-1e-12 or (stop is not None and stop.is_set()):
+            return
+        candidates = [k for k in range(opened) if size[k] < capacity]
+        candidates.sort(key=lambda k: cost[i, k])
+        if opened < taxi:
+            candidates.append(opened)
+        for k in candidates:
+            added = cost[i, k]
+            number[i] = k
+            size[k] += 1
+            cost[:, k] += dist[:, i]
+            branch(i+1, max(opened, k+1), value+added)
+            cost[:, k] -= dist[:, i]
+            size[k] -= 1
+        number[i] = -1
+
+    branch(0, 0, 0.0)
+    return Solution(best[1], best[0], 'exact', time.perf_counter()-started)
+
+
+def solve_local(dist_array, taxi, capacity, seed=0, max_round=100, callback=None, stop=None):
+    """
+    貪欲法で初期解を作り、移動・交換の局所探索で改善する。
+    callbackを渡すと、初期解と改善した暫定解を順に渡す。
+
+    Parameters
+    ----------
+    dist_array: numpy.ndarray
+        データ間距離の上三角行列
+    taxi: int
+        タクシー数
+    capacity: int
+        タクシー1台あたりの定員
+    seed: int
+        乱数シード
+    max_round: int
+        局所探索の最大反復回数
+    callback: function
+        暫定解（Solution）を受け取る関数
+    stop: threading.Event
+        セットされたら局所探索を打ち切る
+
+    Returns
+    -------
+    solution: Solution
+        局所最適解（打ち切ったときはその時点の暫定解）
+    """
+    started = time.perf_counter()
+    dist = symmetrize(dist_array)
+    user = len(dist)
+    if user > taxi*capacity:
+        raise ValueError('number of user exceeds total capacity.')
+    rng = np.random.default_rng(seed)
+
+    # 互いに遠い利用者をグループの種にする
+    number = np.full(user, -1)
+    size = np.zeros(taxi, dtype=int)
+    cost = np.zeros((user, taxi))
+    seeds = [int(rng.integers(user))] if user else []
+    while len(seeds) < min(taxi, user):
+        far = dist[:, seeds].min(axis=1)
+        far[seeds] = -1
+        seeds.append(int(far.argmax()))
+    for k, i in enumerate(seeds):
+        number[i] = k
+        size[k] = 1
+        cost[:, k] += dist[:, i]
+
+    # 残りの利用者を、追加距離の最も小さいグループに入れる
+    rest = [i for i in range(user) if number[i] < 0]
+    while rest:
+        masked = np.where(size < capacity, cost[rest], np.inf)
+        order = np.sort(masked, axis=1)
+        regret = order[:, 1]-order[:, 0] if taxi > 1 else -order[:, 0]  # 後回しにしたときの損失
+        r = int(np.argmax(np.nan_to_num(regret, posinf=np.finfo(float).max)))
+        i = rest.pop(r)
+        k = int(masked[r].argmin())
+        number[i] = k
+        size[k] += 1
+        cost[:, k] += dist[:, i]
+
+    def incumbent():
+        return Solution(number.copy(), calc_objective(dist_array, number), 'local', time.perf_counter()-started)
+
+    if callback is not None:
+        callback(incumbent())
+
+    # 移動・交換の局所探索
+    index = np.arange(user)
+    for _ in range(max_round):
+        if stop is not None and stop.is_set():
+            break
+        improved = False
+        for i in rng.permutation(user):
+            a = number[i]
+            # 利用者iを空きのあるグループに移す
+            gain = np.where(size < capacity, cost[i]-cost[i, a], np.inf)
+            gain[a] = np.inf
+            b = int(gain.argmin()) if taxi > 1 else a
+            if b != a and gain[b] < -1e-12:
+                number[i] = b
+                size[a] -= 1
+                size[b] += 1
+                cost[:, a] -= dist[:, i]
+                cost[:, b] += dist[:, i]
+                improved = True
+                continue
+            # 別グループの利用者jと入れ替える
+            other = index[number != a]
+            if len(other) == 0:
+                continue
+            delta = (cost[i, number[other]]-dist[i, other]-cost[i, a]
+                     +cost[other, a]-dist[i, other]-cost[other, number[other]])
+            j = int(delta.argmin())
+            if delta[j] < -1e-12:
+                j = other[j]
+                b = number[j]
+                number[i], number[j] = b, a
+                cost[:, a] += dist[:, j]-dist[:, i]
+                cost[:, b] += dist[:, i]-dist[:, j]
+                improved = True
+        if not improved:
+            break
+        if callback is not None:
+            callback(incumbent())
+
+    return incumbent()
+
+
+SOLVERS = {
+    'exact': solve_exact,
+    'local': solve_local,
+}
+
+
+def select_engine(user):
+    """
+    利用者数から最も速く十分な精度で解けるソルバーを選ぶ。
+
+    Parameters
+    ----------
+    user: int
+        利用者数
+
+    Returns
+    -------
+    engine: str
+        'exact', 'local', 'dapt'のいずれか
+    """
+    if user <= EXACT_UPPER:
+        return 'exact'
+    elif user <= LOCAL_UPPER:
+        return 'local'
+    return 'dapt'
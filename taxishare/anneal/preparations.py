@@ -1,10 +1,188 @@
+import hashlib
+import threading
+from collections import OrderedDict
 from datetime import date
 import numpy as np
 import pandas as pd
 from scipy.stats import zscore
 
 
-def normalize(df):
+def calc_age(born):
+    """
+    生年月日から年齢を計算する。
+
+    Parameters
+    ----------
+    born: datetime.datetime
+        利用者の生年月日
+
+    Returns
+    -------
+    age: int
+        利用者の年齢
+    """
+    today = date.today()
+    age = today.year-born.year-((today.month, today.day)<(born.month, born.day))
+    return age
+
+
+F_COLS = ['desitination_latitude', 'desitination_longitude', 'age', 'sex']  # 標準化する特徴量
+STATS_TOLERANCE = 0.01  # 標準化に使う平均・標準偏差を取り直す変化の大きさ（標準偏差に対する割合）
+
+
+class RunningStats(object):
+    """
+    特徴量毎の件数・平均・偏差平方和（M2）を、利用者の追加・削除・移動の度に1件ずつ更新する（Welford法）。
+    値の無い特徴量（年齢未登録など）は、その特徴量だけ数えない。
+
+    Attributes
+    ----------
+    count: numpy.ndarray
+        特徴量毎の件数
+    mean: numpy.ndarray
+        特徴量毎の平均
+    m2: numpy.ndarray
+        特徴量毎の偏差平方和
+    ref_mean, ref_std: numpy.ndarray
+        標準化に使う平均・標準偏差（Noneなら現在の値を使う）
+    add: method
+        1人分の特徴量を加える。
+    remove: method
+        1人分の特徴量を除く。
+    replace: method
+        1人分の特徴量を入れ替える。
+    merge: method
+        別の集団の統計量をまとめる。
+    rebase: method
+        統計量が許容幅を超えて動いていれば、標準化に使う平均・標準偏差を取り直す。
+    normalize: method
+        特徴量を標準化する。
+    """
+    def __init__(self, count=None, mean=None, m2=None, ref_mean=None, ref_std=None):
+        n = len(F_COLS)
+        self.count = np.zeros(n) if count is None else np.asarray(count, dtype=np.float64)
+        self.mean = np.zeros(n) if mean is None else np.asarray(mean, dtype=np.float64)
+        self.m2 = np.zeros(n) if m2 is None else np.asarray(m2, dtype=np.float64)
+        self.ref_mean = None if ref_mean is None else np.asarray(ref_mean, dtype=np.float64)
+        self.ref_std = None if ref_std is None else np.asarray(ref_std, dtype=np.float64)
+
+    @classmethod
+    def from_values(cls, values):
+        """
+        利用者×特徴量の配列（値が無ければnan）から統計量を求める。
+        """
+        values = np.asarray(values, dtype=np.float64).reshape(-1, len(F_COLS))
+        valid = ~np.isnan(values)
+        count = valid.sum(axis=0).astype(np.float64)
+        mean = np.where(count > 0, np.nansum(values, axis=0)/np.maximum(count, 1), 0.0)
+        m2 = np.nansum(np.where(valid, (values-mean)**2, np.nan), axis=0)
+        return cls(count, mean, m2)
+
+    @staticmethod
+    def vector(x):
+        """
+        特徴量の並び（Noneはnan）を配列にする。
+        """
+        return np.array([np.nan if v is None else v for v in x], dtype=np.float64)
+
+    def add(self, x):
+        """
+        1人分の特徴量（F_COLSの順）を加える。
+        """
+        x = self.vector(x)
+        valid = ~np.isnan(x)
+        self.count[valid] += 1
+        delta = x[valid]-self.mean[valid]
+        self.mean[valid] += delta/self.count[valid]
+        self.m2[valid] += delta*(x[valid]-self.mean[valid])
+
+    def remove(self, x):
+        """
+        1人分の特徴量（F_COLSの順）を除く。
+        """
+        x = self.vector(x)
+        valid = ~np.isnan(x)
+        last = valid & (self.count <= 1)
+        self.count[last], self.mean[last], self.m2[last] = 0, 0, 0  # 最後の1人を除いたら初期状態に戻す
+        valid &= ~last
+        self.count[valid] -= 1
+        delta = x[valid]-self.mean[valid]
+        self.mean[valid] -= delta/self.count[valid]
+        self.m2[valid] = np.maximum(self.m2[valid]-delta*(x[valid]-self.mean[valid]), 0)
+
+    def replace(self, old, new):
+        """
+        1人分の特徴量を入れ替える（地点情報の更新など）。
+        """
+        self.remove(old)
+        self.add(new)
+
+    def merge(self, other):
+        """
+        別の集団の統計量をまとめる（一括登録など）。
+        """
+        count = self.count+other.count
+        delta = other.mean-self.mean
+        safe = np.maximum(count, 1)
+        self.mean = np.where(count > 0, self.mean+delta*other.count/safe, 0.0)
+        self.m2 = self.m2+other.m2+delta**2*self.count*other.count/safe
+        self.count = count
+
+    @property
+    def std(self):
+        """
+        特徴量毎の標準偏差（母標準偏差）。
+        """
+        return np.sqrt(self.m2/np.maximum(self.count, 1))
+
+    def reference(self):
+        """
+        標準化に使う平均・標準偏差を返す。
+        """
+        if self.ref_mean is None or self.ref_std is None:
+            return self.mean, self.std
+        return self.ref_mean, self.ref_std
+
+    def rebase(self, tolerance=STATS_TOLERANCE):
+        """
+        平均・標準偏差のどれかが、標準化に使う値から標準偏差のtolerance倍を超えて動いていれば取り直す。
+        1人分の更新では取り直さないので、標準化した特徴量のキャッシュを使い回せる。
+
+        Returns
+        -------
+        rebased: bool
+            取り直したか
+        """
+        std = self.std
+        if self.ref_mean is not None and self.ref_std is not None:
+            limit = tolerance*self.ref_std
+            if not ((np.abs(self.mean-self.ref_mean) > limit) | (np.abs(std-self.ref_std) > limit)).any():
+                return False
+        self.ref_mean, self.ref_std = self.mean.copy(), std
+        return True
+
+    def key(self):
+        """
+        標準化に使う平均・標準偏差を表す文字列（キャッシュのキーに使う）。
+        """
+        return repr(np.round(np.concatenate(self.reference()), 12).tolist())
+
+    def normalize(self, df):
+        """
+        標準化に使う平均・標準偏差で特徴量を標準化する。
+        標準偏差が0の特徴量と値の無い特徴量は、距離に寄与させないように0にする。
+        """
+        mean, std = self.reference()
+        norm_df = pd.DataFrame(index=range(len(df)))
+        for k, c in enumerate(F_COLS):
+            if std[k] > 0:
+                norm_df[c] = (df[c].values.astype(np.float64)-mean[k])/std[k]
+            else:
+                norm_df[c] = 0.0
+        return norm_df.fillna(0)
+
+
+def normalize(df, stats=None):
     """
     特徴量を標準化する。
 
@@ -12,6 +190,8 @@ def normalize(df):
     ----------
     df: pandas.dataframe
         標準化前の特徴量データフレーム
+    stats: RunningStats
+        利用者全体の統計量（省略時はdfの中で標準化する）
 
     Returns
     -------
@@ -19,38 +199,200 @@ def normalize(df):
         標準化された特徴量データフレーム
     """
 
-    def calc_age(born):
+    # 年齢を算出する（スナップショットから読んだ場合は算出済み）。
+    if 'age' not in df:
+        df['age'] = df['birth_date'].map(calc_age)
+
+    # 標準化する。
+    if stats is not None:
+        return stats.normalize(df)
+    norm_df = pd.DataFrame()
+    # norm_df['id'] = df['id']
+    norm_df[F_COLS] = df[F_COLS].apply(zscore).fillna(0)  # 全員同じ値の特徴量は距離に寄与させない
+    return norm_df
+
+
+FEATURES = ['direct', 'age', 'sex']  # 重みf_wの順の特徴量
+FEATURE_CACHE_SIZE = 64  # 特徴量毎の距離行列を残す利用者集団の数
+
+
+def square_diff_matrix(f_array):
+    """
+    1次元配列の各要素の差分の二乗を計算する。
+
+    Parameters
+    ----------
+    f_array: numpy.ndarray
+        利用者毎の特徴量を示す１次元配列
+
+    Returns
+    -------
+    diff_array: numpy.ndarray
+        差分の二乗が入った2次元配列
+    """
+    f_array = np.asarray(f_array, dtype=np.float64)
+    return (f_array[:, None]-f_array[None, :])**2
+
+
+class FeatureDistances(object):
+    """
+    特徴量毎の利用者間の距離行列を、重みが0でないものだけ必要になった時に求めて保持する。
+    重みを変えても、保持した行列の重み付き和を取り直すだけで済む。
+
+    Attributes
+    ----------
+    norm_df: pandas.dataframe
+        標準化された特徴量のデータフレーム
+    matrix: method
+        特徴量の距離行列を返す。
+    combine: method
+        重み付きのデータ間距離を求める。
+    sweep: method
+        複数の重みのデータ間距離をまとめて求める。
+    evaluate: method
+        配車結果の目的関数値を複数の重みで求める。
+    """
+    def __init__(self, norm_df):
+        """
+        Parameters
+        ----------
+        norm_df: pandas.dataframe
+            標準化された特徴量のデータフレーム
+        """
+        self.norm_df = norm_df
+        self.matrices = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.norm_df)
+
+    def matrix(self, name):
+        """
+        特徴量nameの距離行列を返す（読み取り専用）。初めて使う時に求める。
         """
-        生年月日から年齢を計算する。
+        with self.lock:
+            if name not in self.matrices:
+                if name == 'direct':
+                    m = np.sqrt(square_diff_matrix(self.norm_df['desitination_latitude'].values)
+                                +square_diff_matrix(self.norm_df['desitination_longitude'].values))
+                elif name in ('age', 'sex'):
+                    m = square_diff_matrix(self.norm_df[name].values)
+                else:
+                    raise KeyError('unknown feature: {}'.format(name))
+                m.setflags(write=False)
+                self.matrices[name] = m
+            return self.matrices[name]
+
+    def combine(self, f_w=[1, 1, 1]):
+        """
+        特徴量からデータ間距離を求める。重みが0の特徴量は求めない。
 
         Parameters
         ----------
-        born: datetime.datetime
-            利用者の生年月日
+        f_w: list
+            各特徴量の重み（FEATURESの順）
 
         Returns
         -------
-        age: int
-            利用者の年齢
+        dist_array: numpy.ndarray
+            利用者間のデータ間距離2次元配列（上三角行列）
         """
-        today = date.today()
-        age = today.year-born.year-((today.month, today.day)<(born.month, born.day))
-        return age
+        return self.sweep([f_w])[0]
 
-    # 年齢を算出する。
-    df['age'] = df['birth_date'].map(calc_age)
+    def sweep(self, weights):
+        """
+        複数の重みのデータ間距離をまとめて求める。
+        重みのどれかが0でない特徴量の距離行列だけを1回ずつ求め、重み付き和を取る。
 
-    # 標準化する。
-    norm_df = pd.DataFrame()
-    # norm_df['id'] = df['id']
-    f_cols = ['desitination_latitude', 'desitination_longitude', 'age', 'sex']
-    norm_df[f_cols] = df[f_cols].apply(zscore)
-    return norm_df
+        Parameters
+        ----------
+        weights: list
+            重みf_wのリスト
+
+        Returns
+        -------
+        dist_arrays: numpy.ndarray
+            重み毎のデータ間距離（重みの数×利用者数×利用者数、上三角行列）
+        """
+        weights = np.atleast_2d(np.asarray(weights, dtype=np.float64))
+        if weights.shape[1] != len(FEATURES):
+            raise ValueError('each weight must have {} elements: {}'.format(len(FEATURES), weights.shape[1]))
+        total = weights.sum(axis=1)
+        if (total == 0).any():
+            raise ValueError('weights must not sum to zero.')
+        used = np.flatnonzero((weights != 0).any(axis=0))
+        stack = np.stack([self.matrix(FEATURES[k]) for k in used])
+        dist_arrays = np.tensordot(weights[:, used]/total[:, None], stack, axes=1)
+        return np.triu(dist_arrays)
+
+    def evaluate(self, number, weights):
+        """
+        配車結果の目的関数値（同乗者間のデータ間距離の総和）を、複数の重みで求める。
+
+        Parameters
+        ----------
+        number: numpy.ndarray
+            利用者毎の配車番号
+        weights: list
+            重みf_wのリスト
+
+        Returns
+        -------
+        objectives: numpy.ndarray
+            重み毎の目的関数値
+        """
+        number = np.asarray(number)
+        same = np.triu(number[:, None] == number[None, :], 1)
+        return self.sweep(weights)[:, same].sum(axis=1)
+
+
+_feature_cache = OrderedDict()
+_feature_lock = threading.Lock()
+
+
+def feature_key(df):
+    """
+    利用者集団の特徴量からキャッシュのキーを求める。
+    """
+    cols = [c for c in ['desitination_latitude', 'desitination_longitude', 'age', 'birth_date', 'sex'] if c in df]
+    digest = hashlib.sha1(repr(cols).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df[cols], index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def features(df, stats=None):
+    """
+    利用者集団の特徴量毎の距離行列を返す。同じ利用者集団・統計量には求めたものを使い回す。
+
+    Parameters
+    ----------
+    df: pandas.dataframe
+        標準化前の特徴量データフレーム
+    stats: RunningStats
+        利用者全体の統計量（省略時はdfの中で標準化する）
+
+    Returns
+    -------
+    distances: FeatureDistances
+        特徴量毎の距離行列
+    """
+    key = feature_key(df)+('' if stats is None else stats.key())
+    with _feature_lock:
+        if key in _feature_cache:
+            _feature_cache.move_to_end(key)
+            return _feature_cache[key]
+    distances = FeatureDistances(normalize(df.copy(), stats))  # 年齢の列を足してもキーが変わらないように写してから標準化する
+    with _feature_lock:
+        distances = _feature_cache.setdefault(key, distances)
+        _feature_cache.move_to_end(key)
+        while len(_feature_cache) > FEATURE_CACHE_SIZE:
+            _feature_cache.popitem(last=False)
+    return distances
 
 
 def calc_dist_array(norm_df, f_w=[1, 1, 1]):
     """
-    特徴量からデータ間距離を求める。
+    特徴量からデータ間距離を求める。重みが0の特徴量は求めない。
 
     Parameters
     ----------
@@ -64,37 +406,4 @@ def calc_dist_array(norm_df, f_w=[1, 1, 1]):
     dist_array: numpy.ndarray
         利用者間のデータ間距離2次元配列（上三角行列）
     """
-    d_lat = norm_df['desitination_latitude'].values
-    d_long = norm_df['desitination_longitude'].values
-    age = norm_df['age'].values
-    sex = norm_df['sex'].values
-
-    def square_diff_matrix(f_array):
-        """
-        1次元配列の各要素の差分の二乗を計算する。
-
-        Parameters
-        ----------
-        f_array: numpy.ndarray
-            利用者毎の特徴量を示す１次元配列
-
-        Returns
-        -------
-        diff_array: numpy.ndarray
-            差分の二乗が入った2次元配列
-        """
-        length_fa = len(f_array)
-        diff_array = np.array([(i-j)**2 for i in f_array for j in f_array])
-        diff_array = diff_array.reshape(length_fa, length_fa)
-        return diff_array
-
-    # 各特徴量の差分の二乗和の行列を求める。
-    direct_dist = np.sqrt(square_diff_matrix(d_lat)+square_diff_matrix(d_long))
-    age_dist = square_diff_matrix(age)
-    sex_dist = square_diff_matrix(sex)
-
-    # 各特徴量への重みづける
-    dist_array = f_w[0]*direct_dist+f_w[1]*age_dist+f_w[2]*sex_dist
-    dist_array = dist_array/sum(f_w)
-    dist_array = np.triu(dist_array)
-    return dist_array
+    return FeatureDistances(norm_df).combine(f_w)
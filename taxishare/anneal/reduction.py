@@ -0,0 +1,138 @@
+import math
+
+import numpy as np
+
+from taxishare.anneal import sizing
+from taxishare.anneal.routing import EARTH_RADIUS
+
+
+METER_PER_DEGREE = 2*math.pi*EARTH_RADIUS*1000/360  # 緯度1度あたりの距離（m）
+
+
+def snap(lat, lon, cell):
+    """
+    目的地を一辺cellメートルの格子に寄せ、格子毎の番号を求める。
+
+    Parameters
+    ----------
+    lat, lon: array_like
+        利用者毎の目的地の緯度・経度
+    cell: float
+        格子の一辺（m、0なら同じ座標の利用者だけを同じ格子にする）
+
+    Returns
+    -------
+    cell_of: numpy.ndarray
+        利用者毎の格子番号（出現順）
+    """
+    lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+    if len(lat) == 0:
+        return np.zeros(0, dtype=int)
+    if cell:
+        # 経度1度の距離は緯度で変わるので、集団の平均緯度で補正する
+        y = np.floor(lat*METER_PER_DEGREE/cell)
+        x = np.floor(lon*METER_PER_DEGREE*math.cos(math.radians(lat.mean()))/cell)
+    else:
+        y, x = lat, lon
+    _, first, inverse = np.unique(np.stack([y, x], axis=1), axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(np.argsort(first))  # 格子番号を出現順に振り直す
+    return order[inverse.ravel()]
+
+
+def merge(lat, lon, cell, capacity=sizing.CAPACITY):
+    """
+    同じ格子に目的地がある利用者を、定員以下の人数ずつ1つのノードにまとめる。
+
+    Parameters
+    ----------
+    lat, lon: array_like
+        利用者毎の目的地の緯度・経度
+    cell: float
+        格子の一辺（m）
+    capacity: int
+        タクシー1台あたりの定員（1ノードの人数の上限）
+
+    Returns
+    -------
+    node_of: numpy.ndarray
+        利用者毎のノード番号（出現順）
+    """
+    cell_of = snap(lat, lon, cell)
+    node_of = np.empty(len(cell_of), dtype=int)
+    open_node = {}  # 格子毎の人数に空きがあるノード
+    size = []
+    for i, c in enumerate(cell_of):
+        node = open_node.get(c)
+        if node is None or size[node] >= capacity:
+            node = open_node[c] = len(size)
+            size.append(0)
+        size[node] += 1
+        node_of[i] = node
+    return node_of
+
+
+def aggregate(dist_array, node_of):
+    """
+    利用者間の距離をノード間の距離にまとめる。ノード間の距離は、両ノードの利用者の組の距離の和とする。
+    同じノードの利用者は必ず同じタクシーに乗るので、ノード内の距離は目的関数の定数になり除く。
+
+    Parameters
+    ----------
+    dist_array: numpy.ndarray
+        利用者間距離の上三角行列
+    node_of: numpy.ndarray
+        利用者毎のノード番号
+
+    Returns
+    -------
+    node_dist: numpy.ndarray
+        ノード間距離の上三角行列
+    """
+    member = np.zeros((len(node_of), node_of.max()+1))
+    member[np.arange(len(node_of)), node_of] = 1
+    sym = dist_array+dist_array.T
+    return np.triu(member.T @ sym @ member, k=1)
+
+
+def intra(dist_array, node_of):
+    """
+    同じノードの利用者の組の距離の総和（ノードにまとめたQUBOの定数）を求める。
+    """
+    upper = np.triu(dist_array, 1)
+    return float(upper[node_of[:, None] == node_of[None, :]].sum())
+
+
+def taxi_number(weight, capacity=sizing.CAPACITY, headroom=sizing.HEADROOM):
+    """
+    人数の異なるノードを詰められるタクシー数を、First Fit Decreasingで求める。
+
+    Parameters
+    ----------
+    weight: array_like
+        ノード毎の人数
+    capacity: int
+        タクシー1台あたりの定員
+    headroom: int
+        最小台数に加える予備台数
+
+    Returns
+    -------
+    taxi: int
+        タクシー数（ノード数を超えない）
+    """
+    load = []
+    for w in sorted(weight, reverse=True):
+        for k in range(len(load)):
+            if load[k]+w <= capacity:
+                load[k] += w
+                break
+        else:
+            load.append(w)
+    return max(1, min(len(load)+headroom, len(weight)))
+
+
+def expand(number, node_of):
+    """
+    ノード毎の配車番号を、利用者毎の配車番号に戻す。
+    """
+    return np.asarray(number)[node_of]
@@ -0,0 +1,89 @@
+import time
+
+import numpy as np
+
+from taxishare.anneal import main, partition, archive
+
+
+def replay_one(path, engine=None, params=None, penalties=None):
+    """
+    保存した1回の配車処理を、指定したソルバー・設定で解き直す。
+    プロセスプールから呼べるように、引数と戻り値は単純な値にする。
+
+    Parameters
+    ----------
+    path: str
+        保存したファイル
+    engine: str
+        ソルバー名（省略時は記録したソルバー）
+    params: dictionary
+        QUBOソルバーのパラメータの上書き
+    penalties: tuple
+        制約項1, 2の係数（指定すると記録したQUBOの代わりに作り直す）
+
+    Returns
+    -------
+    result: dictionary
+        記録した結果と解き直した結果（目的関数値、エネルギー、実行可能性、計算時間）
+    """
+    try:
+        rec = archive.Record(path)
+    except (OSError, ValueError, KeyError) as e:  # 壊れた・古い形式のファイル
+        return failed(path, engine, 'unreadable archive: {}'.format(e))
+    engine = engine or rec.engine
+    result = {
+        'path': path,
+        'user': len(rec.dist_array),
+        'recorded_engine': rec.engine,
+        'recorded_objective': rec.objective,
+        'recorded_energy': np.nan if rec.energy is None else rec.energy,
+        'recorded_elapsed': rec.elapsed,
+        'engine': engine,
+        'objective': np.nan,
+        'energy': np.nan,
+        'feasible': False,
+        'elapsed': np.nan,
+        'error': None,
+    }
+    if engine not in main.QUBO_SOLVERS and engine not in partition.SOLVERS:
+        result['error'] = 'unknown engine: {}'.format(engine)  # stubなど、このプロセスに無いソルバー
+        return result
+    started = time.perf_counter()
+    try:
+        if engine in main.QUBO_SOLVERS:
+            if penalties is not None:
+                model = main.build_model(rec.dist_array, rec.taxi, *penalties)
+            elif rec.has_qubo():
+                model = rec
+            else:
+                model = main.build_model(rec.dist_array, rec.taxi)
+            solver = main.QUBO_SOLVERS[engine]()
+            solver.params.update(params or {})
+            response = solver.minimize(model.to_dict())
+            result['energy'] = response.energy
+            solution = main.decode(response, rec.dist_array, rec.taxi, model, engine, started)
+        else:
+            solution = partition.SOLVERS[engine](rec.dist_array, rec.taxi, rec.capacity)
+        result['elapsed'] = time.perf_counter()-started
+        result['objective'] = solution.objective
+        result['feasible'] = (len(solution.number) == len(rec.dist_array)
+                              and partition.check_feasible(solution.number, rec.taxi, rec.capacity))
+    except ValueError as e:  # 制約を満たさない解
+        result['elapsed'] = time.perf_counter()-started
+        result['error'] = str(e)
+    except Exception as e:  # プールのワーカーからは例外を投げず、ファイル毎の失敗として記録する
+        result['elapsed'] = time.perf_counter()-started
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    return result
+
+
+def failed(path, engine, error):
+    """
+    読み込めなかったファイルの結果を返す。
+    """
+    return {
+        'path': path, 'user': 0,
+        'recorded_engine': None, 'recorded_objective': np.nan, 'recorded_energy': np.nan, 'recorded_elapsed': np.nan,
+        'engine': engine, 'objective': np.nan, 'energy': np.nan, 'feasible': False, 'elapsed': np.nan,
+        'error': error,
+    }
@@ -0,0 +1,183 @@
+import itertools
+from functools import lru_cache
+
+import numpy as np
+
+
+EARTH_RADIUS = 6371.0  # 地球の半径（km）
+EXACT_STOPS = 5  # 全順列で最適な降車順を求める降車地点数の上限
+MAX_ROUND = 100  # 2-optの最大反復回数
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    2地点間の大円距離（km）を求める。配列を渡すと要素毎に求める。
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2-lat1)/2)**2+np.cos(lat1)*np.cos(lat2)*np.sin((lon2-lon1)/2)**2
+    return 2*EARTH_RADIUS*np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+@lru_cache(maxsize=256)
+def _distance_matrix(points):
+    lat, lon = np.array(points).T
+    dist = haversine(lat[:, None], lon[:, None], lat[None, :], lon[None, :])
+    dist.flags.writeable = False  # キャッシュした配列を書き換えないようにする
+    return dist
+
+
+def distance_matrix(lat, lon):
+    """
+    地点間の大円距離の行列を求める。同じ地点の組は計算済みの行列を使う。
+
+    Parameters
+    ----------
+    lat: array_like
+        地点毎の緯度
+    lon: array_like
+        地点毎の経度
+
+    Returns
+    -------
+    dist: numpy.ndarray
+        地点間の距離（km）の対称行列（読み取り専用）
+    """
+    return _distance_matrix(tuple(zip(map(float, lat), map(float, lon))))
+
+
+@lru_cache(maxsize=None)
+def permutations(m):
+    """
+    m地点の全ての訪問順を並べた配列を返す。
+    """
+    return np.array(list(itertools.permutations(range(m))), dtype=int).reshape(-1, m)
+
+
+def path_length(dist, stops):
+    """
+    出発地（0番目の地点）から順に地点を回る経路長を求める。最後の軸が訪問順。
+    """
+    stops = np.asarray(stops)
+    if stops.shape[-1] == 0:
+        return np.zeros(stops.shape[:-1])
+    return dist[0, stops[..., 0]]+dist[stops[..., :-1], stops[..., 1:]].sum(axis=-1)
+
+
+def route_exact(dist, groups):
+    """
+    降車地点数の等しいタクシーの最適な降車順を、全順列でまとめて求める。
+
+    Parameters
+    ----------
+    dist: numpy.ndarray
+        地点間の距離行列（0番目は出発地）
+    groups: numpy.ndarray
+        タクシー毎の降車地点番号（タクシー数×降車地点数）
+
+    Returns
+    -------
+    routes: numpy.ndarray
+        タクシー毎の降車順に並べた地点番号
+    lengths: numpy.ndarray
+        タクシー毎の経路長
+    """
+    candidates = groups[:, permutations(groups.shape[1])]  # タクシー数×順列数×降車地点数
+    length = path_length(dist, candidates)
+    best = length.argmin(axis=1)
+    index = np.arange(len(groups))
+    return candidates[index, best], length[index, best]
+
+
+def route_heuristic(dist, stops):
+    """
+    最近傍法で降車順を作り、2-optで改善する。
+    与えられた順の方が短ければ、そこから改善する（与えられた順より長くはならない）。
+
+    Parameters
+    ----------
+    dist: numpy.ndarray
+        地点間の距離行列（0番目は出発地）
+    stops: array_like
+        降車地点番号
+
+    Returns
+    -------
+    route: numpy.ndarray
+        降車順に並べた地点番号
+    length: float
+        経路長
+    """
+    rest = list(stops)
+    route = []
+    current = 0
+    while rest:
+        current = rest.pop(int(np.argmin(dist[current, rest])))
+        route.append(current)
+    route = np.array(route, dtype=int)
+    given = np.asarray(stops, dtype=int)
+    if path_length(dist, given) < path_length(dist, route):
+        route = given.copy()
+
+    # 区間を反転して短くなる限り繰り返す（終点は出発地に戻らない）
+    for _ in range(MAX_ROUND):
+        path = np.concatenate([[0], route])
+        improved = False
+        for i in range(1, len(path)-1):
+            a, b = path[i-1], path[i]
+            c = path[i+1:]
+            d = np.append(path[i+2:], -1)
+            after = np.where(d >= 0, dist[b, np.maximum(d, 0)], 0)
+            before = np.where(d >= 0, dist[c, np.maximum(d, 0)], 0)
+            delta = dist[a, c]+after-dist[a, b]-before
+            j = int(delta.argmin())
+            if delta[j] < -1e-12:
+                path[i:i+j+2] = path[i:i+j+2][::-1]
+                route = path[1:]
+                improved = True
+                break
+        if not improved:
+            break
+    return route, float(path_length(dist, route))
+
+
+def plan(origin, destinations, number):
+    """
+    配車結果から、タクシー毎に出発地からの降車順と経路長を求める。
+    降車地点数がEXACT_STOPS以下のタクシーは、地点数毎にまとめて最適な順を求める。
+
+    Parameters
+    ----------
+    origin: tuple
+        出発地の(緯度, 経度)
+    destinations: numpy.ndarray
+        利用者毎の目的地の(緯度, 経度)
+    number: numpy.ndarray
+        利用者毎の配車番号
+
+    Returns
+    -------
+    order: numpy.ndarray
+        利用者毎の降車順（1から）
+    route_length: numpy.ndarray
+        利用者毎の、乗るタクシーの経路長（km）
+    """
+    destinations = np.asarray(destinations, dtype=float).reshape(-1, 2)
+    number = np.asarray(number, dtype=int)
+    points = np.vstack([[origin], destinations])
+    dist = distance_matrix(points[:, 0], points[:, 1])
+    order = np.zeros(len(number), dtype=int)
+    route_length = np.zeros(len(number))
+
+    groups = {}
+    for k in np.unique(number):
+        stops = np.flatnonzero(number == k)+1  # 0番目は出発地
+        groups.setdefault(len(stops), []).append(stops)
+    for m, stops in groups.items():
+        if m <= EXACT_STOPS:
+            routes, lengths = route_exact(dist, np.array(stops))
+        else:
+            routes, lengths = zip(*[route_heuristic(dist, s) for s in stops])
+        for route, length in zip(routes, lengths):
+            order[np.asarray(route)-1] = np.arange(1, m+1)
+            route_length[np.asarray(route)-1] = length
+    return order, route_length
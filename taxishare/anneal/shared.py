@@ -0,0 +1,259 @@
+import os
+import json
+import time
+import logging
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+MODEL_VERSION = 1  # モデルの作り方を変えたら上げる
+KEY_COLUMNS = ['id', 'desitination_latitude', 'desitination_longitude', 'age', 'sex']
+
+
+def snapshot_key(df, *params):
+    """
+    利用者集団とモデルのパラメータからキャッシュのキーを求める。
+
+    Parameters
+    ----------
+    df: pandas.dataframe
+        標準化前の特徴量データフレーム
+    params: tuple
+        モデルのパラメータ（タクシー数など）
+
+    Returns
+    -------
+    key: str
+        ハッシュ値
+    """
+    cols = [c for c in KEY_COLUMNS+['birth_date'] if c in df]
+    digest = hashlib.sha1(repr((MODEL_VERSION, cols)+params).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df[cols], index=False).values.tobytes())
+    return digest.hexdigest()[:24]
+
+
+def to_dict(row, col, value, const):
+    """
+    非ゼロ要素の配列で持つqubitsの係数を、デジタルアニーラに投げる形式に変換する。
+
+    Parameters
+    ----------
+    row, col, value: numpy.ndarray
+        qubitの係数（非ゼロ要素）
+    const: float
+        定数
+
+    Returns
+    ----------
+    qubit_dict: dictionary
+        qubits係数の辞書
+    """
+    k1 = "coefficient"
+    k2 = "polynomials"
+    qubit_dict = [{k1: float(v), k2: [int(r), int(c)]} for r, c, v in zip(row, col, value)]
+    if const != 0:
+        qubit_dict.append({k1: float(const), k2: []})
+    return {'binary_polynomial': {'terms': qubit_dict}}
+
+
+def coefficients(model):
+    """
+    目的関数のqubitの係数を非ゼロ要素の配列で返す。
+
+    Parameters
+    ----------
+    model: modeling.CostFunction or SharedModel
+        目的関数
+
+    Returns
+    -------
+    row, col, value: numpy.ndarray
+        qubitの係数（非ゼロ要素）
+    """
+    if isinstance(model, SharedModel):
+        return np.asarray(model.row), np.asarray(model.col), np.asarray(model.value)
+    row, col = model.coefficient_array.nonzero()
+    return row.astype(np.int32), col.astype(np.int32), model.coefficient_array[row, col]
+
+
+class SharedModel(object):
+    """
+    メモリマップしたファイルから、作成済みのモデルを読み込む。
+    配列はコピーせず、同じキーを読み込んだプロセス間でページを共有する。
+
+    Attributes
+    ----------
+    user: int
+        利用者数
+    taxi: int
+        タクシー数
+    capacity: int
+        タクシー1台あたりの定員
+    fixed: dictionary
+        値を固定したqubit番号と固定値の辞書
+    const: float
+        定数
+    number_qubit: int
+        固定されていないqubit数
+    node_of: numpy.ndarray
+        利用者毎のノード番号（同じ地点の利用者をまとめていなければNone）
+    dist_array: numpy.memmap
+        データ間距離の上三角行列
+    row, col, value: numpy.memmap
+        qubitの係数（非ゼロ要素）
+    to_dict: method
+        qubitsの係数をデジタルアニーラに投げる形式に変換する。
+    """
+    ARRAYS = ('dist_array', 'row', 'col', 'value')
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.user = meta['user']
+        self.taxi = meta['taxi']
+        self.capacity = meta['capacity']
+        self.fixed = {int(k): v for k, v in meta['fixed'].items()}
+        self.const = meta['const']
+        self.number_qubit = meta['number_qubit']
+        for name in self.ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name+'.npy'), mmap_mode='r'))
+        node_path = os.path.join(path, 'node_of.npy')
+        self.node_of = np.load(node_path) if os.path.exists(node_path) else None
+
+    def to_dict(self):
+        """
+        qubitsの係数をデジタルアニーラに投げる形式に変換する。
+
+        Returns
+        ----------
+        qubit_dict: dictionary
+            qubits係数の辞書
+        """
+        return to_dict(self.row, self.col, self.value, self.const)
+
+
+def publish(cache_dir, key, dist_array, model):
+    """
+    作成したモデルをファイルに書き出す。
+    一時ディレクトリに書いてから名前を変えるので、読み込み側が書きかけを見ることはない。
+
+    Parameters
+    ----------
+    cache_dir: str
+        キャッシュのディレクトリ
+    key: str
+        キャッシュのキー
+    dist_array: numpy.ndarray
+        データ間距離の上三角行列
+    model: CostFunction
+        初期化済みの目的関数
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key)
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.'+key)
+    row, col, value = coefficients(model)
+    arrays = {
+        'dist_array': np.ascontiguousarray(dist_array, dtype=np.float64),
+        'row': row,
+        'col': col,
+        'value': value,
+    }
+    if model.node_of is not None:
+        arrays['node_of'] = np.asarray(model.node_of)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp, name+'.npy'), array)
+    meta = {
+        'user': model.user,
+        'taxi': model.taxi,
+        'capacity': model.capacity,
+        'fixed': {str(k): int(v) for k, v in model.fixed.items()},
+        'const': float(model.const),
+        'number_qubit': model.number_qubit,
+    }
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    try:
+        os.rename(tmp, path)
+    except OSError:  # 他のプロセスが先に書き出した
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def attach(cache_dir, key):
+    """
+    作成済みのモデルを読み込む。無ければNoneを返す。
+    読み込む前に更新日時を現在時刻にし、使われているモデルをpurgeが削除しないようにする。
+    それでも読み込みの途中で削除されたら、無かったものとして扱う。
+    """
+    path = os.path.join(cache_dir, key)
+    try:
+        os.utime(path)
+        return SharedModel(path)
+    except FileNotFoundError:
+        return None
+
+
+def get_or_build(cache_dir, key, builder):
+    """
+    作成済みのモデルを読み込み、無ければ作成して書き出す。
+    書き出したモデルを読み込めなかったとき（書き出した直後に削除された、書き出せなかったなど）は、
+    作成したモデルをそのまま返す。
+
+    Parameters
+    ----------
+    cache_dir: str
+        キャッシュのディレクトリ
+    key: str
+        キャッシュのキー
+    builder: function
+        (dist_array, model)を返す関数
+
+    Returns
+    -------
+    dist_array: numpy.ndarray or numpy.memmap
+        データ間距離の上三角行列
+    model: SharedModel or CostFunction
+        読み込んだモデル（読み込めなければ作成したモデル）
+    """
+    model = attach(cache_dir, key)
+    if model is not None:
+        return model.dist_array, model
+    dist_array, built = builder()
+    try:
+        publish(cache_dir, key, dist_array, built)
+    except OSError:
+        logger.exception('failed to publish model %s.', key)
+        return dist_array, built
+    model = attach(cache_dir, key)
+    if model is None:
+        return dist_array, built
+    return model.dist_array, model
+
+
+def purge(cache_dir, max_age):
+    """
+    一定時間より前に書き出した（または最後に読み込んだ）モデルを削除する。
+
+    Parameters
+    ----------
+    cache_dir: str
+        キャッシュのディレクトリ
+    max_age: float
+        残す期間（秒）
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    limit = time.time()-max_age
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            expired = os.path.getmtime(path) < limit
+        except FileNotFoundError:  # 他のプロセスが先に削除した
+            continue
+        if expired:
+            shutil.rmtree(path, ignore_errors=True)
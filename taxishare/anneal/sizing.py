@@ -0,0 +1,118 @@
+import math
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+CAPACITY = 4  # タクシー1台あたりの定員
+HEADROOM = 1  # 最小台数に加える予備台数
+BASE_TAXI = 15  # 従来の固定タクシー数
+BASE_SLACK = 5  # 従来のタクシー毎のスラックビット数（one-hot）
+
+
+def calc_taxi_number(user, capacity=CAPACITY, headroom=HEADROOM):
+    """
+    定員から必要最小限のタクシー数を求める。
+
+    Parameters
+    ----------
+    user: int
+        利用者数
+    capacity: int
+        タクシー1台あたりの定員
+    headroom: int
+        最小台数に加える予備台数
+
+    Returns
+    -------
+    taxi: int
+        タクシー数（利用者数を超えない）
+    """
+    taxi = math.ceil(user/capacity)+headroom
+    return max(1, min(taxi, user))
+
+
+def slack_weights(capacity=CAPACITY, encoding='log'):
+    """
+    容量制約のスラック変数の重みを求める。
+
+    Parameters
+    ----------
+    capacity: int
+        タクシー1台あたりの定員
+    encoding: str
+        'unary'ならone-hot（0〜capacityの各値に1bit）、
+        'log'なら上限付き2進数（1, 2, 4, ..., 端数）
+
+    Returns
+    -------
+    weights: list
+        スラックビット毎の重み
+    """
+    if encoding == 'unary':
+        return list(range(capacity+1))
+    elif encoding == 'log':
+        weights = []
+        w = 1
+        while sum(weights)+w <= capacity:
+            weights.append(w)
+            w *= 2
+        rest = capacity-sum(weights)
+        if rest > 0:
+            weights.append(rest)
+        return weights
+    raise ValueError('unknown encoding: {}'.format(encoding))
+
+
+def symmetry_fixed(user, taxi):
+    """
+    タクシー番号の入れ替え対称性を取り除くために固定するqubitを求める。
+    利用者iはタクシー0〜iにしか乗らないものとし、利用者0はタクシー0に固定する。
+
+    Parameters
+    ----------
+    user: int
+        利用者数
+    taxi: int
+        タクシー数
+
+    Returns
+    -------
+    fixed: dictionary
+        qubit番号と固定値の辞書
+    """
+    fixed = {user*k: 0 for k in range(1, taxi)}  # 利用者0のタクシー1以降
+    fixed[0] = 1  # 利用者0はタクシー0
+    for i in range(1, user):
+        for k in range(i+1, taxi):
+            fixed[user*k+i] = 0
+    return fixed
+
+
+def report(user, model):
+    """
+    従来のモデルと比べたqubit数の削減量を記録する。
+
+    Parameters
+    ----------
+    user: int
+        利用者数
+    model: CostFunction
+        初期化済みの目的関数
+
+    Returns
+    -------
+    size_report: dictionary
+        従来qubit数、今回qubit数、削減率
+    """
+    base_qubit = (user+BASE_SLACK)*BASE_TAXI
+    size_report = {
+        'user': user,
+        'taxi': model.taxi,
+        'base_qubit': base_qubit,
+        'qubit': model.number_qubit,
+        'reduction': 1-model.number_qubit/base_qubit,
+    }
+    logger.info('qubits %(base_qubit)d -> %(qubit)d (taxi=%(taxi)d, -%(reduction).0f%%)',
+                dict(size_report, reduction=100*size_report['reduction']))
+    return size_report
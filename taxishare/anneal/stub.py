@@ -0,0 +1,115 @@
+import copy
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+
+from taxishare.anneal import tabu
+
+try:
+    from aiohttp import web
+except ImportError:  # スタブサーバーを動かすときだけ必要
+    web = None
+
+
+def make_app(latency=0.0, solver=None, forward_params=False):
+    """
+    デジタルアニーラのAPIを真似るスタブサーバーを作る。
+    指定した待ち時間のあと、ローカルのソルバーで解いて同じ形式で返す。
+    forward_paramsなら、依頼のパラメータ（fujitsuDAPT）のうちローカルのソルバーにもあるものを使う。
+
+    Parameters
+    ----------
+    latency: float
+        応答までに入れる待ち時間（秒）
+    solver: class
+        minimize(qubit_dict)でResponseを返すソルバー（省略時はタブー探索）
+    forward_params: bool
+        依頼のパラメータをローカルのソルバーに渡すかどうか
+
+    Returns
+    -------
+    app: aiohttp.web.Application
+        スタブサーバー
+    """
+    if web is None:
+        raise ImportError('stub server requires aiohttp.')
+    solver = solver or tabu.TabuSolver()
+
+    async def solve(request):
+        started = time.perf_counter()
+        body = await request.json()
+        await asyncio.sleep(latency)
+        qubit_dict = {'binary_polynomial': body['binary_polynomial']}
+        local = solver
+        if forward_params:
+            local = copy.deepcopy(solver)
+            local.params.update({k: v for k, v in body.get('fujitsuDAPT', {}).items() if k in local.params})
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(None, local.minimize, qubit_dict)
+        elapsed = int((time.perf_counter()-started)*1000)
+        return web.json_response({'qubo_solution': {
+            'result_status': True,
+            'solutions': [{
+                'configuration': {str(k): bool(v) for k, v in response.config.items()},
+                'energy': response.energy,
+            }],
+            'timing': dict(response.timing, total_elapsed_time=elapsed),
+        }})
+
+    app = web.Application(client_max_size=1024**3)
+    app.router.add_post('/v1/qubo/solve', solve)
+    return app
+
+
+async def start(latency=0.0, host='127.0.0.1', port=0, solver=None, forward_params=False):
+    """
+    スタブサーバーを起動する。
+
+    Returns
+    -------
+    runner: aiohttp.web.AppRunner
+        停止するときにcleanup()を呼ぶ
+    url: str
+        DAPTSolver.urlに設定するURL
+    """
+    runner = web.AppRunner(make_app(latency, solver, forward_params))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, 'http://{}:{}'.format(host, port)
+
+
+@contextmanager
+def serve(latency=0.0, solver=None, forward_params=False):
+    """
+    スタブサーバーを別スレッドのイベントループで起動し、抜けるときに止める。
+
+    Parameters
+    ----------
+    latency: float
+        応答までに入れる待ち時間（秒）
+    solver: object
+        minimize(qubit_dict)でResponseを返すソルバー（省略時はタブー探索）
+    forward_params: bool
+        依頼のパラメータをローカルのソルバーに渡すかどうか
+
+    Yields
+    ------
+    url: str
+        DAPTSolver.urlに設定するURL
+    """
+    if web is None:
+        raise ImportError('stub server requires aiohttp.')
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name='dapt-stub', daemon=True)
+    thread.start()
+    runner, url = asyncio.run_coroutine_threadsafe(start(latency, solver=solver, forward_params=forward_params), loop).result()
+    try:
+        yield url
+    finally:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
@@ -0,0 +1,192 @@
+import time
+
+import numpy as np
+
+from taxishare.anneal import kernels
+from taxishare.anneal.kernels import jit, _flip_numba, _flip_numpy
+
+
+@jit
+def _tabu_numba(x, field, indptr, indices, data, iterations, tenure, restart, perturb, seed):
+    np.random.seed(seed)
+    n = len(x)
+    tabu_until = np.zeros(n, dtype=np.int64)
+    energy = 0.0
+    best = 0.0
+    best_x = x.copy()
+    last_improved = 0
+    for it in range(iterations):
+        # 禁止されていない（または最良解を更新する）ビットのうち、エネルギー変化最小のものを選ぶ
+        k = -1
+        k_gain = np.inf
+        for i in range(n):
+            gain = (1-2*x[i])*field[i]
+            if gain < k_gain and (tabu_until[i] <= it or energy+gain < best-1e-12):
+                k = i
+                k_gain = gain
+        if k < 0:
+            continue
+        _flip_numba(k, x, field, indptr, indices, data)
+        energy += k_gain
+        tabu_until[k] = it+tenure
+        if energy < best-1e-12:
+            best = energy
+            best_x[:] = x
+            last_improved = it
+        elif it-last_improved >= restart:
+            # 最良解の一部のビットを反転して探索をやり直す
+            for i in range(n):
+                if x[i] != best_x[i]:
+                    energy += (1-2*x[i])*field[i]
+                    _flip_numba(i, x, field, indptr, indices, data)
+            for i in range(n):
+                if np.random.random() < perturb:
+                    energy += (1-2*x[i])*field[i]
+                    _flip_numba(i, x, field, indptr, indices, data)
+            tabu_until[:] = 0
+            last_improved = it
+    return best_x, best
+
+
+def _tabu_numpy(x, field, indptr, indices, data, iterations, tenure, restart, perturb, seed):
+    rng = np.random.default_rng(seed)
+    n = len(x)
+    tabu_until = np.zeros(n, dtype=np.int64)
+    energy = 0.0
+    best = 0.0
+    best_x = x.copy()
+    last_improved = 0
+
+    def flip(i, energy):
+        energy += (1-2*x[i])*field[i]
+        _flip_numpy(i, x, field, indptr, indices, data)
+        return energy
+
+    for it in range(iterations):
+        # 禁止されていない（または最良解を更新する）ビットのうち、エネルギー変化最小のものを選ぶ
+        gain = (1-2*x)*field
+        allowed = (tabu_until <= it) | (energy+gain < best-1e-12)
+        if not allowed.any():
+            continue
+        k = int(np.argmin(np.where(allowed, gain, np.inf)))
+        energy = flip(k, energy)
+        tabu_until[k] = it+tenure
+        if energy < best-1e-12:
+            best = energy
+            best_x[:] = x
+            last_improved = it
+        elif it-last_improved >= restart:
+            # 最良解の一部のビットを反転して探索をやり直す
+            for i in np.flatnonzero(x != best_x):
+                energy = flip(i, energy)
+            for i in np.flatnonzero(rng.random(n) < perturb):
+                energy = flip(i, energy)
+            tabu_until[:] = 0
+            last_improved = it
+    return best_x, best
+
+
+TABU_KERNELS = {
+    'numpy': _tabu_numpy,
+}
+if kernels.numba is not None:
+    TABU_KERNELS['numba'] = _tabu_numba
+
+
+class TabuSolver(object):
+    """
+    ローカルでタブー探索を行うソルバー情報を保持する。
+    qubit毎の反転によるエネルギー変化（局所場）を保持し、反転毎に結合先だけ更新する。
+
+    Attributes
+    ----------
+    backend: str
+        カーネルの実装（'numba' or 'numpy'）
+    params: dictionary
+        パラメータ
+    stop: threading.Event
+        打ち切りの合図（Noneなら最後まで計算する）
+    minimize: method
+        タブー探索で計算する。
+    search: method
+        1つの試行を計算する。
+    """
+    def __init__(self, backend=None):
+        self.backend = backend or kernels.BACKEND
+        self.stop = None
+        self.params = {}
+        self.params['number_iterations'] = 20_000  # 反転回数
+        self.params['number_replicas'] = 2  # 独立な試行回数
+        self.params['tenure'] = None  # 反転を禁止する期間（省略時はqubit数から決める）
+        # 最良解が更新されないときにやり直すまでの反転回数
+        # （2000では数十qubitの問題でも同じ局所解に留まりやすく、利用者4〜8人で厳密解に届く割合が1〜8割だった）
+        self.params['restart'] = 200
+        self.params['perturbation'] = 0.1  # やり直し時に反転するビットの割合
+        self.params['seed'] = 0
+
+    def minimize(self, qubit_dict):
+        """
+        タブー探索で計算する。
+
+        Parameters
+        ----------
+        qubit_dict: dictionary
+            qubits係数の辞書
+
+        Returns
+        -------
+        Response: class
+            デジタルアニーラの戻り値と同じ形式の結果
+        """
+        started = time.perf_counter()
+        qubo = kernels.SparseQUBO.from_dict(qubit_dict)
+        rng = np.random.default_rng(self.params['seed'])
+        best_x, best = None, np.inf
+        for replica in range(self.params['number_replicas']):
+            if replica and self.stop is not None and self.stop.is_set():
+                break
+            x = rng.integers(0, 2, qubo.n).astype(np.int64)
+            x, energy = self.search(qubo, x, self.params['seed']+replica)
+            if energy < best:
+                best_x, best = x, energy
+        return kernels.to_response(best_x, best, time.perf_counter()-started)
+
+    def search(self, qubo, x, seed):
+        """
+        初期状態からタブー探索を行う。
+        stopがあれば、やり直しの間隔（restart）毎に区切って計算し、区切り毎に打ち切りの合図を確認する。
+
+        Parameters
+        ----------
+        qubo: kernels.SparseQUBO
+            CSR形式のQUBO
+        x: numpy.ndarray
+            初期状態
+        seed: int
+            乱数シード
+
+        Returns
+        -------
+        best_x: numpy.ndarray
+            最良の状態
+        best_energy: float
+            最良のエネルギー
+        """
+        tenure = self.params['tenure'] or max(1, min(20, qubo.n//4))
+        kernel = TABU_KERNELS[self.backend]
+        field = qubo.local_field(x)
+        start = qubo.energy(x)
+        iterations = self.params['number_iterations']
+        chunk = iterations if self.stop is None else max(1, self.params['restart'])
+        # 状態と局所場はカーネルの中で更新されるので、区切りをまたいでそのまま引き継ぐ
+        best_x, best = x.copy(), start
+        for k, offset in enumerate(range(0, iterations, chunk)):
+            if self.stop is not None and self.stop.is_set():
+                break
+            energy = start if k == 0 else qubo.energy(x)
+            chunk_x, chunk_best = kernel(x, field, qubo.indptr, qubo.indices, qubo.data,
+                                         min(chunk, iterations-offset), tenure, self.params['restart'],
+                                         self.params['perturbation'], seed+k)
+            if energy+chunk_best < best:
+                best_x, best = chunk_x, energy+chunk_best
+        return best_x, best
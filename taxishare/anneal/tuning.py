@@ -0,0 +1,247 @@
+import os
+import json
+import math
+import time
+import hashlib
+import itertools
+import threading
+from collections import defaultdict
+
+import numpy as np
+
+from taxishare.anneal.batching import count_qubit
+
+
+HISTORY = 'history.jsonl'
+POLICY = 'policy.json'
+ENERGY_TOLERANCE = 0.01  # 最良のエネルギーからこの割合以内なら十分よいとみなす
+SUCCESS_RATE = 0.9  # 選ぶパラメータに求める、実行可能で十分よい解に届いた割合
+MIN_SAMPLES = 3  # パラメータを選ぶのに必要な記録数
+HISTORY_MAX_BYTES = 16*1024*1024  # 記録がこの大きさを超えたら1世代前に回す
+
+# ソルバー毎に試すパラメータの候補
+GRIDS = {
+    'dapt': {
+        'number_iterations': [10_000, 30_000, 100_000, 300_000],
+        'number_replicas': [16, 32, 64, 100],
+        'offset_increase_rate': [100, 1000],
+    },
+    'sa': {
+        'number_iterations': [1000, 2000, 4000, 8000],
+        'number_replicas': [4, 8, 16],
+    },
+    'tabu': {
+        'number_iterations': [1000, 5000, 20_000],
+        'number_replicas': [1, 2],
+    },
+}
+
+
+def size_bucket(number_qubit):
+    """
+    qubit数を2のべき乗の区間にまとめる。
+    """
+    return 1 << max(0, math.ceil(math.log2(max(number_qubit, 1))))
+
+
+def describe(qubit_dict):
+    """
+    qubits係数の辞書から、qubit数、非ゼロ係数の数、問題のキーを求める。
+    """
+    terms = qubit_dict['binary_polynomial']['terms']
+    digest = hashlib.sha1(json.dumps(terms, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return count_qubit(qubit_dict), len(terms), digest
+
+
+def candidates(engine):
+    """
+    ソルバーのパラメータの候補を全て返す。
+    """
+    grid = GRIDS.get(engine, {})
+    keys = sorted(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[k] for k in keys])]
+
+
+def read_history(path):
+    """
+    記録を1世代前（path.1）から順に1件ずつ返す。壊れた行は飛ばす。
+    """
+    for p in [path+'.1', path]:
+        try:
+            f = open(p, encoding='utf-8')
+        except FileNotFoundError:
+            continue
+        with f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def fit(records, success_rate=SUCCESS_RATE, min_samples=MIN_SAMPLES, tolerance=ENERGY_TOLERANCE):
+    """
+    記録から、ソルバー・問題の大きさ毎に、実行可能で最良に近い解に届いた中で最も速いパラメータを選ぶ。
+
+    Parameters
+    ----------
+    records: list
+        記録（describe, パラメータ, エネルギー, 実行可能性, 計算時間）のリスト
+    success_rate: float
+        選ぶパラメータに求める、実行可能で十分よい解に届いた割合
+    min_samples: int
+        パラメータを選ぶのに必要な記録数
+    tolerance: float
+        最良のエネルギーからこの割合以内なら十分よいとみなす
+
+    Returns
+    -------
+    policy: dictionary
+        {ソルバー名: {区間: {'params', 'success', 'elapsed', 'samples'}}}
+    """
+    records = list(records)
+    best = {}
+    for r in records:
+        if r['feasible']:
+            key = (r['engine'], r['problem'])
+            best[key] = min(best.get(key, np.inf), r['energy'])
+
+    groups = defaultdict(list)
+    for r in records:
+        b = best.get((r['engine'], r['problem']))
+        good = r['feasible'] and b is not None and r['energy'] <= b+tolerance*abs(b)+1e-9
+        params = json.dumps(r['params'], sort_keys=True)
+        groups[r['engine'], size_bucket(r['qubits']), params].append((good, r['elapsed']))
+
+    policy = {}
+    for (engine, bucket, params), results in groups.items():
+        if len(results) < min_samples:
+            continue
+        success = float(np.mean([good for good, _ in results]))
+        if success < success_rate:
+            continue
+        elapsed = float(np.median([e for _, e in results]))
+        current = policy.setdefault(engine, {}).get(str(bucket))
+        if current is None or elapsed < current['elapsed']:
+            policy[engine][str(bucket)] = {
+                'params': json.loads(params), 'success': success, 'elapsed': elapsed, 'samples': len(results)}
+    return policy
+
+
+class Tuner(object):
+    """
+    ソルバーの計算毎に記録を残し、記録から選んだパラメータを返す。
+
+    Attributes
+    ----------
+    directory: str
+        記録（history.jsonl）と選んだパラメータ（policy.json）のディレクトリ
+    max_bytes: int
+        記録の大きさの上限（超えたら1世代前のhistory.jsonl.1に回し、それより古い記録は捨てる）
+    params_for: method
+        問題の大きさに合ったパラメータを返す。
+    record: method
+        1回の計算を記録する。
+    refit: method
+        記録からパラメータを選び直して書き出す。
+    """
+    def __init__(self, directory, max_bytes=HISTORY_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.history_path = os.path.join(directory, HISTORY)
+        self.policy_path = os.path.join(directory, POLICY)
+        self.policy = {}
+        self.policy_mtime = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        選んだパラメータを読み込む。書き換えられていたら読み直す。
+        """
+        try:
+            mtime = os.path.getmtime(self.policy_path)
+        except OSError:
+            return self.policy
+        if mtime != self.policy_mtime:
+            with open(self.policy_path, encoding='utf-8') as f:
+                self.policy = json.load(f)
+            self.policy_mtime = mtime
+        return self.policy
+
+    def params_for(self, engine, number_qubit):
+        """
+        問題の大きさに合ったパラメータを返す。
+        同じ区間が無ければ最も近い区間のものを使い、どの区間も無ければ空の辞書を返す。
+
+        Parameters
+        ----------
+        engine: str
+            ソルバー名
+        number_qubit: int
+            qubit数
+
+        Returns
+        -------
+        params: dictionary
+            ソルバーのパラメータの上書き
+        """
+        buckets = self.load().get(engine, {})
+        if not buckets:
+            return {}
+        target = math.log2(size_bucket(number_qubit))
+        bucket = min(buckets, key=lambda b: abs(math.log2(int(b))-target))
+        return dict(buckets[bucket]['params'])
+
+    def record(self, engine, qubit_dict, params, energy, feasible, elapsed):
+        """
+        1回の計算を記録する。
+
+        Parameters
+        ----------
+        engine: str
+            ソルバー名
+        qubit_dict: dictionary
+            qubits係数の辞書
+        params: dictionary
+            使ったパラメータ
+        energy: float
+            エネルギー
+        feasible: bool
+            制約を満たしたかどうか
+        elapsed: float
+            計算時間（秒）
+        """
+        qubits, nonzeros, problem = describe(qubit_dict)
+        line = json.dumps({
+            'time': time.time(),
+            'engine': engine,
+            'qubits': qubits,
+            'nonzeros': nonzeros,
+            'problem': problem,
+            'params': {k: params[k] for k in GRIDS.get(engine, params) if k in params},
+            'energy': float(energy),
+            'feasible': bool(feasible),
+            'elapsed': float(elapsed),
+        })
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.history_path, 'a', encoding='utf-8') as f:
+                f.write(line+'\n')
+                size = f.tell()
+            if self.max_bytes is not None and size > self.max_bytes:
+                try:
+                    os.replace(self.history_path, self.history_path+'.1')
+                except FileNotFoundError:  # 他のプロセスが先に回した
+                    pass
+
+    def refit(self, **options):
+        """
+        記録からパラメータを選び直して書き出す。
+        """
+        policy = fit(read_history(self.history_path), **options)
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self.policy_path+'.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(policy, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.policy_path)
+        return policy
@@ -4,3 +4,6 @@ from django.db.models.signals import post_migrate
 
 class TaxishareConfig(AppConfig):
     name = 'taxishare'
+
+    def ready(self):
+        from . import signals  # noqa: F401 利用者の保存・削除でスナップショットを作り直す
@@ -0,0 +1,390 @@
+import datetime
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+from django.conf import settings
+from django.core.mail import send_mail
+from django.db import connections, transaction
+from django.db.models import F, Max
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django_pandas.io import read_frame
+
+from .models import Taxi, RiderSnapshot, DispatchRun, Vehicle, FeatureStatistic
+from . import admission
+from taxishare.anneal import main, routing, tuning, fleet, archive
+
+
+logger = logging.getLogger(__name__)
+
+# 配車依頼をまとめる時間幅（秒）
+WINDOW_SECONDS = getattr(settings, 'DISPATCH_WINDOW_SECONDS', 60*5)
+# 出発地毎の配車処理を並行して行うワーカー数
+WORKERS = getattr(settings, 'DISPATCH_WORKERS', 4)
+# 配車に使うソルバー（'auto', 'dapt', 'sa', 'tabu', 'exact', 'local'）
+ENGINE = getattr(settings, 'DISPATCH_ENGINE', 'auto')
+# 作成したQUBOをプロセス間で共有するディレクトリ（Noneなら共有しない）
+MODEL_CACHE = getattr(settings, 'DISPATCH_MODEL_CACHE', None)
+# QUBOで解くとき、バッチをまとめて1回でソルバーに投げるかどうか
+BATCH_QUBO = getattr(settings, 'DISPATCH_BATCH_QUBO', True)
+# バッチ毎の配車処理の期限（秒）。Noneなら選んだソルバーの結果を待つ
+BUDGET_SECONDS = getattr(settings, 'DISPATCH_BUDGET_SECONDS', None)
+# 配車処理の入力と結果を保存するディレクトリ（Noneなら保存しない）
+ARCHIVE_DIR = getattr(settings, 'DISPATCH_ARCHIVE_DIR', None)
+# 保存するファイル数の上限（配車の度に古いものから削除する）
+ARCHIVE_MAX_FILES = getattr(settings, 'DISPATCH_ARCHIVE_MAX_FILES', 10000)
+# QUBOソルバーの計算の記録とパラメータの選択を行うディレクトリ（Noneなら既定のパラメータで解く）
+TUNING_DIR = getattr(settings, 'DISPATCH_TUNING_DIR', None)
+# 計算の記録の大きさの上限（バイト）
+TUNING_MAX_BYTES = getattr(settings, 'DISPATCH_TUNING_MAX_BYTES', tuning.HISTORY_MAX_BYTES)
+TUNER = None if TUNING_DIR is None else tuning.Tuner(TUNING_DIR, TUNING_MAX_BYTES)
+# 残す公開済みの版の数（古い版を読んでいる途中の読み手のため）
+KEEP_RUNS = getattr(settings, 'DISPATCH_KEEP_RUNS', 3)
+# 古い版の行を1回に削除する行数
+GC_BATCH = getattr(settings, 'DISPATCH_GC_BATCH', 1000)
+# 特徴量を利用者全体の統計量で標準化するかどうか（Falseならバッチの中で標準化する）
+GLOBAL_NORMALIZATION = getattr(settings, 'DISPATCH_GLOBAL_NORMALIZATION', True)
+# 空車を割り当てる迎車距離の上限（km）。Noneなら上限なし
+MAX_PICKUP_KM = getattr(settings, 'DISPATCH_MAX_PICKUP_KM', None)
+# 配車処理の次の計算を待つ依頼数の上限（超えたら断って公開済みの結果を使う）
+QUEUE_LIMIT = getattr(settings, 'DISPATCH_QUEUE_LIMIT', 100)
+# taxi_searchが配車結果を待つ期限（秒）。過ぎたら公開済みの結果を表示する
+DEADLINE_SECONDS = getattr(settings, 'DISPATCH_DEADLINE_SECONDS', 10)
+# 受け付けた配車処理を同時に計算するワーカースレッドの数
+ADMISSION_WORKERS = getattr(settings, 'DISPATCH_ADMISSION_WORKERS', 1)
+# 他の配車処理が書き込み中だったとき、受け付けた配車処理をやり直すまでの間隔（秒）
+CLAIM_RETRY_SECONDS = 0.1
+# QUBOで解くとき、目的地を寄せてまとめる格子の一辺（m、Noneならまとめない）
+SNAP_METERS = getattr(settings, 'DISPATCH_SNAP_METERS', None)
+
+
+def pending_riders(now=None, window=None):
+    """
+    時間幅内に地点情報を更新し、まだ配車されていない利用者を返す。
+
+    Parameters
+    ----------
+    now: datetime.datetime
+        基準時刻（省略時は現在時刻）
+    window: int
+        時間幅（秒）
+
+    Returns
+    -------
+    snapshot_table: QuerySet
+        配車依頼日時順の利用者スナップショット
+    """
+    now = now or timezone.now()
+    window = window or WINDOW_SECONDS
+    snapshot_table = RiderSnapshot.objects.filter(
+        requested_at__gt=now-datetime.timedelta(seconds=window),
+        requested_at__lte=now,
+    )
+    # 依頼後に配車済みの利用者は除く
+    snapshot_table = snapshot_table.exclude(user__taxi__dispatched_at__gte=F('requested_at'))
+    return snapshot_table.order_by('requested_at', 'user_id')
+
+
+def read_riders(snapshot_table):
+    """
+    利用者スナップショットを特徴量データフレームにする。
+
+    Parameters
+    ----------
+    snapshot_table: QuerySet
+        利用者スナップショット
+
+    Returns
+    -------
+    df_of_user_table: pandas.dataframe
+        利用者毎の出発地と特徴量
+    """
+    cols = ['user_id', 'origin_latitude', 'origin_longitude',
+            'desitination_latitude', 'desitination_longitude', 'sex', 'age']  # 抽出するカラム
+    df_of_user_table = read_frame(snapshot_table, fieldnames=cols, verbose=False)
+    return df_of_user_table.rename(columns={'user_id': 'id'})
+
+
+def partition(df_of_user_table):
+    """
+    利用者を出発地毎に分け、1回に処理できる人数ずつのバッチにする。
+
+    Parameters
+    ----------
+    df_of_user_table: pandas.dataframe
+        利用者毎の出発地と特徴量
+
+    Returns
+    -------
+    batches: list
+        バッチ毎の特徴量データフレーム
+    """
+    batches = []
+    for _, origin_df in df_of_user_table.groupby(['origin_latitude', 'origin_longitude'], sort=False):
+        for start in range(0, len(origin_df), main.UPPER_USER):
+            batches.append(origin_df.iloc[start:start+main.UPPER_USER].reset_index(drop=True))
+    return batches
+
+
+def solve(batches, stats=None):
+    """
+    バッチ毎のアニーリング処理を、ワーカーで並行して行う。
+    QUBOで解く場合は、ブロック対角にまとめて1回でソルバーに投げる。
+
+    Parameters
+    ----------
+    batches: list
+        バッチ毎の特徴量データフレーム
+    stats: preparations.RunningStats
+        利用者全体の特徴量の統計量（省略時はバッチの中で標準化する）
+
+    Returns
+    -------
+    number_lists: list
+        バッチ毎の配車番号リスト
+    """
+    if BATCH_QUBO and ENGINE in main.QUBO_SOLVERS and len(batches) > 1:
+        return main.main_many(batches, ENGINE, MODEL_CACHE, archive_dir=ARCHIVE_DIR, stats=stats, snap=SNAP_METERS)
+    solve_batch = partial(main.main, engine=ENGINE, cache_dir=MODEL_CACHE, budget=BUDGET_SECONDS,
+                          archive_dir=ARCHIVE_DIR, tuner=TUNER, stats=stats, snap=SNAP_METERS)
+    if len(batches) <= 1:
+        return [solve_batch(df) for df in batches]
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        return list(executor.map(solve_batch, batches))
+
+
+def route(df, number_list):
+    """
+    バッチの配車結果から、タクシー毎の降車順と経路長を求める。
+    バッチの利用者は全員同じ出発地から乗る。
+
+    Parameters
+    ----------
+    df: pandas.dataframe
+        バッチの特徴量データフレーム
+    number_list: numpy.ndarray
+        配車番号リスト
+
+    Returns
+    -------
+    order: numpy.ndarray
+        利用者毎の降車順
+    route_length: numpy.ndarray
+        利用者毎の、乗るタクシーの経路長（km）
+    """
+    origin = (df['origin_latitude'].iloc[0], df['origin_longitude'].iloc[0])
+    destinations = df[['desitination_latitude', 'desitination_longitude']].values
+    return routing.plan(origin, destinations, number_list)
+
+
+def save(run, batches, number_lists):
+    """
+    バッチ毎の配車結果を降車順とともに書き込み中の版に追加する。
+    再依頼した利用者の以前の行は、この版で置き換えたことにする（公開するまでは見えない）。
+
+    Parameters
+    ----------
+    run: DispatchRun
+        書き込み中の版
+    batches: list
+        バッチ毎の特徴量データフレーム
+    number_lists: list
+        バッチ毎の配車番号リスト
+
+    Returns
+    -------
+    taxis: list
+        今回登録したTaxi
+    """
+    now = timezone.now()
+    taxis = []
+    # 以前の版と配車番号が重ならないようにずらす
+    offset = Taxi.objects.aggregate(number=Max('number'))['number']
+    offset = 0 if offset is None else offset+1
+    user_id_list = []
+    for df, number_list in zip(batches, number_lists):
+        batch_user_id_list = df['id'].values.tolist()
+        user_id_list.extend(batch_user_id_list)
+        order, route_length = route(df, number_list)
+        points = df[['origin_latitude', 'origin_longitude', 'desitination_latitude', 'desitination_longitude']].values
+        taxis.extend(Taxi(run=run, user_id=user_id, number=offset+int(number_list[i]), dispatched_at=now,
+                          order=int(order[i]), route_length=float(route_length[i]),
+                          origin_latitude=float(points[i, 0]), origin_longitude=float(points[i, 1]),
+                          desitination_latitude=float(points[i, 2]), desitination_longitude=float(points[i, 3]))
+                     for i, user_id in enumerate(batch_user_id_list))
+        offset += int(max(number_list))+1
+    assign_vehicles(batches, taxis)
+    with transaction.atomic():
+        Taxi.objects.bulk_create(taxis)
+        Taxi.objects.filter(user_id__in=user_id_list, replaced_in__isnull=True).exclude(run=run).update(
+            replaced_in=run)
+    return taxis
+
+
+def assign_vehicles(batches, taxis):
+    """
+    配車番号（タクシー）毎に、迎車距離の総和が最小になるように空車を1台ずつ割り当てる。
+    空車が足りなければ、残りのタクシーには車両を割り当てない。
+
+    Parameters
+    ----------
+    batches: list
+        バッチ毎の特徴量データフレーム（バッチの利用者は全員同じ出発地から乗る）
+    taxis: list
+        今回登録するTaxi（batchesの順）。vehicle_idを設定する
+    """
+    vehicles = list(Vehicle.objects.filter(is_available=True).values_list('pk', 'latitude', 'longitude', 'capacity'))
+    if not vehicles or not taxis:
+        return
+    origins = np.concatenate([df[['origin_latitude', 'origin_longitude']].values for df in batches])
+    number = np.array([taxi.number for taxi in taxis])
+    groups, first, size = np.unique(number, return_index=True, return_counts=True)
+    vehicle_id, vehicle_lat, vehicle_lon, capacity = map(np.array, zip(*vehicles))
+    vehicle, _ = fleet.assign(origins[first, 0], origins[first, 1], size, vehicle_lat, vehicle_lon, capacity,
+                              MAX_PICKUP_KM)
+    group_vehicle = dict(zip(groups.tolist(), vehicle.tolist()))
+    for taxi in taxis:
+        v = group_vehicle[taxi.number]
+        taxi.vehicle_id = None if v == fleet.UNASSIGNED else int(vehicle_id[v])
+
+
+def release_vehicles(run):
+    """
+    版runで置き換えた行に割り当てていた車両のうち、まだ見えている行で使っていないものを空車に戻す。
+    （再依頼で乗るタクシーが変わった利用者の以前の車両を、同乗者がいなければ次の配車で使えるようにする）
+
+    Parameters
+    ----------
+    run: DispatchRun
+        公開した版
+
+    Returns
+    -------
+    released: int
+        空車に戻した車両数
+    """
+    replaced = set(Taxi.objects.filter(replaced_in=run, vehicle__isnull=False).values_list('vehicle_id', flat=True))
+    if not replaced:
+        return 0
+    busy = set(Taxi.objects.filter(vehicle_id__in=replaced, replaced_in__isnull=True).values_list(
+        'vehicle_id', flat=True))
+    return Vehicle.objects.filter(pk__in=replaced-busy).update(is_available=True)
+
+
+def collect_garbage(keep=KEEP_RUNS, batch=GC_BATCH):
+    """
+    新しいkeep個の版から見えなくなった行と、行の無くなった古い版を、batch行ずつ削除する。
+    古い版を読んでいる途中の読み手のために、直近の版は残す。
+
+    Parameters
+    ----------
+    keep: int
+        残す公開済みの版の数
+    batch: int
+        1回の削除で消す行数
+
+    Returns
+    -------
+    deleted: int
+        削除した行数
+    """
+    cutoff = DispatchRun.objects.filter(status=DispatchRun.PUBLISHED).order_by('-pk').values_list(
+        'pk', flat=True)[keep-1:keep].first()
+    if cutoff is None:
+        return 0
+    deleted = 0
+    while True:
+        # 1回の削除を短くして、書き込みのロックを長く持たない
+        pk_list = list(Taxi.objects.filter(replaced_in__lte=cutoff).values_list('pk', flat=True)[:batch])
+        if not pk_list:
+            break
+        deleted += Taxi.objects.filter(pk__in=pk_list).delete()[0]
+    DispatchRun.objects.filter(pk__lt=cutoff, status=DispatchRun.PUBLISHED, taxis__isnull=True).delete()
+    return deleted
+
+
+def dispatch_pending(now=None, window=None):
+    """
+    配車待ちの利用者を出発地毎のバッチに分けて配車し、新しい版として公開する。
+    他の配車処理が書き込み中なら何もしない。
+
+    Parameters
+    ----------
+    now: datetime.datetime
+        基準時刻（省略時は現在時刻）
+    window: int
+        時間幅（秒）
+
+    Returns
+    -------
+    taxis: list
+        今回登録したTaxi
+    """
+    run = DispatchRun.claim()
+    if run is None:
+        logger.info('another dispatch is running; skipped.')
+        return []
+    try:
+        df_of_user_table = read_riders(pending_riders(now, window))
+        if df_of_user_table.empty:
+            run.discard()
+            return []
+        batches = partition(df_of_user_table)
+        number_lists = solve(batches, FeatureStatistic.load() if GLOBAL_NORMALIZATION else None)
+        taxis = save(run, batches, number_lists)
+        if not run.publish(len(taxis)):
+            raise RuntimeError('dispatch run {} was discarded before publishing.'.format(run.pk))
+    except BaseException:
+        run.discard()
+        raise
+    # 割り当てた車両は、空車に戻るまで配車しない
+    Vehicle.objects.filter(pk__in={taxi.vehicle_id for taxi in taxis if taxi.vehicle_id is not None}).update(
+        is_available=False)
+    release_vehicles(run)
+    send_result(run)
+    collect_garbage()
+    if ARCHIVE_DIR is not None:
+        archive.prune(ARCHIVE_DIR, ARCHIVE_MAX_FILES)
+    return taxis
+
+
+def dispatch_admitted():
+    """
+    受け付けた依頼をまとめて配車する（アドミッション制御のワーカーから呼ぶ）。
+    他の配車処理（別のワーカーやdispatch_loop）が書き込み中なら、その後に来た利用者を取りこぼさないよう、
+    書き込みが終わるのを待ってやり直す。
+    """
+    try:
+        while True:
+            taxis = dispatch_pending()
+            if taxis or not DispatchRun.objects.filter(status=DispatchRun.WRITING).exists():
+                return taxis
+            time.sleep(CLAIM_RETRY_SECONDS)
+    finally:
+        connections.close_all()  # ワーカースレッドの接続を残さない
+
+
+# taxi_searchからの配車処理の依頼（計算中の依頼は次の1回にまとめ、期限を過ぎたら公開済みの結果を使う）
+ADMISSION = admission.Admission(dispatch_admitted, QUEUE_LIMIT, DEADLINE_SECONDS, workers=ADMISSION_WORKERS)
+
+
+def send_result(run):
+    """
+    配車結果をメールで送信する。
+
+    Parameters
+    ----------
+    run: DispatchRun
+        公開した版
+    """
+    for taxi in Taxi.objects.filter(run=run).select_related('user', 'vehicle'):
+        # メールの内容
+        context = {
+            'taxi': taxi,
+        }
+        subject = render_to_string('taxishare/mail_template/search/subject.txt', context).strip()
+        message = render_to_string('taxishare/mail_template/search/message.txt', context).strip()
+        send_mail(subject, message, None, [taxi.user.email])
@@ -4,6 +4,7 @@ from django.contrib.auth.forms import (
     PasswordResetForm, SetPasswordForm
 )
 from django.contrib.auth import get_user_model
+from django.conf import settings
 
 
 # 性別の選択肢
@@ -12,6 +13,9 @@ SEX_CHOICES = [
 (1, '女性'),
 ]
 
+# 出発地の選択肢
+ORIGIN_CHOICES = [(i, name) for i, (name, _, _) in enumerate(settings.TAXISHARE_ORIGINS)]
+
 
 User = get_user_model()
 
@@ -125,16 +129,29 @@ class PlaceUpdateForm(forms.ModelForm):
     """
     地点更新用フォーム
     """
-    origin_latitude = forms.FloatField(label='出発地の緯度', initial=35.696739, disabled=True)
-    origin_longitude = forms.FloatField(label='出発地の経度', initial=139.814484, disabled=True)
+    origin = forms.TypedChoiceField(label='出発地', coerce=int, choices=ORIGIN_CHOICES)
     desitination_latitude = forms.FloatField(label='目的地の緯度')
     desitination_longitude = forms.FloatField(label='目的地の経度')
 
+    field_order = ('origin', 'desitination_latitude', 'desitination_longitude')
+
     class Meta:
         model = User
-        fields = ('origin_latitude', 'origin_longitude', 'desitination_latitude', 'desitination_longitude')
+        fields = ('desitination_latitude', 'desitination_longitude')
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         for field in self.fields.values():
             field.widget.attrs['class'] = 'form-control'
+        # 登録済みの出発地を初期値にする
+        for i, (_, lat, lng) in enumerate(settings.TAXISHARE_ORIGINS):
+            if (lat, lng) == (self.instance.origin_latitude, self.instance.origin_longitude):
+                self.initial['origin'] = i
+
+    def save(self, commit=True):
+        """
+        選択した出発地の緯度経度を登録する。
+        """
+        _, self.instance.origin_latitude, self.instance.origin_longitude = \
+            settings.TAXISHARE_ORIGINS[self.cleaned_data['origin']]
+        return super().save(commit)
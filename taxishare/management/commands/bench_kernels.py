@@ -0,0 +1,39 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from taxishare.anneal import kernels, modeling, sizing
+
+
+class Command(BaseCommand):
+    """
+    焼きなまし法のカーネルの速さ（1秒あたりの1ビット反転の試行回数）を実装毎に測る。
+    """
+    help = 'Numba/NumPyの焼きなましカーネルのflips/secを測る。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, default=10, help='利用者数')
+        parser.add_argument('--sweeps', type=int, default=200, help='スイープ数')
+        parser.add_argument('--seed', type=int, default=0, help='乱数シード')
+
+    def handle(self, *args, **options):
+        user = options['user']
+        rng = np.random.default_rng(options['seed'])
+        point = rng.random((user, 2))
+        dist_array = np.triu(np.sqrt(((point[:, None]-point[None])**2).sum(axis=-1)))
+        taxi = sizing.calc_taxi_number(user)
+        model = modeling.CostFunction(user, taxi, sizing.CAPACITY, encoding='log', symmetry=True)
+        model.initialize(dist_array, 10, 10)
+        qubo = kernels.SparseQUBO.from_dict(model.to_dict())
+        betas = np.geomspace(*qubo.beta_range(), options['sweeps'])
+        self.stdout.write('qubits={} nonzeros={} sweeps={}'.format(qubo.n, len(qubo.data)//2, options['sweeps']))
+
+        for backend in kernels.KERNELS:
+            x0 = rng.integers(0, 2, qubo.n)
+            kernels.anneal(qubo, x0, betas[:1], backend=backend)  # コンパイル時間を除く
+            started = time.perf_counter()
+            _, energy = kernels.anneal(qubo, x0, betas, backend=backend)
+            elapsed = time.perf_counter()-started
+            flips = qubo.n*len(betas)/elapsed
+            self.stdout.write('{:>6}: {:>12,.0f} flips/sec  energy={:.4f}'.format(backend, flips, energy))
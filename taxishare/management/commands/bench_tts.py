@@ -0,0 +1,126 @@
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+
+from django.core.management.base import BaseCommand, CommandError
+
+from taxishare.anneal import main, partition, sizing, benchmark, stub
+
+
+def parse_penalty(text):
+    """
+    PENALTY1,PENALTY2を(PENALTY1, PENALTY2)にする。
+    """
+    try:
+        penalty1, penalty2 = (float(v) for v in text.split(','))
+    except ValueError:
+        raise CommandError('--penalty must be PENALTY1,PENALTY2: {}'.format(text))
+    return penalty1, penalty2
+
+
+class Command(BaseCommand):
+    """
+    乱数シードから作った問題で、ソルバー・スラック変数の符号化・制約項の係数の組み合わせ毎に
+    計算量を増やしながら何度も解き、厳密解に届くまでの時間（time-to-target）と実行可能な解の割合を比べる。
+    daptはローカルのスタブサーバー（タブー探索）に投げ、通信を含めた時間を測る。
+    """
+    help = 'ソルバーの設定毎に、厳密解に届くまでの時間と実行可能な解の割合を測って比べる。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--engine', nargs='+', default=['sa', 'tabu'], choices=sorted(main.QUBO_SOLVERS),
+                            help='ソルバー名')
+        parser.add_argument('--encoding', nargs='+', default=['log', 'unary'], choices=['log', 'unary'],
+                            help='スラック変数の符号化')
+        parser.add_argument('--penalty', nargs='+', type=parse_penalty,
+                            default=[(main.PENALTY1, main.PENALTY2)], help='制約項の係数（PENALTY1,PENALTY2）')
+        parser.add_argument('--users', type=int, nargs='+', default=[6, 8, 10], help='問題の利用者数')
+        parser.add_argument('--instances', type=int, default=3, help='利用者数毎の問題の数')
+        parser.add_argument('--runs', type=int, default=10, help='問題毎に乱数シードを変えて解く回数')
+        parser.add_argument('--effort', type=float, nargs='+', default=[0.125, 0.25, 0.5, 1.0],
+                            help='既定の反転・スイープ回数に掛ける倍率')
+        parser.add_argument('--seed', type=int, default=0, help='問題を作る乱数シード')
+        parser.add_argument('--latency', type=float, default=0.0, help='スタブサーバーの待ち時間（秒）')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='プロセス数')
+        parser.add_argument('--trace', help='計算量毎のエネルギーと計算時間の推移を書き出すファイル（JSON Lines）')
+        parser.add_argument('--output', help='集計を書き出すファイル（JSON）')
+        parser.add_argument('--baseline', help='比べる以前の集計（--outputで書き出したJSON）')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='以前の集計よりtime-to-targetがこの割合を超えて遅ければ警告する')
+
+    def handle(self, *args, **options):
+        for user in options['users']:
+            if not 2 <= user <= main.UPPER_USER:
+                raise CommandError('--users must be between 2 and {}: {}'.format(main.UPPER_USER, user))
+        if 'dapt' in options['engine'] and stub.web is None:
+            raise CommandError('dapt benchmark requires aiohttp for the stub server.')
+
+        with ExitStack() as stack:
+            url = None
+            if 'dapt' in options['engine']:
+                url = stack.enter_context(stub.serve(options['latency'], forward_params=True))
+            tasks = self.tasks(options, url)
+            with ProcessPoolExecutor(max_workers=options['workers'], initializer=benchmark.warm_up,
+                                     initargs=(sorted(set(options['engine'])),)) as executor:
+                traces = list(executor.map(benchmark.run_one, tasks))
+
+        if options['trace']:
+            self.write_trace(options['trace'], tasks, traces)
+        summary = benchmark.summarize(tasks, traces)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(summary, f, indent=1)
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+        self.table(summary, baseline, options['tolerance'])
+
+    def tasks(self, options, url):
+        """
+        設定・問題・乱数シード毎の計算を作る。問題毎の目標は厳密解の目的関数値にする。
+        """
+        configs = benchmark.configurations(options['engine'], options['encoding'], options['penalty'])
+        tasks = []
+        for user in options['users']:
+            for index in range(options['instances']):
+                dist_array, taxi = benchmark.synthetic(user, options['seed'], index)
+                reference = partition.solve_exact(dist_array, taxi, sizing.CAPACITY).objective
+                for config in configs:
+                    for run in range(options['runs']):
+                        tasks.append(dict(config, user=user, index=index, seed=options['seed'], run_seed=run,
+                                          efforts=options['effort'], reference=reference, url=url))
+        return tasks
+
+    def write_trace(self, path, tasks, traces):
+        """
+        計算量毎のエネルギーと計算時間を、1行1記録で書き出す。
+        """
+        keys = ['engine', 'encoding', 'penalty1', 'penalty2', 'user', 'index', 'seed', 'run_seed', 'reference']
+        with open(path, 'w') as f:
+            for task, trace in zip(tasks, traces):
+                for record in trace:
+                    f.write(json.dumps(dict({k: task[k] for k in keys}, **record))+'\n')
+
+    def table(self, summary, baseline, tolerance):
+        """
+        設定・利用者数毎の集計を表示する。以前の集計があれば、time-to-targetの比も表示する。
+        利用者数毎にまとめ、その中でtime-to-targetの短い順に並べる。
+        """
+        def key(row):
+            # 利用者数の無い以前の集計は、利用者数をまとめた行として比べない
+            return (row['engine'], row['encoding'], row['penalty1'], row['penalty2'], row.get('user'))
+
+        previous = {key(row): row['tts_ms'] for row in baseline or []}
+        self.stdout.write('{:<7}{:<7}{:>7}{:>7}{:>6}{:>8}{:>10}{:>9}{:>12}{:>10}{:>11}{:>8}'.format(
+            'engine', 'enc', 'pen1', 'pen2', 'user', 'qubits', 'feasible', 'success', 'iterations', 'ms', 'tts ms',
+            'ratio'))
+        for row in sorted(summary, key=lambda row: (row['user'], row['tts_ms'])):
+            ratio = row['tts_ms']/previous[key(row)] if previous.get(key(row)) else None
+            line = '{:<7}{:<7}{:>7g}{:>7g}{:>6}{:>8.0f}{:>10.0%}{:>9.0%}{:>12}{:>10.1f}{:>11.1f}{:>8}'.format(
+                row['engine'], row['encoding'], row['penalty1'], row['penalty2'], row['user'], row['qubits'],
+                row['feasible'], row['success'], row['iterations'], row['median_ms'], row['tts_ms'],
+                '-' if ratio is None else '{:.2f}'.format(ratio))
+            if ratio is not None and ratio > 1+tolerance:
+                line = self.style.WARNING(line)
+            self.stdout.write(line)
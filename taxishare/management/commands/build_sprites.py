@@ -0,0 +1,27 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from taxishare import sprites
+
+
+class Command(BaseCommand):
+    """
+    地図のマーカー画像を1枚のスプライトにまとめる。
+    collectstaticの前に実行し、書き出したスプライトと配置のJSONを静的ファイルとして配信する。
+    """
+    help = 'マーカー画像を1枚のスプライトにまとめる。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default=os.path.join(settings.BASE_DIR, 'assets', 'markers'),
+                            help='マーカー画像のディレクトリ')
+        parser.add_argument('--output', default=os.path.join(settings.BASE_DIR, 'static', 'taxishare', 'common'),
+                            help='書き出すディレクトリ')
+        parser.add_argument('--cell', type=int, default=sprites.CELL, help='1マスの大きさ（px）')
+
+    def handle(self, *args, **options):
+        layout = sprites.build(options['source'], options['output'], options['cell'])
+        path = os.path.join(options['output'], 'markers.png')
+        self.stdout.write('packed {} markers into {} cells ({}, {} bytes)'.format(
+            len(layout['names']), layout['columns'], path, os.path.getsize(path)))
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from taxishare import dispatch
+from taxishare.anneal import shared
+
+
+class Command(BaseCommand):
+    """
+    時間幅毎に配車待ちの利用者をまとめて配車する。
+    """
+    help = '時間幅毎に配車待ちの利用者をバッチで配車する。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=int, default=dispatch.WINDOW_SECONDS, help='時間幅（秒）')
+        parser.add_argument('--once', action='store_true', help='1回だけ配車して終了する')
+
+    def handle(self, *args, **options):
+        window = options['window']
+        while True:
+            started = time.monotonic()
+            taxis = dispatch.dispatch_pending(window=window)
+            self.stdout.write('dispatched {} riders'.format(len(taxis)))
+            if dispatch.MODEL_CACHE:
+                shared.purge(dispatch.MODEL_CACHE, max_age=2*window)  # 古いQUBOを削除する
+            if options['once']:
+                break
+            time.sleep(max(0, window-(time.monotonic()-started)))
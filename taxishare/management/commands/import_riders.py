@@ -0,0 +1,193 @@
+import csv
+import json
+import time
+import datetime
+from itertools import islice
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction, reset_queries
+
+from taxishare.models import RiderSnapshot, FeatureStatistic
+
+try:
+    import resource
+except ImportError:  # Windowsではメモリ使用量を表示しない
+    resource = None
+
+
+User = get_user_model()
+
+FIELDS = ['email', 'birth_date', 'sex', 'origin_latitude', 'origin_longitude',
+          'desitination_latitude', 'desitination_longitude']
+FLOAT_FIELDS = ['origin_latitude', 'origin_longitude', 'desitination_latitude', 'desitination_longitude']
+
+
+def read_csv(path):
+    """
+    CSVから1行ずつ利用者を読み込む。
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        yield from csv.DictReader(f)
+
+
+def read_jsonl(path):
+    """
+    JSON Linesから1行ずつ利用者を読み込む。
+    """
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def generate(count, start=0, seed=0, spread=0.02):
+    """
+    出発地の周りに目的地を持つ合成した利用者を1人ずつ作る。
+
+    Parameters
+    ----------
+    count: int
+        利用者数
+    start: int
+        メールアドレスの通し番号の開始
+    seed: int
+        乱数シード
+    spread: float
+        出発地から目的地までのばらつき（度）
+    """
+    rng = np.random.default_rng(seed)
+    origins = np.array([(lat, lng) for _, lat, lng in settings.TAXISHARE_ORIGINS])
+    chunk = 10_000  # 乱数はまとめて作る
+    for offset in range(0, count, chunk):
+        n = min(chunk, count-offset)
+        origin = origins[rng.integers(len(origins), size=n)]
+        destination = origin+rng.normal(0, spread, (n, 2))
+        birth_year = rng.integers(1940, 2005, n)
+        birth_day = rng.integers(0, 365, n)
+        sex = rng.choice([-1, 1], n)
+        for i in range(n):
+            yield {
+                'email': 'rider{}@example.com'.format(start+offset+i),
+                'birth_date': datetime.date(int(birth_year[i]), 1, 1)+datetime.timedelta(days=int(birth_day[i])),
+                'sex': int(sex[i]),
+                'origin_latitude': float(origin[i, 0]),
+                'origin_longitude': float(origin[i, 1]),
+                'desitination_latitude': float(destination[i, 0]),
+                'desitination_longitude': float(destination[i, 1]),
+            }
+
+
+def to_user(row, password):
+    """
+    読み込んだ1行をUserにする。空の値は既定値のままにする。
+    """
+    values = {}
+    for k in FIELDS:
+        v = row.get(k)
+        v = v.strip() if isinstance(v, str) else v
+        if v not in (None, ''):
+            values[k] = v
+    for k in FLOAT_FIELDS:
+        if k in values:
+            values[k] = float(values[k])
+    if 'sex' in values:
+        values['sex'] = int(values['sex'])
+    if isinstance(values.get('birth_date'), str):
+        values['birth_date'] = datetime.date.fromisoformat(values['birth_date'])
+    values['email'] = User.objects.normalize_email(values['email'])
+    return User(password=password, **values)
+
+
+def peak_memory():
+    """
+    プロセスの最大常駐メモリ（MB）を返す。
+    """
+    if resource is None:
+        return float('nan')
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+
+class Command(BaseCommand):
+    """
+    CSV・JSON Linesの利用者、または合成した利用者をまとめてデータベースに登録する。
+    利用者毎のパスワードのハッシュ計算とメール送信を行わず、一定件数ずつbulk_createする。
+    """
+    help = '利用者をファイルから読み込み（または合成し）、一定件数ずつ登録する。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help='読み込むファイル（.csv または .jsonl）')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='ファイル形式（省略時は拡張子から決める）')
+        parser.add_argument('--synthetic', type=int, default=0, help='合成する利用者数（pathの代わりに使う）')
+        parser.add_argument('--start', type=int, default=0, help='合成する利用者の通し番号の開始')
+        parser.add_argument('--seed', type=int, default=0, help='合成に使う乱数シード')
+        parser.add_argument('--chunk', type=int, default=5000, help='1回に登録する件数')
+        parser.add_argument('--password', help='全員に設定するパスワード（省略時はログインできない）')
+        parser.add_argument('--hasher', default='default',
+                            help='パスワードのハッシュ方式（PASSWORD_HASHERSのalgorithm）')
+        parser.add_argument('--no-snapshot', dest='snapshot', action='store_false',
+                            help='配車処理用のスナップショットを作らない（後でrefresh_snapshotsで作る）')
+        parser.add_argument('--requested', action='store_true', help='スナップショットを配車依頼済みにする')
+        parser.add_argument('--ignore-conflicts', action='store_true', help='登録済みのメールアドレスを飛ばす')
+
+    def handle(self, *args, **options):
+        rows = self.open(options)
+        # パスワードのハッシュは1回だけ計算して全員に使う
+        try:
+            password = make_password(options['password'], hasher=options['hasher'])
+        except ValueError as e:
+            raise CommandError(e)
+        chunk = options['chunk']
+
+        started = time.perf_counter()
+        total = 0
+        while True:
+            batch = [to_user(row, password) for row in islice(rows, chunk)]
+            if not batch:
+                break
+            with transaction.atomic():
+                User.objects.bulk_create(batch, ignore_conflicts=options['ignore_conflicts'])
+                if options['snapshot'] or options['requested']:
+                    self.create_snapshots(batch, options['requested'])
+            reset_queries()  # DEBUG時に実行したSQLを溜めない
+            total += len(batch)
+            elapsed = time.perf_counter()-started
+            self.stdout.write('{:>10} riders {:>10.0f} riders/s {:>8.1f} MB peak'.format(
+                total, total/elapsed, peak_memory()))
+
+        elapsed = time.perf_counter()-started
+        self.stdout.write(self.style.SUCCESS('imported {} riders in {:.1f}s ({:.0f} riders/s, {:.1f} MB peak)'.format(
+            total, elapsed, total/elapsed if elapsed else 0, peak_memory())))
+
+    def open(self, options):
+        """
+        読み込む（または合成する）利用者を1人ずつ返すイテレータを作る。
+        """
+        if options['synthetic']:
+            return generate(options['synthetic'], options['start'], options['seed'])
+        path = options['path']
+        if not path:
+            raise CommandError('specify a file or --synthetic.')
+        fmt = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+        return read_csv(path) if fmt == 'csv' else read_jsonl(path)
+
+    def create_snapshots(self, batch, requested):
+        """
+        登録した利用者のスナップショットを作り、特徴量の統計量にまとめて加える。
+        bulk_createで主キーが返らないデータベースもあるので、メールアドレスから引き直す。
+        既にスナップショットのある利用者はそのままにする。
+        """
+        ids = dict(User.objects.filter(email__in=[u.email for u in batch]).values_list('email', 'pk'))
+        existing = set(RiderSnapshot.objects.filter(user_id__in=ids.values()).values_list('user_id', flat=True))
+        snapshots = []
+        for user in batch:
+            user.pk = ids[user.email]
+            snapshot = RiderSnapshot.build(user, requested)
+            if snapshot is not None and user.pk not in existing:
+                snapshots.append(snapshot)
+        RiderSnapshot.objects.bulk_create(snapshots)
+        if snapshots:
+            FeatureStatistic.merge(snapshots)
@@ -0,0 +1,213 @@
+import os
+import time
+import logging
+import random
+import tempfile
+import threading
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import connection, connections, OperationalError
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from taxishare import dispatch
+from taxishare.anneal import main, tabu
+from taxishare.models import RiderSnapshot
+
+
+User = get_user_model()
+
+LOCK_WAIT_SECONDS = 0.05  # これより時間のかかった書き込みをロック待ちとみなす
+
+
+class StubSolver(tabu.TabuSolver):
+    """
+    デジタルアニーラの代わりに、待ち時間を入れてからローカルでタブー探索を行う。
+    """
+    latency = 0.0
+
+    def minimize(self, qubit_dict):
+        time.sleep(self.latency)
+        return super().minimize(qubit_dict)
+
+
+class Stats(object):
+    """
+    エンドポイント毎の応答時間、エラー数、DBのロック待ちを集計する。
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(list)
+        self.error = defaultdict(int)
+        self.lock_wait = defaultdict(float)
+        self.lock_count = defaultdict(int)
+        self.lock_error = defaultdict(int)
+
+    def add(self, endpoint, latency, ok, lock_wait, lock_count, lock_error):
+        with self.lock:
+            self.latency[endpoint].append(latency)
+            self.error[endpoint] += not ok
+            self.lock_wait[endpoint] += lock_wait
+            self.lock_count[endpoint] += lock_count
+            self.lock_error[endpoint] += lock_error
+
+
+class Command(BaseCommand):
+    """
+    利用者の地点更新と管理者の配車検索を同時に大量に行い、応答性能を測る。
+    使い捨てのテスト用データベース（SQLiteならファイル）に合成した利用者を作って実行する。
+    """
+    help = '地点更新・配車検索を並行して実行し、エンドポイント毎の応答時間を測る。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--riders', type=int, default=300, help='利用者数（並行に地点更新するスレッド数）')
+        parser.add_argument('--staff', type=int, default=20, help='管理者数（並行に配車検索するスレッド数）')
+        parser.add_argument('--duration', type=float, default=30, help='実行時間（秒）')
+        parser.add_argument('--think', type=float, default=0.5, help='リクエスト間の平均待ち時間（秒）')
+        parser.add_argument('--engine', default='stub', help="配車に使うソルバー（'stub'ならローカルの代替ソルバー）")
+        parser.add_argument('--solver-latency', type=float, default=0.2, help='代替ソルバーの待ち時間（秒）')
+        parser.add_argument('--seed', type=int, default=0, help='乱数シード')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        logging.getLogger('django.request').setLevel(logging.CRITICAL)  # エラーは集計だけ行う
+        settings.EMAIL_BACKEND = 'django.core.mail.backends.dummy.EmailBackend'
+        if connection.vendor == 'sqlite':
+            self.stderr.write(self.style.WARNING(
+                'SQLiteは書き込みを1つずつしか行えないため、並行した地点更新はロックエラーで失敗します。'
+                '意味のある負荷の数値を得るにはPostgreSQLを使ってください。'))
+            # メモリ上ではなくファイルのデータベースでロックの挙動を再現する
+            connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.mkdtemp(), 'loadtest.sqlite3')
+
+        # 途中で失敗しても、差し替えた設定は必ず元に戻す
+        engine, model_cache = dispatch.ENGINE, dispatch.MODEL_CACHE
+        archive_dir, tuner = dispatch.ARCHIVE_DIR, dispatch.TUNER
+        old_name = None
+        try:
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            StubSolver.latency = options['solver_latency']
+            main.QUBO_SOLVERS['stub'] = StubSolver
+            dispatch.ENGINE = options['engine']
+            dispatch.MODEL_CACHE = tempfile.mkdtemp()
+            # 代替ソルバーの計算を、配車処理の保存やパラメータ選択の記録に残さない
+            dispatch.ARCHIVE_DIR = None
+            dispatch.TUNER = None
+
+            riders, staff = self.seed(options['riders'], options['staff'], options['seed'])
+            stats = self.run(riders, staff, options)
+            self.report(stats, options['duration'])
+        finally:
+            dispatch.ENGINE = engine
+            dispatch.MODEL_CACHE = model_cache
+            dispatch.ARCHIVE_DIR = archive_dir
+            dispatch.TUNER = tuner
+            main.QUBO_SOLVERS.pop('stub', None)
+            connections.close_all()
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def seed(self, n_rider, n_staff, seed):
+        """
+        出発地の周りに合成した利用者と管理者を作る。
+        """
+        rng = np.random.default_rng(seed)
+        password = make_password(None)  # ログインはforce_loginで行う
+        _, lat, lng = settings.TAXISHARE_ORIGINS[0]
+        User.objects.bulk_create([
+            User(email='rider{}@example.com'.format(i), password=password,
+                 birth_date='{}-01-01'.format(rng.integers(1950, 2000)), sex=int(rng.choice([-1, 1])),
+                 origin_latitude=lat, origin_longitude=lng,
+                 desitination_latitude=lat+rng.normal(0, 0.02), desitination_longitude=lng+rng.normal(0, 0.02))
+            for i in range(n_rider)
+        ])
+        User.objects.bulk_create([
+            User(email='staff{}@example.com'.format(i), password=password, is_staff=True)
+            for i in range(n_staff)
+        ])
+        for user in User.objects.filter(is_staff=False):
+            RiderSnapshot.refresh(user)
+        return list(User.objects.filter(is_staff=False)), list(User.objects.filter(is_staff=True))
+
+    def run(self, riders, staff, options):
+        """
+        利用者・管理者毎のスレッドで、実行時間の間リクエストを送り続ける。
+        """
+        stats = Stats()
+        deadline = time.monotonic()+options['duration']
+        origin_count = len(settings.TAXISHARE_ORIGINS)
+
+        def worker(user, endpoint, seed):
+            rng = random.Random(seed)
+            client = Client()
+            client.force_login(user)
+            local = threading.local()
+
+            def lock_wrapper(execute, sql, params, many, context):
+                # 書き込みにかかった時間をロック待ちとして集計する
+                started = time.perf_counter()
+                try:
+                    return execute(sql, params, many, context)
+                except OperationalError as e:
+                    if 'locked' in str(e):
+                        local.lock_error += 1
+                    raise
+                finally:
+                    elapsed = time.perf_counter()-started
+                    if elapsed > LOCK_WAIT_SECONDS and not sql.lstrip().upper().startswith('SELECT'):
+                        local.lock_wait += elapsed
+                        local.lock_count += 1
+
+            try:
+                with connection.execute_wrapper(lock_wrapper):
+                    while time.monotonic() < deadline:
+                        time.sleep(rng.expovariate(1/options['think']) if options['think'] > 0 else 0)
+                        local.lock_wait, local.lock_count, local.lock_error = 0.0, 0, 0
+                        started = time.perf_counter()
+                        try:
+                            if endpoint == 'place_update':
+                                response = client.post(reverse('taxishare:place_update', kwargs={'pk': user.pk}), {
+                                    'origin': rng.randrange(origin_count),
+                                    'desitination_latitude': user.desitination_latitude+rng.gauss(0, 0.005),
+                                    'desitination_longitude': user.desitination_longitude+rng.gauss(0, 0.005),
+                                })
+                            else:
+                                response = client.post(reverse('taxishare:taxi_search', kwargs={'pk': user.pk}))
+                            ok = response.status_code < 400
+                        except Exception:
+                            ok = False
+                        stats.add(endpoint, time.perf_counter()-started, ok,
+                                  local.lock_wait, local.lock_count, local.lock_error)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker, args=(user, 'place_update', i)) for i, user in enumerate(riders)]
+        threads += [threading.Thread(target=worker, args=(user, 'taxi_search', -i-1)) for i, user in enumerate(staff)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        dispatch.ADMISSION.join()  # 受け付けた配車処理が終わるのを待つ
+        return stats
+
+    def report(self, stats, duration):
+        """
+        エンドポイント毎の集計結果を表示する。
+        """
+        self.stdout.write('{:<14}{:>8}{:>10}{:>9}{:>9}{:>9}{:>9}{:>8}{:>11}{:>8}'.format(
+            'endpoint', 'count', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'error%', 'locks', 'lock ms', 'busy'))
+        for endpoint, latency in sorted(stats.latency.items()):
+            p50, p95, p99 = np.percentile(np.array(latency)*1000, [50, 95, 99])
+            self.stdout.write('{:<14}{:>8}{:>10.1f}{:>9.1f}{:>9.1f}{:>9.1f}{:>9.1f}{:>8}{:>11.1f}{:>8}'.format(
+                endpoint, len(latency), len(latency)/duration, p50, p95, p99,
+                100*stats.error[endpoint]/len(latency), stats.lock_count[endpoint],
+                1000*stats.lock_wait[endpoint], stats.lock_error[endpoint]))
+        metrics = dispatch.ADMISSION.metrics()
+        self.stdout.write('admission: {requests} requests, {solves} solves, {coalesced} coalesced, '
+                          '{shed} shed, {rejected} rejected, {failed} failed'.format(**metrics))
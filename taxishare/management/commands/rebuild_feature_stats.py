@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from taxishare.anneal.preparations import F_COLS
+from taxishare.models import FeatureStatistic
+
+
+class Command(BaseCommand):
+    """
+    スナップショット全体から特徴量の統計量を求め直す。
+    利用者の削除などスナップショットの作り直しを通らない変更や、1人分ずつの更新の誤差を取り除く。
+    """
+    help = 'スナップショット全体から特徴量の統計量を求め直す。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk', type=int, default=10000, help='1回に読み込むスナップショット数')
+
+    def handle(self, *args, **options):
+        stats = FeatureStatistic.rebuild(options['chunk'])
+        for k, c in enumerate(F_COLS):
+            self.stdout.write('{:<24}{:>10.0f}{:>14.6g}{:>14.6g}'.format(c, stats.count[k], stats.mean[k], stats.std[k]))
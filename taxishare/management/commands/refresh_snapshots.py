@@ -0,0 +1,59 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from taxishare.models import RiderSnapshot, FeatureStatistic
+
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    """
+    全ての利用者のスナップショットを一定件数ずつ作り直し、特徴量の統計量を求め直す。
+    シグナルを送らない経路（bulk_create、QuerySet.update、導入前の利用者）で変わった利用者を配車対象に戻す。
+    配車依頼日時はそのまま残す。
+    """
+    help = '利用者テーブルからスナップショットを作り直し、特徴量の統計量を求め直す。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk', type=int, default=5000, help='1回に処理する利用者数')
+
+    def handle(self, *args, **options):
+        chunk = options['chunk']
+        total = created = updated = deleted = 0
+        last_pk = None
+        while True:
+            users = User.objects.order_by('pk')
+            if last_pk is not None:
+                users = users.filter(pk__gt=last_pk)
+            users = list(users[:chunk])
+            if not users:
+                break
+            last_pk = users[-1].pk
+            with transaction.atomic():
+                existing = RiderSnapshot.objects.in_bulk([u.pk for u in users])
+                to_create, to_update, to_delete = [], [], []
+                for user in users:
+                    snapshot = RiderSnapshot.build(user)
+                    old = existing.get(user.pk)
+                    if snapshot is None:
+                        if old is not None:
+                            to_delete.append(user.pk)
+                    elif old is None:
+                        to_create.append(snapshot)
+                    elif any(getattr(old, f) != getattr(snapshot, f) for f in RiderSnapshot.SNAPSHOT_FIELDS):
+                        for f in RiderSnapshot.SNAPSHOT_FIELDS:
+                            setattr(old, f, getattr(snapshot, f))
+                        to_update.append(old)
+                RiderSnapshot.objects.bulk_create(to_create)
+                RiderSnapshot.objects.bulk_update(to_update, RiderSnapshot.SNAPSHOT_FIELDS)
+                RiderSnapshot.objects.filter(pk__in=to_delete).delete()
+            total += len(users)
+            created, updated, deleted = created+len(to_create), updated+len(to_update), deleted+len(to_delete)
+            self.stdout.write('{:>10} users: created {} updated {} deleted {}'.format(
+                total, created, updated, deleted))
+
+        FeatureStatistic.rebuild()
+        self.stdout.write(self.style.SUCCESS('snapshots: created {} updated {} deleted {}; statistics rebuilt'.format(
+            created, updated, deleted)))
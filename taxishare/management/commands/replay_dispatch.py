@@ -0,0 +1,101 @@
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from taxishare import dispatch
+from taxishare.anneal import archive, replay, benchmark, main
+
+
+def parse_param(text):
+    """
+    KEY=VALUEを(KEY, VALUE)にする。VALUEはJSONとして読めれば読む。
+    """
+    key, sep, value = text.partition('=')
+    if not sep:
+        raise CommandError('--param must be KEY=VALUE: {}'.format(text))
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return key, value
+
+
+class Command(BaseCommand):
+    """
+    保存した配車処理を、指定したソルバー・設定でプロセスプールを使って解き直し、
+    記録した結果と目的関数値、エネルギー、実行可能性、計算時間を比べる。
+    """
+    help = '保存した配車処理を解き直し、記録した結果と比べる。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('archive', nargs='?', default=dispatch.ARCHIVE_DIR, help='保存先のディレクトリ')
+        parser.add_argument('--engine', help='ソルバー名（省略時は記録したソルバー）')
+        parser.add_argument('--param', action='append', default=[], type=parse_param,
+                            help='QUBOソルバーのパラメータの上書き（KEY=VALUE、複数指定可）')
+        parser.add_argument('--penalty', nargs=2, type=float, metavar=('PENALTY1', 'PENALTY2'),
+                            help='制約項の係数（指定するとQUBOを作り直す）')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='プロセス数')
+        parser.add_argument('--limit', type=int, help='解き直す件数の上限（古い順）')
+        parser.add_argument('--verbose-table', action='store_true', help='1件毎の結果も表示する')
+
+    def handle(self, *args, **options):
+        if not options['archive'] or not os.path.isdir(options['archive']):
+            raise CommandError('archive directory not found: {}'.format(options['archive']))
+        paths = list(islice(archive.iter_archive(options['archive']), options['limit']))
+        if not paths:
+            self.stdout.write('no archived dispatch.')
+            return
+
+        replay_one = partial(replay.replay_one, engine=options['engine'], params=dict(options['param']),
+                             penalties=options['penalty'])
+        # 各プロセスでローカルのソルバーに小さな問題を解かせ、JITコンパイルなどの初回の時間を計算時間に含めない
+        # （記録したソルバーで解き直すときは、どれを使うか分からないのでローカルのQUBOソルバーを全て温める）
+        engines = [options['engine']] if options['engine'] else sorted(main.QUBO_SOLVERS)
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=benchmark.warm_up,
+                                 initargs=(engines,)) as executor:
+            results = list(executor.map(replay_one, paths, chunksize=max(1, len(paths)//(4*options['workers']))))
+
+        if options['verbose_table']:
+            self.table(results)
+        self.summary(results)
+
+    def table(self, results):
+        """
+        1件毎の結果を表示する。
+        """
+        self.stdout.write('{:<32}{:>5}{:>8}{:>8}{:>11}{:>11}{:>11}{:>11}{:>6}{:>9}{:>9}'.format(
+            'file', 'user', 'rec', 'new', 'rec obj', 'new obj', 'rec E', 'new E', 'ok', 'rec ms', 'new ms'))
+        for r in results:
+            self.stdout.write('{:<32}{:>5}{:>8}{:>8}{:>11.4g}{:>11.4g}{:>11.4g}{:>11.4g}{:>6}{:>9.1f}{:>9.1f}'.format(
+                os.path.basename(r['path']), r['user'], r['recorded_engine'] or '-', r['engine'] or '-',
+                r['recorded_objective'], r['objective'], r['recorded_energy'], r['energy'],
+                'yes' if r['feasible'] else 'no', 1000*r['recorded_elapsed'], 1000*r['elapsed']))
+
+    def summary(self, results):
+        """
+        記録した結果と比べた集計を表示する。
+        """
+        feasible = [r for r in results if r['feasible']]
+        delta = np.array([r['objective']-r['recorded_objective'] for r in feasible])
+        energy = np.array([r['energy']-r['recorded_energy'] for r in feasible])
+        energy = energy[~np.isnan(energy)]
+        rec_ms = 1000*np.array([r['recorded_elapsed'] for r in results])
+        new_ms = 1000*np.array([r['elapsed'] for r in results])
+
+        self.stdout.write('replayed {} dispatches, {} feasible ({:.1f}%)'.format(
+            len(results), len(feasible), 100*len(feasible)/len(results)))
+        if len(delta):
+            self.stdout.write('objective: better {} / equal {} / worse {}, mean delta {:+.4g}'.format(
+                int((delta < -1e-9).sum()), int((abs(delta) <= 1e-9).sum()), int((delta > 1e-9).sum()), delta.mean()))
+        if len(energy):
+            self.stdout.write('energy: mean delta {:+.4g} over {} QUBO runs'.format(energy.mean(), len(energy)))
+        self.stdout.write('latency ms: recorded p50 {:.1f} p95 {:.1f} / replay p50 {:.1f} p95 {:.1f}'.format(
+            *np.nanpercentile(rec_ms, [50, 95]), *np.nanpercentile(new_ms, [50, 95])))
+        for r in results:
+            if r['error']:
+                self.stdout.write(self.style.WARNING('{}: {}'.format(os.path.basename(r['path']), r['error'])))
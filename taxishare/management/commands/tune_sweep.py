@@ -0,0 +1,125 @@
+import os
+import time
+from contextlib import ExitStack
+from itertools import islice
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from taxishare import dispatch
+from taxishare.anneal import main, sizing, archive, tuning, stub
+
+
+def synthetic(user, rng):
+    """
+    平面上のランダムな地点から、利用者数userの問題（データ間距離、タクシー数）を作る。
+    """
+    point = rng.random((user, 2))
+    dist_array = np.triu(np.sqrt(((point[:, None]-point[None])**2).sum(axis=-1)))
+    return dist_array, sizing.calc_taxi_number(user)
+
+
+class Command(BaseCommand):
+    """
+    問題の大きさ毎に、QUBOソルバーのパラメータの候補を全て試して記録し、
+    記録から実行可能で最良に近い解に届いた中で最も速いパラメータを選び直す。
+    daptは--urlのサーバーか、無ければローカルのスタブサーバー（タブー探索）に投げる。
+    スタブの記録は通信を含めた動作確認のためのもので、デジタルアニーラの計算時間とは異なる。
+    """
+    help = 'QUBOソルバーのパラメータを試して記録し、問題の大きさ毎のパラメータを選ぶ。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--engine', default='tabu', choices=sorted(main.QUBO_SOLVERS), help='ソルバー名')
+        parser.add_argument('--users', type=int, nargs='+', default=list(range(2, main.UPPER_USER+1, 2)),
+                            help='合成する問題の利用者数')
+        parser.add_argument('--instances', type=int, default=3, help='利用者数毎に合成する問題の数')
+        parser.add_argument('--archive', help='合成する代わりに、保存した配車処理の問題を使う')
+        parser.add_argument('--limit', type=int, help='保存した配車処理を使う件数の上限（古い順）')
+        parser.add_argument('--repeat', type=int, default=1, help='パラメータ毎に解く回数')
+        parser.add_argument('--seed', type=int, default=0, help='乱数シード')
+        parser.add_argument('--tuning-dir', default=dispatch.TUNING_DIR, help='記録とパラメータのディレクトリ')
+        parser.add_argument('--fit-only', action='store_true', help='解かずに、記録からパラメータを選び直すだけにする')
+        parser.add_argument('--url', help='daptの依頼先（省略時はローカルのスタブサーバー）')
+        parser.add_argument('--latency', type=float, default=0.0, help='スタブサーバーの待ち時間（秒）')
+
+    def handle(self, *args, **options):
+        if not options['tuning_dir']:
+            raise CommandError('DISPATCH_TUNING_DIR is not set; pass --tuning-dir.')
+        tuner = tuning.Tuner(options['tuning_dir'], dispatch.TUNING_MAX_BYTES)
+        if not options['fit_only']:
+            with ExitStack() as stack:
+                url = options['url']
+                if options['engine'] == 'dapt' and url is None:
+                    if stub.web is None:
+                        raise CommandError('dapt sweep without --url requires aiohttp for the stub server.')
+                    url = stack.enter_context(stub.serve(options['latency'], forward_params=True))
+                self.sweep(tuner, options, url)
+        self.table(tuner.refit())
+
+    def problems(self, options):
+        """
+        試す問題（データ間距離、タクシー数）を返す。
+        """
+        if options['archive']:
+            if not os.path.isdir(options['archive']):
+                raise CommandError('archive directory not found: {}'.format(options['archive']))
+            for path in islice(archive.iter_archive(options['archive']), options['limit']):
+                rec = archive.Record(path)
+                yield rec.dist_array, rec.taxi
+        else:
+            rng = np.random.default_rng(options['seed'])
+            for user in options['users']:
+                if not 2 <= user <= main.UPPER_USER:
+                    raise CommandError('--users must be between 2 and {}: {}'.format(main.UPPER_USER, user))
+                for _ in range(options['instances']):
+                    yield synthetic(user, rng)
+
+    def sweep(self, tuner, options, url=None):
+        """
+        問題毎にパラメータの候補を全て試して記録する。urlがあればdaptの依頼先にする。
+        """
+        engine = options['engine']
+        grid = tuning.candidates(engine)
+        # JITコンパイルなどの初回の時間を計算時間に含めない
+        solver = main.QUBO_SOLVERS[engine]()
+        if url is not None:
+            solver.url = url
+        solver.minimize(main.build_model(*synthetic(2, np.random.default_rng(0))).to_dict())
+
+        count = 0
+        started = time.perf_counter()
+        for dist_array, taxi in self.problems(options):
+            model = main.build_model(dist_array, taxi)
+            qubit_dict = model.to_dict()
+            for params in grid:
+                for _ in range(options['repeat']):
+                    solver = main.QUBO_SOLVERS[engine]()
+                    solver.params.update(params)
+                    if url is not None:
+                        solver.url = url
+                    solving = time.perf_counter()
+                    response = solver.minimize(qubit_dict)
+                    elapsed = time.perf_counter()-solving
+                    try:
+                        main.decode(response, dist_array, taxi, model, engine, solving)
+                        feasible = True
+                    except ValueError:  # 制約を満たさない解
+                        feasible = False
+                    tuner.record(engine, qubit_dict, solver.params, response.energy, feasible, elapsed)
+                    count += 1
+        self.stdout.write('recorded {} solves with {} parameter sets in {:.1f}s'.format(
+            count, len(grid), time.perf_counter()-started))
+
+    def table(self, policy):
+        """
+        選んだパラメータを表示する。
+        """
+        if not policy:
+            self.stdout.write('no parameter reached the success rate; keeping defaults.')
+            return
+        self.stdout.write('{:<6}{:>8}{:>9}{:>10}{:>9}  {}'.format('engine', 'qubits', 'success', 'ms', 'samples', 'params'))
+        for engine, buckets in sorted(policy.items()):
+            for bucket, chosen in sorted(buckets.items(), key=lambda item: int(item[0])):
+                self.stdout.write('{:<6}{:>8}{:>9.0%}{:>10.1f}{:>9}  {}'.format(
+                    engine, '<='+bucket, chosen['success'], 1000*chosen['elapsed'], chosen['samples'],
+                    ' '.join('{}={}'.format(k, v) for k, v in sorted(chosen['params'].items()))))
@@ -1,4 +1,7 @@
-from django.db import models
+import datetime
+
+from django.db import models, transaction, IntegrityError
+from django.db.models import Q
 from django.core.mail import send_mail
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.contrib.auth.models import PermissionsMixin, UserManager
@@ -7,9 +10,13 @@ from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
 from django.conf import settings
 
+import numpy as np
 import pandas as pd
 import random, string
 
+from taxishare.anneal.preparations import calc_age, F_COLS, RunningStats
+from taxishare.anneal.sizing import CAPACITY
+
 
 class CustomUserManager(UserManager):
     """
@@ -62,7 +69,7 @@ class User(AbstractBaseUser, PermissionsMixin):
     birth_date = models.DateField('生年月日',null=True)
     # 性別
     sex = models.IntegerField('性別',null=True)
-    # 出発地（今回は固定値）
+    # 出発地（TAXISHARE_ORIGINSから選択する）
     origin_latitude = models.FloatField('出発地の緯度', default=35.696739)
     origin_longitude = models.FloatField('出発地の経度', default=139.814484)
     # 目的地
@@ -94,6 +101,11 @@ class User(AbstractBaseUser, PermissionsMixin):
     class Meta:
         verbose_name = _('user')
         verbose_name_plural = _('users')
+        indexes = [
+            # 配車対象の利用者の絞り込み
+            models.Index(fields=['is_staff', 'is_active'], name='user_dispatch_idx'),
+            models.Index(fields=['desitination_latitude', 'desitination_longitude'], name='user_destination_idx'),
+        ]
 
     def get_full_name(self):
         """
@@ -119,18 +131,426 @@ class User(AbstractBaseUser, PermissionsMixin):
         return self.email
 
 
+class Vehicle(models.Model):
+    """
+    配車できる実際のタクシー車両の現在地と状態を設定する。
+    """
+    # 車両名（ナンバープレートなど）
+    name = models.CharField('車両名', max_length=64, unique=True)
+    # 現在地
+    latitude = models.FloatField('現在地の緯度')
+    longitude = models.FloatField('現在地の経度')
+    # 乗せられる人数
+    capacity = models.PositiveSmallIntegerField('定員', default=CAPACITY)
+    # 配車できるかどうか（配車したら、その配車が置き換えられるか管理画面で空車に戻すまでFalse）
+    is_available = models.BooleanField('空車', default=True)
+    # 現在地を更新した日時
+    updated_at = models.DateTimeField('更新日時', auto_now=True)
+
+    class Meta:
+        verbose_name = '車両'
+        verbose_name_plural = '車両'
+        indexes = [
+            models.Index(fields=['is_available'], name='vehicle_available_idx'),
+        ]
+
+    def __str__(self):
+        return self.name
+
+
+class DispatchRun(models.Model):
+    """
+    1回の配車処理の結果をまとめる版を設定する。
+    配車結果は書き込み中の版に追加し、書き終えたら公開する。
+    最後に公開した版が現在の配車結果で、読み手は版を1つ決めて読むので書き込みを待たない。
+    """
+    WRITING = 'writing'
+    PUBLISHED = 'published'
+    STATUS_CHOICES = [
+        (WRITING, '書き込み中'),
+        (PUBLISHED, '公開済み'),
+    ]
+    STALE_SECONDS = 60*30  # これより古い書き込み中の版は、書き手が止まったとみなして破棄する
+
+    # 状態
+    status = models.CharField('状態', max_length=16, choices=STATUS_CHOICES, default=WRITING)
+    # 書き込みを始めた日時
+    created_at = models.DateTimeField('作成日時', default=timezone.now)
+    # 公開した日時
+    published_at = models.DateTimeField('公開日時', null=True, blank=True)
+    # この版で配車した利用者数
+    rider_count = models.IntegerField('配車人数', default=0)
+
+    class Meta:
+        verbose_name = '配車処理'
+        verbose_name_plural = '配車処理'
+        indexes = [
+            models.Index(fields=['status'], name='run_status_idx'),
+        ]
+        constraints = [
+            # 書き込み中の版は1つだけ（同時に作ろうとした2つ目はIntegrityErrorになる）
+            models.UniqueConstraint(fields=['status'], condition=Q(status='writing'), name='run_single_writer'),
+        ]
+
+    def __str__(self):
+        return '{} ({})'.format(self.pk, self.get_status_display())
+
+    @classmethod
+    def current_id(cls):
+        """
+        最後に公開した版のidを返す。無ければNoneを返す。
+        """
+        return cls.objects.filter(status=cls.PUBLISHED).order_by('-pk').values_list('pk', flat=True).first()
+
+    @classmethod
+    def claim(cls):
+        """
+        書き込み中の版を作る。書き込みは1つずつ行い、他の書き込み中の版があればNoneを返す。
+        止まった書き手の版は、行とともに破棄してから作る。
+        1つだけであることはデータベースの一意制約で保証する。
+        """
+        stale = timezone.now()-datetime.timedelta(seconds=cls.STALE_SECONDS)
+        with transaction.atomic():
+            cls.objects.filter(status=cls.WRITING, created_at__lte=stale).delete()
+        try:
+            with transaction.atomic():
+                return cls.objects.create()
+        except IntegrityError:  # 他の書き込み中の版がある
+            return None
+
+    def publish(self, rider_count):
+        """
+        版を公開し、現在の配車結果にする。
+        版の1行の更新だけで切り替えるので、読み手が書きかけの配車結果を見ることはない。
+        破棄されていて公開できなければFalseを返す。
+        """
+        self.status = self.PUBLISHED
+        self.published_at = timezone.now()
+        self.rider_count = rider_count
+        return bool(type(self).objects.filter(pk=self.pk, status=self.WRITING).update(
+            status=self.status, published_at=self.published_at, rider_count=rider_count))
+
+    def discard(self):
+        """
+        書き込み中の版を、追加した行とともに破棄する。
+        """
+        type(self).objects.filter(pk=self.pk, status=self.WRITING).delete()
+
+
+class TaxiQuerySet(models.QuerySet):
+    """
+    配車情報を版を指定して読み出す。
+    """
+    def visible(self, run_id=None):
+        """
+        版run_id（省略時は現在の版）の時点の配車情報に絞る。
+        その版までに追加され、まだ後の版で置き換えられていない行が見える。
+        """
+        if run_id is None:
+            run_id = DispatchRun.current_id()
+            if run_id is None:
+                return self.none()
+        return self.filter(run_id__lte=run_id).filter(Q(replaced_in__isnull=True) | Q(replaced_in__gt=run_id))
+
+
 class Taxi(models.Model):
     """
     タクシーの配車情報を設定する。
+    行は配車した版に属し、再依頼した利用者の以前の行は後の版で置き換えられる。
     """
+    # 配車した版
+    run = models.ForeignKey(DispatchRun, on_delete=models.CASCADE, related_name='taxis')
+    # 置き換えた版（置き換えられていなければNone）
+    replaced_in = models.ForeignKey(DispatchRun, on_delete=models.SET_NULL, null=True, blank=True,
+                                    related_name='replaced_taxis')
     # ユーザー
-    user = models.OneToOneField(settings.AUTH_USER_MODEL,on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     #タクシーの配車番号
     number = models.IntegerField(_('number'))
+    # 配車日時
+    dispatched_at = models.DateTimeField('配車日時', default=timezone.now)
+    # 出発地からの降車順（1から）
+    order = models.PositiveSmallIntegerField('降車順', null=True, blank=True)
+    # 乗るタクシーの出発地から最後の降車地点までの経路長
+    route_length = models.FloatField('経路長（km）', null=True, blank=True)
+    # 迎えに行く車両（空車が足りなければNone）
+    vehicle = models.ForeignKey(Vehicle, on_delete=models.SET_NULL, null=True, blank=True)
+    # 配車したときの出発地・目的地（配車後に利用者が地点を変えても、公開した版の表示は変えない）
+    origin_latitude = models.FloatField('出発地緯度', null=True, blank=True)
+    origin_longitude = models.FloatField('出発地経度', null=True, blank=True)
+    desitination_latitude = models.FloatField('目的地緯度', null=True, blank=True)
+    desitination_longitude = models.FloatField('目的地経度', null=True, blank=True)
+
+    objects = TaxiQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'タクシー'
         verbose_name_plural = 'タクシー'
+        constraints = [
+            models.UniqueConstraint(fields=['run', 'user'], name='taxi_run_user_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['number'], name='taxi_number_idx'),
+            models.Index(fields=['desitination_latitude', 'desitination_longitude'], name='taxi_destination_idx'),
+        ]
 
     def __str__(self):
         return self.user.email
+
+
+class RiderSnapshot(models.Model):
+    """
+    配車処理で読み込む利用者の特徴量を、ユーザーテーブルから切り出して保持する。
+    利用者の保存時（signals.refresh_snapshot）に作り直す。
+    bulk_createやQuerySet.updateはシグナルを送らないので、refresh_snapshotsコマンドで作り直す。
+    """
+    AGE_BUCKET = 5  # 年齢を丸める幅
+    # 利用者から写すフィールド（配車依頼日時は依頼時のみ更新する）
+    SNAPSHOT_FIELDS = ['origin_latitude', 'origin_longitude',
+                       'desitination_latitude', 'desitination_longitude', 'age', 'sex']
+    # スナップショットの内容を決める利用者のフィールド
+    SOURCE_FIELDS = {'origin_latitude', 'origin_longitude', 'desitination_latitude', 'desitination_longitude',
+                     'birth_date', 'sex', 'is_staff', 'is_active'}
+
+    # ユーザー（idは利用者idと同じ）
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True)
+    # 出発地
+    origin_latitude = models.FloatField('出発地の緯度')
+    origin_longitude = models.FloatField('出発地の経度')
+    # 目的地
+    desitination_latitude = models.FloatField('目的地の緯度')
+    desitination_longitude = models.FloatField('目的地の経度')
+    # 年齢（AGE_BUCKET歳刻み）
+    age = models.IntegerField('年齢層', null=True)
+    # 性別
+    sex = models.IntegerField('性別', null=True)
+    updated_at = models.DateTimeField('更新日時', auto_now=True)
+    # 地点情報を更新（配車を依頼）した日時
+    requested_at = models.DateTimeField('配車依頼日時', null=True)
+
+    class Meta:
+        verbose_name = '利用者スナップショット'
+        verbose_name_plural = '利用者スナップショット'
+        indexes = [
+            models.Index(fields=['requested_at'], name='snapshot_requested_idx'),
+            models.Index(fields=['origin_latitude', 'origin_longitude'], name='snapshot_origin_idx'),
+        ]
+
+    def __str__(self):
+        return str(self.user_id)
+
+    @classmethod
+    def build(cls, user, requested=False):
+        """
+        利用者のスナップショットを（保存せずに）作る。
+        配車対象外（管理者、仮登録、目的地未登録）ならNoneを返す。
+        requestedがTrueなら、配車依頼日時を現在時刻にする。
+        """
+        if (user.is_staff or not user.is_active
+                or user.desitination_latitude is None or user.desitination_longitude is None):
+            return None
+        age = None
+        if user.birth_date is not None:
+            age = calc_age(user.birth_date)//cls.AGE_BUCKET*cls.AGE_BUCKET
+        return cls(
+            user_id=user.pk,
+            origin_latitude=user.origin_latitude,
+            origin_longitude=user.origin_longitude,
+            desitination_latitude=user.desitination_latitude,
+            desitination_longitude=user.desitination_longitude,
+            age=age,
+            sex=user.sex,
+            requested_at=timezone.now() if requested else None,
+        )
+
+    def features(self):
+        """
+        標準化する特徴量（F_COLSの順）を返す。
+        """
+        return [getattr(self, c) for c in F_COLS]
+
+    @classmethod
+    def refresh(cls, user, requested=False):
+        """
+        利用者のスナップショットを作り直し、特徴量の統計量を1人分だけ更新する。
+        配車対象外（管理者、仮登録、目的地未登録）なら削除する（統計量はsignals.remove_statisticsで除く）。
+        requestedがTrueなら、配車依頼日時を現在時刻にする。
+        """
+        snapshot = cls.build(user, requested)
+        with transaction.atomic():
+            # 利用者の属する分割の統計量の行を先にロックし、同じ分割の作り直しと読み書きが交互にならないようにする
+            FeatureStatistic.rows(lock=True, shard=FeatureStatistic.shard_of(user.pk))
+            old = cls.objects.select_for_update().filter(user_id=user.pk).first()
+            old_features = None if old is None else old.features()
+            if snapshot is None:
+                if old is not None:
+                    old.delete()
+                return None
+            defaults = {f: getattr(snapshot, f) for f in cls.SNAPSHOT_FIELDS}
+            if requested:
+                defaults['requested_at'] = snapshot.requested_at
+            snapshot, _ = cls.objects.update_or_create(user_id=user.pk, defaults=defaults)
+            if old_features != snapshot.features():
+                FeatureStatistic.apply(user.pk, old_features, snapshot.features())
+        return snapshot
+
+
+class FeatureStatistic(models.Model):
+    """
+    配車処理で標準化する特徴量毎に、スナップショット全体の件数・平均・偏差平方和を保持する。
+    スナップショットの作り直しの度に1人分だけ更新するので、利用者数によらず一定の手間で済む。
+    利用者idで行をSHARDS個に分け、更新では利用者の属する行だけをロックする（読み込み時にまとめる）。
+    標準化には基準の平均・標準偏差（分割0の行に保持）を使い、統計量が許容幅（STATS_TOLERANCE）を超えて動いた時だけ取り直す。
+    """
+    SHARDS = 16  # 更新のロックを分ける数
+
+    # 特徴量名（F_COLS）
+    feature = models.CharField('特徴量', max_length=32)
+    # 分割の番号（利用者id % SHARDS）
+    shard = models.PositiveSmallIntegerField('分割', default=0)
+    # 件数
+    count = models.FloatField('件数', default=0)
+    # 平均
+    mean = models.FloatField('平均', default=0)
+    # 偏差平方和
+    m2 = models.FloatField('偏差平方和', default=0)
+    # 標準化に使う平均（分割0の行だけ使う）
+    ref_mean = models.FloatField('基準の平均', null=True, blank=True)
+    # 標準化に使う標準偏差（分割0の行だけ使う）
+    ref_std = models.FloatField('基準の標準偏差', null=True, blank=True)
+
+    class Meta:
+        verbose_name = '特徴量の統計量'
+        verbose_name_plural = '特徴量の統計量'
+        constraints = [
+            models.UniqueConstraint(fields=['feature', 'shard'], name='feature_statistic_uniq'),
+        ]
+
+    def __str__(self):
+        return '{}[{}]'.format(self.feature, self.shard)
+
+    @classmethod
+    def shard_of(cls, user_id):
+        """
+        利用者の統計量を持つ分割の番号を返す。
+        """
+        return user_id % cls.SHARDS
+
+    @classmethod
+    def load(cls):
+        """
+        分割毎の統計量をまとめて読み込む。
+        統計量が基準から許容幅を超えて動いていれば、基準を取り直して書き込む。
+        """
+        shards = {}
+        for row in cls.objects.filter(feature__in=F_COLS):
+            shards.setdefault(row.shard, {})[row.feature] = row
+        stats = RunningStats()
+        for rows in shards.values():
+            stats.merge(cls.to_stats(rows))
+        reference = cls.to_stats(shards.get(0, {}))
+        stats.ref_mean, stats.ref_std = reference.ref_mean, reference.ref_std
+        if stats.rebase() and stats.count.any():
+            for k, c in enumerate(F_COLS):
+                cls.objects.filter(feature=c, shard=0).update(
+                    ref_mean=float(stats.ref_mean[k]), ref_std=float(stats.ref_std[k]))
+        return stats
+
+    @classmethod
+    def rows(cls, lock=False, shard=0):
+        """
+        分割shardの特徴量名から行への辞書を返す。lockがTrueなら、無い行を作ってからロックする。
+        """
+        rows = cls.objects.filter(feature__in=F_COLS, shard=shard)
+        if lock:
+            # 行が無いとロックできないので、先に0件の行を作っておく
+            if rows.count() < len(F_COLS):
+                cls.objects.bulk_create([cls(feature=c, shard=shard) for c in F_COLS], ignore_conflicts=True)
+            rows = rows.select_for_update()
+        return {row.feature: row for row in rows}
+
+    @staticmethod
+    def to_stats(rows):
+        """
+        行から統計量を作る。行の無い特徴量は0件とする。
+        """
+        stats = RunningStats()
+        for k, c in enumerate(F_COLS):
+            if c in rows:
+                stats.count[k], stats.mean[k], stats.m2[k] = rows[c].count, rows[c].mean, rows[c].m2
+        if all(c in rows and rows[c].ref_mean is not None and rows[c].ref_std is not None for c in F_COLS):
+            stats.ref_mean = np.array([rows[c].ref_mean for c in F_COLS])
+            stats.ref_std = np.array([rows[c].ref_std for c in F_COLS])
+        return stats
+
+    @classmethod
+    def save_stats(cls, stats, rows):
+        """
+        ロックした分割の行に統計量を書き込む（基準の平均・標準偏差はloadで取り直す）。
+        """
+        for k, c in enumerate(F_COLS):
+            rows[c].count, rows[c].mean, rows[c].m2 = float(stats.count[k]), float(stats.mean[k]), float(stats.m2[k])
+        cls.objects.bulk_update([rows[c] for c in F_COLS], ['count', 'mean', 'm2'])
+
+    @classmethod
+    def apply(cls, user_id, old, new):
+        """
+        1人分の特徴量の変化を、利用者の属する分割の統計量に反映する。
+
+        Parameters
+        ----------
+        user_id: int
+            利用者id
+        old: list
+            変化前の特徴量（新しく加える利用者ならNone）
+        new: list
+            変化後の特徴量（除く利用者ならNone）
+        """
+        with transaction.atomic():
+            rows = cls.rows(lock=True, shard=cls.shard_of(user_id))
+            stats = cls.to_stats(rows)
+            if old is not None:
+                stats.remove(old)
+            if new is not None:
+                stats.add(new)
+            cls.save_stats(stats, rows)
+
+    @classmethod
+    def merge(cls, snapshots):
+        """
+        一括登録したスナップショットの統計量を、分割毎にまとめる。
+        """
+        by_shard = {}
+        for snapshot in snapshots:
+            by_shard.setdefault(cls.shard_of(snapshot.user_id), []).append(snapshot.features())
+        with transaction.atomic():
+            for shard, values in sorted(by_shard.items()):  # ロックの順を揃える
+                rows = cls.rows(lock=True, shard=shard)
+                stats = cls.to_stats(rows)
+                stats.merge(RunningStats.from_values(values))
+                cls.save_stats(stats, rows)
+
+    @classmethod
+    def rebuild(cls, chunk=10000):
+        """
+        スナップショット全体から統計量を求め直す（誤差の蓄積を取り除く）。
+        読み込む前に全ての分割の行をロックし、求め直す間の更新を取りこぼさない。
+        """
+        with transaction.atomic():
+            rows = [cls.rows(lock=True, shard=shard) for shard in range(cls.SHARDS)]
+            shards = [RunningStats() for _ in range(cls.SHARDS)]
+            values = RiderSnapshot.objects.order_by('pk').values_list('pk', *F_COLS)
+            last = None
+            while True:
+                # OFFSETで読み飛ばさず、主キーの続きから読む
+                page = list((values if last is None else values.filter(pk__gt=last))[:chunk])
+                if not page:
+                    break
+                last = page[-1][0]
+                array = np.array(page, dtype=np.float64)
+                shard_of = array[:, 0].astype(np.int64) % cls.SHARDS
+                for shard in np.unique(shard_of):
+                    shards[shard].merge(RunningStats.from_values(array[shard_of == shard, 1:]))
+            for shard in range(cls.SHARDS):
+                cls.save_stats(shards[shard], rows[shard])
+        return cls.load()
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import RiderSnapshot, FeatureStatistic
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def refresh_snapshot(sender, instance, raw=False, update_fields=None, **kwargs):
+    """
+    利用者を保存したら（管理画面・シェルなど経路によらず）スナップショットを作り直す。
+    スナップショットに写すフィールドを含まない部分的な保存（最終ログイン日時など）と、loaddataは除く。
+    """
+    if raw:
+        return
+    if update_fields is not None and not set(update_fields) & RiderSnapshot.SOURCE_FIELDS:
+        return
+    RiderSnapshot.refresh(instance)
+
+
+@receiver(post_delete, sender=RiderSnapshot)
+def remove_statistics(sender, instance, **kwargs):
+    """
+    スナップショットを削除したら（利用者の削除による連鎖削除を含む）、特徴量の統計量から1人分除く。
+    """
+    FeatureStatistic.apply(instance.user_id, instance.features(), None)
@@ -0,0 +1,159 @@
+import os
+import json
+import zlib
+import struct
+
+import numpy as np
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+CELL = 64  # スプライトの1マスの大きさ（表示の2倍程度にして高解像度の画面でもぼけないようにする）
+
+
+def read_png(path):
+    """
+    8bit RGBA（カラータイプ6、インターレース無し）のPNGを読み込む。
+
+    Parameters
+    ----------
+    path: str
+        PNGファイル
+
+    Returns
+    -------
+    image: numpy.ndarray
+        高さ×幅×4のuint8配列
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError('not a PNG file: {}'.format(path))
+    pos = 8
+    idat = []
+    while pos < len(data):
+        length, kind = struct.unpack('>I4s', data[pos:pos+8])
+        body = data[pos+8:pos+8+length]
+        if kind == b'IHDR':
+            width, height, depth, color, _, _, interlace = struct.unpack('>IIBBBBB', body)
+            if (depth, color, interlace) != (8, 6, 0):
+                raise ValueError('only 8-bit non-interlaced RGBA PNG is supported: {}'.format(path))
+        elif kind == b'IDAT':
+            idat.append(body)
+        pos += 12+length
+
+    bpp = 4
+    stride = width*bpp
+    raw = zlib.decompress(b''.join(idat))
+    image = np.zeros((height, stride), dtype=np.uint8)
+    prev = np.zeros(stride, dtype=np.uint8)
+    for y in range(height):
+        kind = raw[y*(stride+1)]
+        line = np.frombuffer(raw, dtype=np.uint8, count=stride, offset=y*(stride+1)+1)
+        if kind == 0:  # None
+            row = line.copy()
+        elif kind == 1:  # Sub
+            row = np.cumsum(line.reshape(-1, bpp), axis=0, dtype=np.uint8).reshape(-1)
+        elif kind == 2:  # Up
+            row = line+prev
+        else:  # Average, Paethは左の画素に依存するので1画素ずつ戻す
+            row = bytearray(stride)
+            up = prev.tolist()
+            for x, v in enumerate(line.tolist()):
+                a = row[x-bpp] if x >= bpp else 0
+                b = up[x]
+                if kind == 3:
+                    row[x] = (v+(a+b)//2) & 0xff
+                else:
+                    c = up[x-bpp] if x >= bpp else 0
+                    p = a+b-c
+                    pa, pb, pc = abs(p-a), abs(p-b), abs(p-c)
+                    row[x] = (v+(a if pa <= pb and pa <= pc else b if pb <= pc else c)) & 0xff
+            row = np.frombuffer(bytes(row), dtype=np.uint8)
+        image[y] = row
+        prev = image[y]
+    return image.reshape(height, width, bpp)
+
+
+def write_png(path, image):
+    """
+    高さ×幅×4のuint8配列を、RGBAのPNGとして書き出す。
+    """
+    height, width, _ = image.shape
+
+    def chunk(kind, body):
+        return struct.pack('>I', len(body))+kind+body+struct.pack('>I', zlib.crc32(kind+body) & 0xffffffff)
+
+    raw = np.hstack([np.zeros((height, 1), dtype=np.uint8), image.reshape(height, -1)])  # 各行のフィルタは0
+    with open(path, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 9)))
+        f.write(chunk(b'IEND', b''))
+
+
+def resize(image, size):
+    """
+    正方形の画像を、アルファで重み付けした平均で縮小する。
+    """
+    height, width, _ = image.shape
+    factor = height//size
+    if height != width or factor*size != height:
+        raise ValueError('image size must be a multiple of {}: {}x{}'.format(size, width, height))
+    block = image.astype(np.float64).reshape(size, factor, size, factor, 4)
+    alpha = block[..., 3:]
+    weight = alpha.sum(axis=(1, 3))
+    color = (block[..., :3]*alpha).sum(axis=(1, 3))/np.maximum(weight, 1)
+    alpha = weight/factor**2
+    return np.concatenate([color, alpha], axis=-1).round().astype(np.uint8)
+
+
+def sort_key(name):
+    """
+    番号付きのマーカーを番号順に、残りを名前順に並べる。
+    """
+    return (0, int(name), '') if name.isdigit() else (1, 0, name)
+
+
+def build(source_dir, output_dir, cell=CELL, name='markers'):
+    """
+    マーカー画像を横1列のスプライトにまとめ、配置をJSONに書き出す。
+    内容の同じ画像は1マスにまとめる。
+
+    Parameters
+    ----------
+    source_dir: str
+        マーカー画像（PNG）のディレクトリ
+    output_dir: str
+        書き出すディレクトリ
+    cell: int
+        1マスの大きさ（px）
+    name: str
+        書き出すファイル名（拡張子なし）
+
+    Returns
+    -------
+    layout: dictionary
+        スプライトの配置（cell, columns, names, numbered）
+    """
+    names = sorted((os.path.splitext(f)[0] for f in os.listdir(source_dir) if f.endswith('.png')), key=sort_key)
+    cells = []
+    index = {}
+    seen = {}
+    for n in names:
+        image = resize(read_png(os.path.join(source_dir, n+'.png')), cell)
+        digest = image.tobytes()
+        if digest not in seen:
+            seen[digest] = len(cells)
+            cells.append(image)
+        index[n] = seen[digest]
+    layout = {
+        'cell': cell,
+        'columns': len(cells),
+        'names': index,
+        'numbered': sum(n.isdigit() for n in names),
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    write_png(os.path.join(output_dir, name+'.png'), np.hstack(cells))
+    with open(os.path.join(output_dir, name+'.json'), 'w') as f:
+        json.dump(layout, f, indent=1, sort_keys=True)
+    return layout
@@ -0,0 +1,52 @@
+import gzip
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+try:
+    import brotli
+except ImportError:  # brotliが無ければgzipのみ作る
+    brotli = None
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    ファイル名に内容のハッシュを付け、圧縮したファイル（.gz, .br）も書き出す静的ファイルのストレージ。
+    ハッシュ付きのファイルは内容が変わらないので、配信側で長期間キャッシュさせる。
+    collectstatic前（開発・テスト時）はハッシュの無いファイル名を返す。
+    """
+    COMPRESS_EXTENSIONS = ('.css', '.js', '.json', '.svg', '.txt', '.html', '.map')
+    MIN_SIZE = 200  # これより小さいファイルは圧縮しない
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            if self.hashed_files:
+                raise
+            return name
+
+    def post_process(self, paths, dry_run=False, **options):
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            if not dry_run and not isinstance(processed, Exception) and hashed_name:
+                self.compress(name)
+                self.compress(hashed_name)
+            yield name, hashed_name, processed
+
+    def compress(self, name):
+        """
+        圧縮すると小さくなるファイルの.gz（brotliがあれば.brも）を書き出す。
+        """
+        if not name.endswith(self.COMPRESS_EXTENSIONS) or not self.exists(name):
+            return
+        with self.open(name) as f:
+            content = f.read()
+        if len(content) < self.MIN_SIZE:
+            return
+        compressed = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            compressed['.br'] = brotli.compress(content)
+        for ext, data in compressed.items():
+            if len(data) < len(content):
+                path = self.path(name+ext)
+                with open(path, 'wb') as f:
+                    f.write(data)
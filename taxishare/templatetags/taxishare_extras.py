@@ -0,0 +1,28 @@
+import json
+from functools import lru_cache
+
+from django import template
+from django.contrib.staticfiles import finders
+from django.templatetags.static import static
+from django.utils.html import json_script
+
+register = template.Library()
+
+SPRITE = 'taxishare/common/markers'
+
+
+@lru_cache(maxsize=None)
+def sprite_layout():
+    """
+    build_spritesで書き出したスプライトの配置を読み込む。
+    """
+    with open(finders.find(SPRITE+'.json')) as f:
+        return json.load(f)
+
+
+@register.simple_tag
+def marker_sprite():
+    """
+    マーカーのスプライトのURLと配置を、markers.jsから読めるようにJSONで埋め込む。
+    """
+    return json_script(dict(sprite_layout(), url=static(SPRITE+'.png')), 'marker-sprite')
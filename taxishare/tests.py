@@ -1,3 +1,787 @@
-from django.test import TestCase
+import os
+import datetime
+import itertools
+import shutil
+import tempfile
+import threading
+import time
+from functools import partial
+from unittest import mock, skipIf
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+
+from taxishare import dispatch, admission
+from taxishare.anneal import (
+    partition, reduction, main, sizing, modeling, shared, fleet, anytime, benchmark, tuning, preparations, kernels,
+    tabu, batching, async_solver, stub, routing
+)
+from taxishare.anneal.preparations import F_COLS, RunningStats
+from taxishare.models import User, Taxi, DispatchRun, RiderSnapshot, FeatureStatistic, Vehicle
+
+
+def make_user(i):
+    """
+    テスト用の利用者を作る。
+    """
+    return User.objects.create_user(
+        'rider{}@example.com'.format(i), 'password', birth_date=datetime.date(1980, 1, 1), sex=1,
+        origin_latitude=35.68, origin_longitude=139.76,
+        desitination_latitude=35.60+0.01*i, desitination_longitude=139.70+0.01*i)
+
+
+def make_batch(users):
+    """
+    利用者のバッチ（配車処理に渡す特徴量データフレーム）を作る。
+    """
+    return pd.DataFrame({
+        'id': [u.pk for u in users],
+        'origin_latitude': [u.origin_latitude for u in users],
+        'origin_longitude': [u.origin_longitude for u in users],
+        'desitination_latitude': [u.desitination_latitude for u in users],
+        'desitination_longitude': [u.desitination_longitude for u in users],
+    })
+
+
+class DispatchRunTests(TestCase):
+    """
+    配車結果の版の作成・公開・読み出し・削除を確認する。
+    """
+    def setUp(self):
+        self.users = [make_user(i) for i in range(4)]
+
+    def dispatch(self, users, number_list):
+        run = DispatchRun.claim()
+        self.assertIsNotNone(run)
+        dispatch.save(run, [make_batch(users)], [number_list])
+        return run
+
+    def test_claim_allows_single_writer(self):
+        run = DispatchRun.claim()
+        self.assertIsNone(DispatchRun.claim())
+        self.assertTrue(run.publish(0))
+        self.assertIsNotNone(DispatchRun.claim())
+
+    def test_stale_writer_is_discarded(self):
+        run = DispatchRun.claim()
+        DispatchRun.objects.filter(pk=run.pk).update(
+            created_at=run.created_at-datetime.timedelta(seconds=DispatchRun.STALE_SECONDS+1))
+        self.assertIsNotNone(DispatchRun.claim())
+        self.assertFalse(run.publish(0))
+
+    def test_unpublished_run_is_invisible(self):
+        first = self.dispatch(self.users, [0, 0, 1, 1])
+        self.assertEqual(Taxi.objects.visible().count(), 0)
+        first.publish(4)
+        self.assertEqual(Taxi.objects.visible().count(), 4)
+
+        # 再依頼した利用者の行は、公開するまで以前の版のものが見える
+        second = self.dispatch(self.users[:2], [0, 1])
+        self.assertEqual(set(Taxi.objects.visible().values_list('run_id', flat=True)), {first.pk})
+        second.publish(2)
+        visible = dict(Taxi.objects.visible().values_list('user_id', 'run_id'))
+        self.assertEqual(len(visible), 4)
+        self.assertEqual({visible[u.pk] for u in self.users[:2]}, {second.pk})
+        self.assertEqual({visible[u.pk] for u in self.users[2:]}, {first.pk})
+        # 以前の版を指定すれば、その時点の配車結果が見える
+        self.assertEqual(set(Taxi.objects.visible(first.pk).values_list('run_id', flat=True)), {first.pk})
+
+    def test_discard_removes_rows(self):
+        run = self.dispatch(self.users, [0, 0, 1, 1])
+        run.discard()
+        self.assertFalse(Taxi.objects.exists())
+        self.assertFalse(DispatchRun.objects.exists())
+
+    def test_collect_garbage_keeps_recent_runs(self):
+        runs = []
+        for _ in range(3):
+            run = self.dispatch(self.users, [0, 0, 1, 1])
+            run.publish(4)
+            runs.append(run)
+        self.assertEqual(Taxi.objects.count(), 12)
+        deleted = dispatch.collect_garbage(keep=2)
+        # 新しい2つの版から見えない（最初の版の）行と、行の無くなった版を消す
+        self.assertEqual(deleted, 4)
+        self.assertEqual(set(DispatchRun.objects.values_list('pk', flat=True)), {runs[1].pk, runs[2].pk})
+        self.assertEqual(set(Taxi.objects.visible().values_list('run_id', flat=True)), {runs[2].pk})
+        self.assertEqual(set(Taxi.objects.visible(runs[1].pk).values_list('run_id', flat=True)), {runs[1].pk})
+
+    def test_replaced_vehicles_are_released(self):
+        vehicles = [Vehicle.objects.create(name='car{}'.format(i), latitude=35.68, longitude=139.76)
+                    for i in range(3)]
+        first = self.dispatch(self.users, [0, 0, 1, 1])
+        first.publish(4)
+        Vehicle.objects.filter(pk__in=Taxi.objects.values('vehicle_id')).update(is_available=False)
+        used = dict(Taxi.objects.values_list('user_id', 'vehicle_id'))
+        self.assertEqual(Vehicle.objects.filter(is_available=True).count(), 1)
+
+        # 1台目の2人が再依頼して別々のタクシーになれば、1台目は空車に戻る
+        second = self.dispatch(self.users[:2], [0, 1])
+        second.publish(2)
+        Vehicle.objects.filter(pk__in=Taxi.objects.filter(run=second).values('vehicle_id')).update(
+            is_available=False)
+        dispatch.release_vehicles(second)
+        self.assertTrue(Vehicle.objects.get(pk=used[self.users[0].pk]).is_available)
+        self.assertFalse(Vehicle.objects.get(pk=used[self.users[2].pk]).is_available)
+
+
+class TaxiMarkersTests(TestCase):
+    """
+    配車後に利用者が目的地を変えても、公開した版のマーカーが動かないことを確認する。
+    """
+    def test_markers_use_dispatched_destination(self):
+        users = [make_user(i) for i in range(2)]
+        run = DispatchRun.claim()
+        dispatch.save(run, [make_batch(users)], [[0, 0]])
+        run.publish(2)
+        before = users[0].desitination_latitude
+        users[0].desitination_latitude = before+1.0
+        users[0].save()
+
+        staff = User.objects.create_user('staff@example.com', 'password', is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get(reverse('taxishare:taxi_markers', kwargs={'pk': staff.pk}))
+        latitudes = sorted(row[0] for row in response.json()['markers'])
+        self.assertEqual(latitudes, sorted([round(before, 6), round(users[1].desitination_latitude, 6)]))
+
+        response = self.client.get(reverse('taxishare:taxi_result', kwargs={'pk': staff.pk}))
+        path = response.context['routes'][0]['path']
+        self.assertIn(before, [p[0] for p in path])
+        self.assertNotIn(users[0].desitination_latitude, [p[0] for p in path])
+
+    def test_result_centers_on_rider_origin(self):
+        users = [make_user(i) for i in range(2)]
+        _, lat, lng = settings.TAXISHARE_ORIGINS[1]
+        batch = make_batch(users)
+        batch['origin_latitude'], batch['origin_longitude'] = lat, lng  # 両国駅から配車した
+        run = DispatchRun.claim()
+        dispatch.save(run, [batch], [[0, 0]])
+        run.publish(2)
+        self.client.force_login(users[0])
+        response = self.client.get(reverse('taxishare:taxi_result', kwargs={'pk': users[0].pk}))
+        self.assertEqual(response.context['origin'], {'lat': lat, 'lng': lng})
+        self.assertEqual(response.context['routes'][0]['path'][0], [lat, lng])
+
+
+class RiderSnapshotTests(TestCase):
+    """
+    利用者の作成・更新・削除の経路によらず、スナップショットと特徴量の統計量が追従することを確認する。
+    """
+    def assertStatsMatch(self):
+        expected = RunningStats.from_values(np.array(RiderSnapshot.objects.values_list(*F_COLS), dtype=np.float64))
+        stats = FeatureStatistic.load()
+        np.testing.assert_allclose(stats.count, expected.count)
+        np.testing.assert_allclose(stats.mean, expected.mean, atol=1e-9)
+        np.testing.assert_allclose(stats.m2, expected.m2, atol=1e-6)
+
+    def test_save_and_delete_follow_user(self):
+        users = [make_user(i) for i in range(3)]
+        self.assertEqual(RiderSnapshot.objects.count(), 3)
+        users[0].desitination_latitude = 36.0
+        users[0].save()
+        self.assertEqual(RiderSnapshot.objects.get(pk=users[0].pk).desitination_latitude, 36.0)
+        users[1].is_active = False
+        users[1].save()
+        users[2].delete()
+        self.assertEqual(list(RiderSnapshot.objects.values_list('pk', flat=True)), [users[0].pk])
+        self.assertStatsMatch()
+
+    def test_place_update_requests_dispatch(self):
+        user = make_user(0)
+        self.client.force_login(user)
+        response = self.client.post(reverse('taxishare:place_update', kwargs={'pk': user.pk}), {
+            'origin': 0, 'desitination_latitude': 35.7, 'desitination_longitude': 139.8})
+        self.assertRedirects(response, reverse('taxishare:place_update_done', kwargs={'pk': user.pk}))
+        snapshot = RiderSnapshot.objects.get(pk=user.pk)
+        self.assertIsNotNone(snapshot.requested_at)
+        self.assertEqual(snapshot.desitination_latitude, 35.7)
+        self.assertStatsMatch()
+
+    def test_refresh_snapshots_backfills_bulk_changes(self):
+        users = [make_user(i) for i in range(4)]
+        User.objects.filter(pk=users[0].pk).update(desitination_latitude=36.5)  # シグナルを送らない更新
+        RiderSnapshot.objects.filter(pk=users[1].pk).delete()
+        call_command('refresh_snapshots', stdout=open(os.devnull, 'w'))
+        self.assertEqual(RiderSnapshot.objects.count(), 4)
+        self.assertEqual(RiderSnapshot.objects.get(pk=users[0].pk).desitination_latitude, 36.5)
+        self.assertStatsMatch()
+
+    def test_import_merges_statistics_by_shard(self):
+        call_command('import_riders', '--synthetic', '40', stdout=open(os.devnull, 'w'))
+        self.assertEqual(RiderSnapshot.objects.count(), 40)
+        self.assertStatsMatch()
+
+    def test_statistics_are_sharded_by_user(self):
+        users = [make_user(i) for i in range(5)]
+        shards = set(FeatureStatistic.objects.values_list('shard', flat=True))
+        self.assertEqual(shards, {FeatureStatistic.shard_of(u.pk) for u in users})
+        users[0].desitination_latitude = 36.0
+        users[0].save()
+        self.assertStatsMatch()
+        # 求め直しても、分割毎の更新をまとめたものと一致する（1件ずつ読むのでページ送りも通る）
+        before = FeatureStatistic.load()
+        after = FeatureStatistic.rebuild(chunk=1)
+        np.testing.assert_allclose(after.mean, before.mean, atol=1e-9)
+        np.testing.assert_allclose(after.m2, before.m2, atol=1e-6)
+        self.assertStatsMatch()
+
+
+def brute_force(dist_array, taxi, capacity):
+    """
+    全ての配車番号を調べて、制約を満たす中で最小の目的関数値を求める。
+    """
+    user = len(dist_array)
+    return min(partition.calc_objective(dist_array, number)
+               for number in itertools.product(range(taxi), repeat=user)
+               if partition.check_feasible(number, taxi, capacity))
+
+
+class FleetAssignTests(SimpleTestCase):
+    """
+    車両の割り当てが、全ての割り当てを調べた結果と一致するか確認する。
+    """
+    def brute_force(self, cost, allowed):
+        """
+        割り当てる組の数を最大にし、その中で迎車距離の総和を最小にする。
+        """
+        n_group, n_vehicle = cost.shape
+        best = (0, 0.0)
+        for chosen in itertools.product(range(-1, n_vehicle), repeat=n_group):
+            used = [v for v in chosen if v >= 0]
+            if len(used) != len(set(used)) or any(v >= 0 and not allowed[g, v] for g, v in enumerate(chosen)):
+                continue
+            value = (-len(used), sum(cost[g, v] for g, v in enumerate(chosen) if v >= 0))
+            if value[0] < best[0] or (value[0] == best[0] and value[1] < best[1]-1e-12):
+                best = value
+        return -best[0], best[1]
+
+    def test_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        for _ in range(300):
+            n_group, n_vehicle = rng.integers(1, 5), rng.integers(1, 5)
+            group_lat, group_lon = 35.7+rng.random(n_group)*0.1, 139.8+rng.random(n_group)*0.1
+            vehicle_lat, vehicle_lon = 35.7+rng.random(n_vehicle)*0.1, 139.8+rng.random(n_vehicle)*0.1
+            size, capacity = rng.integers(1, 5, n_group), rng.integers(1, 5, n_vehicle)
+            max_km = rng.choice([None, 5.0])
+            vehicle, distance = fleet.assign(group_lat, group_lon, size, vehicle_lat, vehicle_lon, capacity, max_km)
+
+            cost = fleet.pickup_cost(group_lat, group_lon, vehicle_lat, vehicle_lon)
+            allowed = capacity[None, :] >= size[:, None]
+            if max_km is not None:
+                allowed &= cost <= max_km
+            count, total = self.brute_force(cost, allowed)
+            assigned = vehicle != fleet.UNASSIGNED
+            self.assertEqual(assigned.sum(), count)
+            self.assertEqual(len(set(vehicle[assigned])), count)
+            self.assertTrue(allowed[np.flatnonzero(assigned), vehicle[assigned]].all())
+            self.assertAlmostEqual(np.nansum(distance), total)
+
+
+class SolveExactTests(SimpleTestCase):
+    """
+    分枝限定法の解が全探索の最適解と一致するか確認する。
+    """
+    def test_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        for user, taxi, capacity in [(4, 2, 2), (5, 2, 3), (6, 3, 2), (7, 3, 3)]:
+            for _ in range(3):
+                dist_array = np.triu(rng.random((user, user)), 1)
+                solution = partition.solve_exact(dist_array, taxi, capacity)
+                self.assertTrue(partition.check_feasible(solution.number, taxi, capacity))
+                self.assertAlmostEqual(solution.objective, partition.calc_objective(dist_array, solution.number))
+                self.assertAlmostEqual(solution.objective, brute_force(dist_array, taxi, capacity))
+
+    def test_rejects_over_capacity(self):
+        with self.assertRaises(ValueError):
+            partition.solve_exact(np.zeros((5, 5)), 2, 2)
+
+
+class AnytimeRaceTests(SimpleTestCase):
+    """
+    期限を過ぎたら、負けたソルバーも最後まで計算せずに打ち切ることを確認する。
+    """
+    def test_losers_stop_after_budget(self):
+        rng = np.random.default_rng(0)
+        user = 16
+        point = rng.random((user, 2))
+        dist_array = np.triu(np.sqrt(((point[:, None]-point[None])**2).sum(axis=-1)), 1)
+        taxi = sizing.calc_taxi_number(user)
+        model = main.build_model(dist_array, taxi)
+        benchmark.warm_up(['sa', 'tabu'])  # Numbaのコンパイル中は打ち切れないので先に済ませる
+        tasks = {e: partial(main.run_engine, dist_array, taxi, e, model if e in main.QUBO_SOLVERS else None, 0.05, None)
+                 for e in ['local', 'sa', 'tabu', 'exact']}
+        incumbent = anytime.race(tasks, 0.05, dist_array, taxi, sizing.CAPACITY)
+        self.assertIsNotNone(incumbent.best)
+        # 焼きなまし法は既定のパラメータで最後まで計算すると数秒かかる
+        deadline = time.perf_counter()+1
+        while any(t.name.startswith('anytime') for t in threading.enumerate()) and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        self.assertFalse([t.name for t in threading.enumerate() if t.name.startswith('anytime')])
+
+
+class FeatureDistancesTests(SimpleTestCase):
+    """
+    特徴量毎の距離行列から求めたデータ間距離が、元の式（全ての特徴量の重み付き和）と一致し、
+    重みが0の特徴量の距離行列は求めないことを確認する。
+    """
+    WEIGHTS = [[1, 1, 1], [2, 0, 1], [0, 0, 3], [0.5, 0.2, 0]]
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.norm_df = pd.DataFrame(rng.normal(size=(7, len(F_COLS))), columns=F_COLS)
+
+    def baseline(self, f_w):
+        """
+        元のcalc_dist_arrayの式でデータ間距離を求める。
+        """
+        def square_diff(f):
+            return (f[:, None]-f[None, :])**2
+        df = self.norm_df
+        direct = np.sqrt(square_diff(df['desitination_latitude'].values)
+                         +square_diff(df['desitination_longitude'].values))
+        dist = f_w[0]*direct+f_w[1]*square_diff(df['age'].values)+f_w[2]*square_diff(df['sex'].values)
+        return np.triu(dist/sum(f_w))
+
+    def test_combine_and_sweep_match_baseline(self):
+        distances = preparations.FeatureDistances(self.norm_df)
+        for f_w in self.WEIGHTS:
+            np.testing.assert_allclose(distances.combine(f_w), self.baseline(f_w))
+            np.testing.assert_allclose(preparations.calc_dist_array(self.norm_df, f_w), self.baseline(f_w))
+        swept = distances.sweep(self.WEIGHTS)
+        for f_w, dist_array in zip(self.WEIGHTS, swept):
+            np.testing.assert_allclose(dist_array, self.baseline(f_w))
+
+        number = np.array([0, 1, 0, 2, 1, 2, 0])
+        for f_w, objective in zip(self.WEIGHTS, distances.evaluate(number, self.WEIGHTS)):
+            self.assertAlmostEqual(objective, partition.calc_objective(self.baseline(f_w), number))
+
+    def test_zero_weight_matrix_is_not_computed(self):
+        distances = preparations.FeatureDistances(self.norm_df)
+        distances.combine([1, 0, 0])
+        self.assertEqual(set(distances.matrices), {'direct'})
+        distances.sweep([[1, 0, 0], [0.5, 0.2, 0]])
+        self.assertEqual(set(distances.matrices), {'direct', 'age'})
+        with self.assertRaises(ValueError):
+            distances.combine([0, 0, 0])
+
+    def test_features_are_cached_per_group(self):
+        df = pd.DataFrame({
+            'desitination_latitude': [35.6, 35.7, 35.8], 'desitination_longitude': [139.7, 139.8, 139.9],
+            'age': [20, 40, 60], 'sex': [1, -1, 1]})
+        distances = preparations.features(df)
+        self.assertIs(preparations.features(df.copy()), distances)
+        np.testing.assert_allclose(main.calc_dist(df), distances.combine(main.F_WEIGHT))
+        other = df.assign(age=[21, 40, 60])
+        self.assertIsNot(preparations.features(other), distances)
+
+
+def random_qubo(rng, n):
+    """
+    乱数の係数のQUBO（qubits係数の辞書）と、全ての状態を調べた最小のエネルギーを返す。
+    """
+    coefficient_array = np.triu(rng.normal(size=(n, n)))
+    const = float(rng.normal())
+    row, col = coefficient_array.nonzero()
+    terms = [{'coefficient': float(coefficient_array[r, c]), 'polynomials': [int(r), int(c)]} for r, c in zip(row, col)]
+    terms.append({'coefficient': const, 'polynomials': []})
+    best = min(float(np.dot(x, coefficient_array @ x))+const for x in itertools.product([0, 1], repeat=n))
+    return {'binary_polynomial': {'terms': terms}}, best
+
+
+def small_dispatch(rng, user):
+    """
+    小さな配車の問題（データ間距離、タクシー数、目的関数、全探索の最適値）を作る。
+    """
+    point = rng.random((user, 2))
+    dist_array = np.triu(np.sqrt(((point[:, None]-point[None])**2).sum(axis=-1)), 1)
+    taxi = sizing.calc_taxi_number(user)
+    return dist_array, taxi, main.build_model(dist_array, taxi), brute_force(dist_array, taxi, sizing.CAPACITY)
+
+
+class SASolverTests(SimpleTestCase):
+    """
+    焼きなまし法のカーネル（Numba・NumPy実装）が、小さな問題で厳密な最適解に届くことを確認する。
+    """
+    def solvers(self):
+        for backend in kernels.KERNELS:
+            solver = kernels.SASolver(backend)
+            if backend == 'numpy':
+                solver.params.update(number_iterations=1000, number_replicas=4)  # NumPy実装は遅いので減らす
+            yield solver
+
+    def test_reaches_optimum(self):
+        rng = np.random.default_rng(0)
+        problems = [random_qubo(rng, 10) for _ in range(3)]
+        for solver in self.solvers():
+            for qubit_dict, best in problems:
+                response = solver.minimize(qubit_dict)
+                self.assertAlmostEqual(response.energy, best, msg=solver.backend)
+                x = [response.config[i] for i in range(10)]
+                self.assertAlmostEqual(kernels.SparseQUBO.from_dict(qubit_dict).energy(x), best)
+
+    def test_reaches_optimal_dispatch(self):
+        rng = np.random.default_rng(1)
+        for solver in self.solvers():
+            for user in [4, 5]:
+                dist_array, taxi, model, best = small_dispatch(rng, user)
+                solution = main.decode(solver.minimize(model.to_dict()), dist_array, taxi, model, 'sa', 0.0)
+                self.assertAlmostEqual(solution.objective, best, msg=solver.backend)
+
+
+class TabuSolverTests(SimpleTestCase):
+    """
+    タブー探索のカーネル（Numba・NumPy実装）が、小さな問題で厳密な最適解に届くことを確認する。
+    """
+    def solvers(self):
+        for backend in tabu.TABU_KERNELS:
+            yield tabu.TabuSolver(backend)
+
+    def test_reaches_optimum(self):
+        rng = np.random.default_rng(0)
+        problems = [random_qubo(rng, 10) for _ in range(3)]
+        for solver in self.solvers():
+            for qubit_dict, best in problems:
+                response = solver.minimize(qubit_dict)
+                self.assertAlmostEqual(response.energy, best, msg=solver.backend)
+                x = [response.config[i] for i in range(10)]
+                self.assertAlmostEqual(kernels.SparseQUBO.from_dict(qubit_dict).energy(x), best)
+
+    def test_reaches_optimal_dispatch(self):
+        rng = np.random.default_rng(1)
+        for solver in self.solvers():
+            for user in [4, 5]:
+                dist_array, taxi, model, best = small_dispatch(rng, user)
+                solution = main.decode(solver.minimize(model.to_dict()), dist_array, taxi, model, 'tabu', 0.0)
+                self.assertAlmostEqual(solution.objective, best, msg=solver.backend)
+
+    def test_stop_keeps_best_so_far(self):
+        # 打ち切りの合図があっても、区切りまでの最良の状態とそのエネルギーを返す
+        qubit_dict, _ = random_qubo(np.random.default_rng(2), 10)
+        solver = tabu.TabuSolver()
+        solver.stop = threading.Event()
+        solver.stop.set()
+        response = solver.minimize(qubit_dict)
+        x = [response.config[i] for i in range(10)]
+        self.assertAlmostEqual(kernels.SparseQUBO.from_dict(qubit_dict).energy(x), response.energy)
+
+
+class BatchingTests(SimpleTestCase):
+    """
+    ブロック対角にまとめた問題の解を分けたとき、問題毎のエネルギーがそれぞれの問題で計算し直したものと一致することを確認する。
+    """
+    def test_split_energies_match_blocks(self):
+        rng = np.random.default_rng(0)
+        qubit_dicts = [random_qubo(rng, n)[0] for n in [3, 5, 4]]
+        merged, offsets = batching.merge(qubit_dicts)
+        self.assertEqual(offsets, [0, 3, 8])
+        whole = kernels.SparseQUBO.from_dict(merged)
+        for _ in range(5):
+            x = rng.integers(0, 2, whole.n)
+            response = modeling.Response({
+                'solutions': [{'configuration': {str(i): int(v) for i, v in enumerate(x)},
+                               'energy': whole.energy(x)}],
+                'timing': {'solve_time': 1}})
+            responses = batching.split(response, qubit_dicts, offsets)
+            energies = []
+            for qd, offset, r in zip(qubit_dicts, offsets, responses):
+                n = batching.count_qubit(qd)
+                block = x[offset:offset+n]
+                self.assertEqual([r.config[i] for i in range(n)], block.tolist())
+                self.assertAlmostEqual(r.energy, kernels.SparseQUBO.from_dict(qd).energy(block))
+                self.assertEqual(r.timing['batch_size'], 3)
+                energies.append(r.energy)
+            # 定数項もまとめているので、ブロック毎のエネルギーの和はまとめた問題のエネルギーになる
+            self.assertAlmostEqual(sum(energies), response.energy)
+
+    def test_batch_solver_returns_in_order(self):
+        rng = np.random.default_rng(1)
+        problems = [random_qubo(rng, n) for n in [4, 6, 5]]
+        solver = batching.BatchSolver(kernels.SASolver(), max_qubit=10)
+        responses = solver.minimize_all([qd for qd, _ in problems])
+        for (_, best), response in zip(problems, responses):
+            self.assertAlmostEqual(response.energy, best)
+
+
+@skipIf(async_solver.aiohttp is None, 'requires aiohttp')
+class AsyncSolverTests(SimpleTestCase):
+    """
+    スタブサーバーに複数の問題を同時に投げ、結果が問題の順に返ることを確認する。
+    """
+    def test_gather_through_stub(self):
+        rng = np.random.default_rng(0)
+        problems = [random_qubo(rng, n) for n in [4, 6, 5, 7]]
+        latency = 0.3
+        with stub.serve(latency) as url:
+            solver = async_solver.AsyncDAPTSolver(limit=4)
+            solver.url = url
+            started = time.perf_counter()
+            responses = solver.run([qd for qd, _ in problems])
+            elapsed = time.perf_counter()-started
+            # 同時に投げるので、待ち時間は問題数分積み上がらない
+            self.assertLess(elapsed, latency*len(problems))
+            for (_, best), response in zip(problems, responses):
+                self.assertAlmostEqual(response.energy, best)
+
+            # まとめて投げるBatchSolverからも、非同期にまとめた問題を同時に投げる
+            batch = batching.BatchSolver(solver, max_qubit=10)
+            for (_, best), response in zip(problems, batch.minimize_all([qd for qd, _ in problems])):
+                self.assertAlmostEqual(response.energy, best)
+
+
+class RoutingTests(SimpleTestCase):
+    """
+    タクシー毎の降車順が、地点数の少ないタクシーでは全順列の最適な順と一致し、
+    2-optで求めるタクシーでも与えられた順（利用者の順）より長くならないことを確認する。
+    """
+    def test_plan(self):
+        rng = np.random.default_rng(0)
+        origin = (35.69, 139.70)
+        for _ in range(20):
+            number = np.repeat(np.arange(4), [1, 3, routing.EXACT_STOPS+2, routing.EXACT_STOPS+4])
+            rng.shuffle(number)
+            destinations = np.column_stack([35.6+rng.random(len(number))*0.2, 139.6+rng.random(len(number))*0.2])
+            order, route_length = routing.plan(origin, destinations, number)
+
+            points = np.vstack([[origin], destinations])
+            dist = routing.distance_matrix(points[:, 0], points[:, 1])
+            for k in range(4):
+                stops = np.flatnonzero(number == k)+1
+                self.assertEqual(sorted(order[stops-1]), list(range(1, len(stops)+1)))
+                route = stops[np.argsort(order[stops-1])]
+                self.assertTrue(np.allclose(route_length[stops-1], routing.path_length(dist, route)))
+                if len(stops) <= routing.EXACT_STOPS:
+                    best = min(routing.path_length(dist, list(p)) for p in itertools.permutations(stops))
+                    self.assertAlmostEqual(route_length[stops[0]-1], best)
+                else:
+                    self.assertLessEqual(route_length[stops[0]-1], routing.path_length(dist, stops)+1e-12)
+
+    def test_heuristic_keeps_shorter_given_order(self):
+        # 出発地を挟んで一直線に並んだ地点では、最近傍法の順（+1, +3, -1.5）を2-optで直せないが、
+        # 与えられた順（-1.5, +1, +3）の方が短い
+        lat = 35.0+0.01*np.array([0, -1.5, 1, 3])
+        dist = routing.distance_matrix(lat, np.full(len(lat), 139.0))
+        stops = np.array([1, 2, 3])
+        route, length = routing.route_heuristic(dist, stops)
+        self.assertEqual(route.tolist(), stops.tolist())
+        self.assertAlmostEqual(length, routing.path_length(dist, stops))
+
+
+class RunningStatsTests(SimpleTestCase):
+    """
+    逐次更新・結合した統計量がnumpyの平均・分散と一致するか確認する。
+    """
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.values = rng.normal(50, 10, (200, len(F_COLS)))
+        self.values[rng.random(self.values.shape) < 0.1] = np.nan  # 値の無い特徴量
+
+    def assertMatches(self, stats, values):
+        np.testing.assert_array_equal(stats.count, (~np.isnan(values)).sum(axis=0))
+        np.testing.assert_allclose(stats.mean, np.nanmean(values, axis=0), rtol=1e-12)
+        np.testing.assert_allclose(stats.std**2, np.nanvar(values, axis=0), rtol=1e-10)
+
+    def test_from_values(self):
+        self.assertMatches(RunningStats.from_values(self.values), self.values)
+
+    def test_merge(self):
+        stats = RunningStats()
+        for chunk in np.array_split(self.values, 7):
+            stats.merge(RunningStats.from_values(chunk))
+        self.assertMatches(stats, self.values)
+
+    def test_add_remove_replace(self):
+        stats = RunningStats()
+        for x in self.values:
+            stats.add(x)
+        self.assertMatches(stats, self.values)
+        for x in self.values[:50]:
+            stats.remove(x)
+        self.assertMatches(stats, self.values[50:])
+        moved = self.values[50:].copy()
+        moved[0] = moved[0]+5
+        stats.replace(self.values[50], moved[0])
+        self.assertMatches(stats, moved)
+
+    def test_rebase_only_past_tolerance(self):
+        stats = RunningStats.from_values(self.values)
+        self.assertTrue(stats.rebase())
+        key = stats.key()
+        stats.add(self.values[0])  # 1人分の更新では基準を取り直さない
+        self.assertFalse(stats.rebase())
+        self.assertEqual(stats.key(), key)
+        stats.merge(RunningStats.from_values(self.values+10))  # 大きく動けば取り直す
+        self.assertTrue(stats.rebase())
+        self.assertNotEqual(stats.key(), key)
+        np.testing.assert_array_equal(stats.reference()[0], stats.mean)
+
+
+def qubo_energy(model, config):
+    """
+    qubitの値からQUBOのエネルギーを求める。
+    """
+    x = np.zeros(len(model.coefficient_array))
+    for i, v in config.items():
+        x[i] = v
+    for i, v in model.fixed.items():
+        x[i] = 0  # 固定したqubitは係数に畳み込み済み
+    return float(x @ model.coefficient_array @ x+model.const)
+
+
+def encode(model, number):
+    """
+    ノード毎の配車番号（対称性の固定を満たす番号）を、制約を満たすqubitの値にする。
+    """
+    user, taxi, slack = model.user, model.taxi, model.slack
+    config = {user*k+i: 1 for i, k in enumerate(number)}
+    load = np.bincount(number, weights=model.weight, minlength=taxi)
+    for k in range(taxi):
+        # 人数と重みの和が等しくなるスラックビットを探す
+        for bits in itertools.product([0, 1], repeat=len(slack)):
+            if np.dot(bits, slack) == load[k]:
+                break
+        for l, b in enumerate(bits):
+            config[user*taxi+len(slack)*k+l] = b
+    return config
+
+
+class ReductionTests(SimpleTestCase):
+    """
+    同じ地点の利用者をまとめたQUBOのエネルギーが、利用者毎に戻した配車の目的関数値と一致するか確認する。
+    """
+    def test_merge_respects_capacity(self):
+        lat = np.array([35.0]*9+[35.1])
+        node_of = reduction.merge(lat, np.full(10, 139.0), 50, capacity=4)
+        self.assertEqual(np.bincount(node_of).tolist(), [4, 4, 1, 1])
+        self.assertEqual(reduction.merge(lat, np.full(10, 139.0), None, capacity=4).tolist(), node_of.tolist())
+
+    def test_energy_matches_objective(self):
+        rng = np.random.default_rng(0)
+        for trial in range(5):
+            user = 9
+            point = rng.random((user, 2))
+            point[3] = point[0]
+            point[5] = point[0]
+            point[7] = point[2]
+            dist_array = np.triu(np.sqrt(((point[:, None]-point[None])**2).sum(axis=-1)))
+            node_of = reduction.merge(point[:, 0], point[:, 1], 0, sizing.CAPACITY)
+            weight = np.bincount(node_of)
+            taxi = max(sizing.calc_taxi_number(user), reduction.taxi_number(weight))
+            model = main.build_model(dist_array, taxi, node_of=node_of)
+            self.assertLess(model.user, user)
+            for _ in range(20):
+                number = rng.integers(0, taxi, model.user)
+                if np.bincount(number, weights=weight, minlength=taxi).max() > sizing.CAPACITY:
+                    continue
+                _, first, inverse = np.unique(number, return_index=True, return_inverse=True)
+                number = np.argsort(np.argsort(first))[inverse.ravel()]  # 出現順に振り直す（対称性の固定を満たす）
+                config = encode(model, number)
+                objective = partition.calc_objective(dist_array, reduction.expand(number, node_of))
+                self.assertAlmostEqual(qubo_energy(model, config), objective)
+
+                # 解いた結果からも同じ配車番号に戻る
+                response = modeling.Response({'solutions': [{'configuration': config, 'energy': 0.0}],
+                                              'timing': {}})
+                solution = main.decode(response, dist_array, taxi, model, 'test', 0.0)
+                np.testing.assert_array_equal(solution.number, reduction.expand(number, node_of))
+
+
+class SharedCacheTests(SimpleTestCase):
+    """
+    共有キャッシュの削除と読み込みが重なっても、読み込み側が失敗しないことを確認する。
+    """
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, ignore_errors=True)
+        dist_array = np.triu(np.random.default_rng(0).random((4, 4)), 1)
+        self.build = lambda: (dist_array, main.build_model(dist_array, 2))
+
+    def test_purge_keeps_recently_attached(self):
+        shared.get_or_build(self.cache_dir, 'key', self.build)
+        path = os.path.join(self.cache_dir, 'key')
+        os.utime(path, (0, 0))  # 書き出したのは昔
+        self.assertIsNotNone(shared.attach(self.cache_dir, 'key'))
+        shared.purge(self.cache_dir, 60)
+        self.assertTrue(os.path.isdir(path))
+        os.utime(path, (0, 0))
+        shared.purge(self.cache_dir, 60)
+        self.assertFalse(os.path.isdir(path))
+
+    def test_vanished_files_are_a_miss(self):
+        shared.get_or_build(self.cache_dir, 'key', self.build)
+        os.remove(os.path.join(self.cache_dir, 'key', 'value.npy'))  # 読み込みの途中で削除された
+        self.assertIsNone(shared.attach(self.cache_dir, 'key'))
+        self.assertIsNone(shared.attach(self.cache_dir, 'missing'))
+
+    def test_falls_back_to_built_model(self):
+        dist_array, built = self.build()
+        # 書き出した直後に削除された
+        with mock.patch.object(shared, 'attach', return_value=None):
+            got_dist, model = shared.get_or_build(self.cache_dir, 'key', self.build)
+        np.testing.assert_array_equal(got_dist, dist_array)
+        self.assertEqual(model.to_dict(), built.to_dict())
+        # 書き出せない
+        with mock.patch.object(shared, 'publish', side_effect=OSError), \
+                self.assertLogs('taxishare.anneal.shared', 'ERROR'):
+            got_dist, model = shared.get_or_build(self.cache_dir, 'other', self.build)
+        np.testing.assert_array_equal(got_dist, dist_array)
+
+
+class TuningFitTests(SimpleTestCase):
+    """
+    記録から、十分よい解に届いた割合を満たす中で最も速いパラメータを、問題の大きさの区間毎に選ぶことを確認する。
+    """
+    def record(self, qubits, problem, params, energy, elapsed, feasible=True):
+        return {'engine': 'tabu', 'qubits': qubits, 'problem': problem, 'params': params,
+                'energy': energy, 'feasible': feasible, 'elapsed': elapsed}
+
+    def test_fit(self):
+        fast, slow = {'number_iterations': 1000}, {'number_iterations': 20_000}
+        records = []
+        for problem in ['a', 'b', 'c', 'd']:
+            # 30 qubit（区間32）: 速い方は半分しか最良の解に届かない
+            records.append(self.record(30, problem+'30', slow, -10.0, 0.2))
+            records.append(self.record(30, problem+'30', fast, -10.0 if problem in 'ab' else -5.0, 0.01))
+            # 60 qubit（区間64）: 速い方も最良の解に届く（実行可能でない解は最良に数えない）
+            records.append(self.record(60, problem+'60', slow, -20.0, 0.5))
+            records.append(self.record(60, problem+'60', fast, -20.0, 0.02))
+            records.append(self.record(60, problem+'60', {'number_iterations': 5000}, -99.0, 0.001, feasible=False))
+        policy = tuning.fit(records, success_rate=0.9, min_samples=3)
+        self.assertEqual(sorted(policy['tabu']), ['32', '64'])
+        self.assertEqual(policy['tabu']['32']['params'], slow)
+        self.assertEqual(policy['tabu']['32']['samples'], 4)
+        self.assertEqual(policy['tabu']['64']['params'], fast)
+        self.assertEqual(policy['tabu']['64']['success'], 1.0)
+        # 割合を緩めれば、30 qubitでも速い方を選ぶ
+        self.assertEqual(tuning.fit(records, success_rate=0.5)['tabu']['32']['params'], fast)
+        # 記録が足りない区間は選ばない
+        self.assertEqual(tuning.fit(records, min_samples=5), {})
+
+
+class AdmissionTests(SimpleTestCase):
+    """
+    ワーカー数までの計算が並行に動き、それを超えた依頼が次の計算にまとめられることを確認する。
+    """
+    def test_workers_run_concurrently(self):
+        started = threading.Semaphore(0)
+        release = threading.Event()
+
+        def work():
+            started.release()
+            release.wait(5)
+            return 'ok'
+
+        control = admission.Admission(work, workers=2)
+        tickets = [control.request()]
+        self.assertTrue(started.acquire(timeout=5))
+        tickets.append(control.request())
+        self.assertTrue(started.acquire(timeout=5))  # 1つ目の計算中に2つ目のワーカーが始まる
+        tickets += [control.request(), control.request()]
+        self.assertEqual(control.metrics()['queue_depth'], 2)
+        release.set()
+        self.assertTrue(control.join(5))
+        self.assertEqual([t.status for t in tickets], ['done']*4)
+        self.assertEqual(control.metrics()['solves'], 3)
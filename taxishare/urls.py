@@ -25,4 +25,6 @@ urlpatterns = [
     path('place_update/done/<int:pk>/', views.PlaceUpdateDone.as_view(), name='place_update_done'),
     path('taxi_search/<int:pk>/', views.TaxiSearch.as_view(), name='taxi_search'),
     path('taxi_result/<int:pk>/', views.TaxiResult.as_view(), name='taxi_result'),
+    path('taxi_result/<int:pk>/markers/', views.TaxiMarkers.as_view(), name='taxi_markers'),
+    path('dispatch/metrics/', views.DispatchMetrics.as_view(), name='dispatch_metrics'),
 ]
@@ -8,21 +8,20 @@ from django.contrib.auth.views import (
 from django.contrib.sites.shortcuts import get_current_site
 from django.core.mail import send_mail
 from django.core.signing import BadSignature, SignatureExpired, loads, dumps
-from django.http import HttpResponseBadRequest
+from django.http import HttpResponseBadRequest, JsonResponse
 from django.shortcuts import redirect, resolve_url
 from django.template.loader import render_to_string
 from django.urls import reverse_lazy
+from django.utils import timezone
 from django.views import generic
 from .forms import (
     LoginForm, UserCreateForm, UserUpdateForm, MyPasswordChangeForm,
     MyPasswordResetForm, MySetPasswordForm, EmailChangeForm,
     PlaceUpdateForm
 )
-from .models import Taxi
+from .models import Taxi, RiderSnapshot, DispatchRun
 
-from django_pandas.io import read_frame
-
-from taxishare.anneal import main
+from . import dispatch
 
 
 User = get_user_model()
@@ -281,6 +280,23 @@ class PlaceUpdate(OnlyYouMixin, generic.UpdateView):
     form_class = PlaceUpdateForm
     model = User
 
+    def get_context_data(self, **kwargs):
+        """
+        地図に表示する出発地の候補を渡す。
+        """
+        context = super().get_context_data(**kwargs)
+        context['origins'] = settings.TAXISHARE_ORIGINS
+        return context
+
+    def form_valid(self, form):
+        """
+        地点情報を更新し、スナップショットに配車依頼日時を記録する。
+        スナップショットは保存時のシグナルで作り直し済みなので、配車依頼日時だけを更新する。
+        """
+        response = super().form_valid(form)
+        RiderSnapshot.objects.filter(user_id=self.object.pk).update(requested_at=timezone.now())
+        return response
+
     def get_success_url(self):
         """
         地点情報更新完了ページ（利用者側検索中ページ）に飛ぶ。
@@ -304,42 +320,117 @@ class TaxiSearch(OnlyYouMixin, generic.ListView):
 
     def post(self, request, *args, **kwargs):
         """
-        アニーリング処理を行い、配車番号を決定し、データベースを更新する。
+        時間幅内に配車を依頼した利用者についてのアニーリング処理を依頼し、配車結果一覧ページに飛ぶ。
+        計算中の依頼は次の1回の計算にまとめる。期限までに終わらなければ待たずに、公開済みの配車結果を表示する。
         """
-        #　user_tableを読み込み、pandas.dataframeに
-        user_table = User.objects.filter(is_staff=False)  # user_tableの読み込み
-        cols = ['id', 'desitination_latitude', 'desitination_longitude', 'sex', 'birth_date']  # 抽出するカラム
-        df_of_user_table = read_frame(user_table, fieldnames=cols)  #データベースをpandas.dataframe化
-
-        # アニーリング処理
-        number_list = main.main(df_of_user_table)  # user_id順の配車番号が返ってくる
-
-        # taxi_tableを更新
-        Taxi.objects.all().delete()  # 既存taxi_tableのレコード削除
-        taxis = []
-        user_id_list = df_of_user_table['id'].values.tolist()  # user_tableのidリストを取得
-        for i, user_id in enumerate(user_id_list):
-            taxi = Taxi(user_id=user_id, number=number_list[i])
-            taxis.append(taxi)
-        Taxi.objects.bulk_create(taxis) # データベースにtaxi_tableを一括登録
-
-        # メール送信
-        for taxi in Taxi.objects.all():
-            #send_result(obj)
-            # メールの内容
-            context = {
-                'taxi': taxi,
-            }
-            subject = render_to_string('taxishare/mail_template/search/subject.txt', context).strip()
-            message = render_to_string('taxishare/mail_template/search/message.txt', context).strip()
-            send_mail(subject, message, None, [taxi.user.email])
+        dispatch.ADMISSION.wait(dispatch.ADMISSION.request())
 
         return redirect('taxishare:taxi_result', pk=self.kwargs['pk'])
 
 
+class DispatchMetrics(UserPassesTestMixin, generic.View):
+    """
+    配車処理の依頼の待ち行列の長さや待ち時間をJSONで返す（管理者のみ）。
+    """
+    raise_exception = True
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(dispatch.ADMISSION.metrics())
+
+
 class TaxiResult(OnlyYouMixin, generic.ListView):
     """
     タクシーの配車結果一覧ページを表示する。
+    配車番号毎にページを分け、同じタクシーの利用者は同じページに表示する。
+    地図のマーカーはTaxiMarkersから表示範囲の分だけ読み込む。
+    表示中に新しい版が公開されても、最初に読んだ版の配車結果を表示する。
     """
     template_name = 'taxishare/taxi_result.html'
     model = Taxi
+    paginate_by = 20  # 1ページに表示するタクシー数
+
+    def get_queryset(self):
+        self.run_id = DispatchRun.current_id()
+        return Taxi.objects.visible(self.run_id).order_by('number').values_list('number', flat=True).distinct()
+
+    def get_context_data(self, **kwargs):
+        """
+        ページのタクシーの利用者と、出発地から降車順に目的地を結ぶ経路、地図の中心にする出発地を追加する。
+        地点は配車したときのものを使う。
+        """
+        context = super().get_context_data(**kwargs)
+        taxi_list = Taxi.objects.visible(self.run_id).filter(number__in=list(context['object_list'])).select_related(
+            'user', 'vehicle').order_by('number', 'order')
+        routes = {}
+        for taxi in taxi_list:
+            if taxi.number not in routes:
+                routes[taxi.number] = {
+                    'number': taxi.number,
+                    'length': taxi.route_length,
+                    'path': [[taxi.origin_latitude, taxi.origin_longitude]],
+                }
+            routes[taxi.number]['path'].append([taxi.desitination_latitude, taxi.desitination_longitude])
+        context['taxi_list'] = taxi_list
+        context['routes'] = list(routes.values())
+        context['origin'] = self.origin()
+        context['run'] = DispatchRun.objects.filter(pk=self.run_id).first()
+        context['updating'] = DispatchRun.objects.filter(status=DispatchRun.WRITING).exists()
+        return context
+
+    def origin(self):
+        """
+        ページの利用者の出発地（配車済みなら配車したときのもの、未配車なら登録した出発地）を返す。
+        管理者などで出発地が無ければ、最初の出発地を返す。
+        """
+        taxi = Taxi.objects.visible(self.run_id).filter(user_id=self.kwargs['pk'], origin_latitude__isnull=False).first()
+        if taxi is not None:
+            return {'lat': taxi.origin_latitude, 'lng': taxi.origin_longitude}
+        user = get_user_model().objects.filter(pk=self.kwargs['pk']).first()
+        if user is not None and user.origin_latitude is not None and user.origin_longitude is not None:
+            return {'lat': user.origin_latitude, 'lng': user.origin_longitude}
+        _, lat, lng = settings.TAXISHARE_ORIGINS[0]
+        return {'lat': lat, 'lng': lng}
+
+
+class TaxiMarkers(OnlyYouMixin, generic.View):
+    """
+    配車結果の目的地のマーカーを、地図の表示範囲の分だけまとめてJSONで返す。
+    目的地は配車したときのものを使う。
+    """
+    MARKER_LIMIT = 5000  # 1回に返すマーカー数の上限
+    FIELDS = ['lat', 'lng', 'number', 'order']
+
+    def get(self, request, *args, **kwargs):
+        """
+        bbox=南端の緯度,西端の経度,北端の緯度,東端の経度 で範囲を絞る。
+        run=版のid で版を指定する（省略時は現在の版）。
+
+        Returns
+        -------
+        JsonResponse
+            {"fields": [...], "markers": [[緯度, 経度, 配車番号, 降車順], ...], "truncated": bool}
+        """
+        try:
+            run_id = int(request.GET['run']) if request.GET.get('run') else None
+        except ValueError:
+            return HttpResponseBadRequest()
+        taxi_table = Taxi.objects.visible(run_id).filter(desitination_latitude__isnull=False,
+                                                         user__is_superuser=False)
+        bbox = request.GET.get('bbox')
+        if bbox:
+            try:
+                south, west, north, east = map(float, bbox.split(','))
+            except ValueError:
+                return HttpResponseBadRequest()
+            taxi_table = taxi_table.filter(desitination_latitude__range=(south, north))
+            if west <= east:
+                taxi_table = taxi_table.filter(desitination_longitude__range=(west, east))
+            else:  # 日付変更線をまたぐ範囲
+                taxi_table = taxi_table.exclude(desitination_longitude__range=(east, west))
+        rows = list(taxi_table.order_by('number', 'order').values_list(
+            'desitination_latitude', 'desitination_longitude', 'number', 'order')[:self.MARKER_LIMIT+1])
+        markers = [[round(lat, 6), round(lng, 6), number, order] for lat, lng, number, order in rows[:self.MARKER_LIMIT]]
+        return JsonResponse({'fields': self.FIELDS, 'markers': markers, 'truncated': len(rows) > self.MARKER_LIMIT})